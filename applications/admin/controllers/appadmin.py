@@ -31,7 +31,8 @@ response.view = 'appadmin.html'
 response.menu = [[T('design'), False, URL('admin', 'default', 'design',
                  args=[request.application])], [T('db'), False,
                  URL(r=request, f='index')], [T('state'), False,
-                 URL(r=request, f='state')]]
+                 URL(r=request, f='state')], [T('cache'), False,
+                 URL(r=request, f='ccache')]]
 
 # ##########################################################
 # ## auxiliary functions
@@ -128,7 +129,8 @@ def download():
 
     # ## end for GAE ###
 
-    path = os.path.join(request.folder, 'uploads/', filename)
+    from gluon.fileutils import locate
+    path = locate(os.path.join(request.folder, 'uploads/'), filename)
     return response.stream(open(path, 'rb'))
 
 
@@ -266,3 +268,21 @@ def state():
     return dict()
 
 
+# ##########################################################
+# ## cache statistics
+# ###########################################################
+
+
+def ccache():
+    forms = {}
+    for name in ('ram', 'disk'):
+        form = forms[name] = FORM(INPUT(_type='submit',
+                                  _value=T('clear')))
+        if form.accepts(request.post_vars, session, formname='clear_'
+                         + name):
+            getattr(cache, name).clear()
+            session.flash = T('cache cleared')
+            redirect(URL(r=request))
+    return dict(stats=cache.stats(), forms=forms)
+
+
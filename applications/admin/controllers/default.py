@@ -325,7 +325,8 @@ def cleanup():
     session.flash = T('cache, errors and sessions cleaned')
 
     # Remove cache files
-    files = listdir(apath('%s/cache/' % app), 'cache.*', 0)
+    files = listdir(apath('%s/cache/' % app), '^(cache.*|[0-9a-f]{32})$',
+                    0)
     for file in files:
         try:
             os.unlink(file)
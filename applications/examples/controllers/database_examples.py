@@ -126,11 +126,12 @@ def download():
     """ used to download uploaded files """
 
     import gluon.contenttype
+    from gluon.fileutils import locate
     app = request.application
     filename = request.args[0]
     response.headers['Content-Type'] = \
         gluon.contenttype.contenttype(filename)
-    return open('applications/%s/uploads/%s' % (app, filename), 'rb'
+    return open(locate('applications/%s/uploads' % app, filename), 'rb'
                 ).read()
 
 
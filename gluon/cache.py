@@ -9,26 +9,367 @@ License: GPL v2
 
 import time
 import portalocker
-import shelve
+import tempfile
 import thread
+import uuid
 import cPickle
+import cStringIO
 import os
 import logging
 import re
-try:
-    import dbhash
-except:
-    logging.warning('unable to import dbhash')
+import heapq
+from utils import md5_hash
+from fileutils import make_dirs
+from storage import Storage
+from http import HTTP
 
 __all__ = ['Cache']
 
+regex_shard = re.compile('^[0-9a-f]{2}$')
+regex_entry = re.compile('^[0-9a-f]{32}$')
+regex_prefix = re.compile('/?[^/:]*')
+regex_default_repr = re.compile(' at 0x[0-9a-fA-F]+>')
 
-class CacheInRam(object):
+
+class SingleFlight(object):
+
+    """
+    per key locks of the process, so that only one thread at a time
+    computes the value of a key
+    """
+
+    def __init__(self):
+        self.locker = thread.allocate_lock()
+        self.locks = {}  # ## key -> [lock, number of threads using it]
+
+    def acquire(self, key, blocking=True):
+        self.locker.acquire()
+        entry = self.locks.get(key, None)
+        if entry and not blocking:
+            self.locker.release()
+            return False
+        if not entry:
+            entry = self.locks[key] = [thread.allocate_lock(), 0]
+        entry[1] += 1
+        self.locker.release()
+        entry[0].acquire()
+        return True
+
+    def release(self, key):
+        self.locker.acquire()
+        entry = self.locks[key]
+        entry[1] -= 1
+        if not entry[1]:
+            del self.locks[key]
+        entry[0].release()
+        self.locker.release()
+
+
+def key_prefix(key):
+    """
+    the part of key the statistics are grouped by: up to the first : or
+    the second /, e.g. '/app' for '/app/default/index'
+    """
+
+    return regex_prefix.match(key).group()
+
+
+def function_name(func):
+    """
+    module.name of func; functions defined in models and controllers have
+    no module and are named after their file, e.g. controllers.default.index
+    """
+
+    module = func.__module__
+    if not module or module == '__builtin__':
+        (folder, filename) = os.path.split(func.func_code.co_filename)
+        module = '%s.%s' % (os.path.basename(folder),
+                            os.path.splitext(filename)[0])
+    return '%s.%s' % (module, func.__name__)
+
+
+class CacheAbstract(object):
+
+    """
+    the logic shared by the cache models. when a key is missing or
+    expired one thread computes it while the others wait, or return the
+    expired value if there is one. with stale_while_revalidate=seconds an
+    entry expired for less than that is returned at once and computed
+    again in a background thread, so f must not depend on the request;
+    the models keep such entries for time_expire+stale_while_revalidate.
+    entries stored with tags=[...] are removed by invalidate_tags(*tags).
+
+    models using resources of the request, like the db of CacheInDb, are
+    request_scoped: their stale entries are computed again within the
+    request, not in a background thread, and they cannot cache pages.
+
+    the models implement _read(key) -> (time, value, ...) or None,
+    _write(key, value, time_expire, tags), _remove(key) and
+    invalidate_tags(*tags), and may implement _lock(key, blocking) and
+    _unlock(key) to also exclude other processes.
+
+    the counters of stats() are kept per model class and application for
+    the life of the process.
+    """
+
+    flights = SingleFlight()
+    stats_locker = thread.allocate_lock()
+    meta_stats = {}
+    request_scoped = False
+
+    def __call__(
+        self,
+        key,
+        f,
+        time_expire=300,
+        stale_while_revalidate=0,
+        tags=None,
+        ):
+        dt = time_expire
+        if f is None:
+            self._remove(key)
+            return None
+        keep = time_expire + stale_while_revalidate
+        item = self._read(key)
+        now = time.time()
+        if item and item[0] > now - dt:
+            self._count('hits')
+            return item[1]
+        if item and item[0] > now - dt - stale_while_revalidate\
+             and not self.request_scoped:
+            self._count('stale')
+            self._refresh(key, f, keep, tags)
+            return item[1]
+        if not self._acquire(key, blocking=not item):
+            self._count('stale')
+            return item[1]  # ## being computed by another thread
+        try:
+            item = self._read(key)
+            if item and item[0] > time.time() - dt:
+                self._count('hits')
+                return item[1]
+            self._count('misses')
+            value = self._compute(key, f)
+            self._write(key, value, keep, tags)
+        finally:
+            self._release(key)
+        return value
+
+    def _counters(self):
+        request = getattr(self, 'request', None)
+        name = (self.__class__.__name__, request and request.application)
+        counters = self.meta_stats.get(name, None)
+        if counters is None:
+            self.stats_locker.acquire()
+            counters = self.meta_stats.setdefault(name, Storage(hits=0,
+                    misses=0, stale=0, evictions=0, expired=0,
+                    prefixes={}))
+            self.stats_locker.release()
+        return counters
+
+    def _count(self, counter, n=1):
+        counters = self._counters()
+        self.stats_locker.acquire()
+        counters[counter] += n
+        self.stats_locker.release()
+
+    def _compute(self, key, f):
+        t0 = time.time()
+        value = f()
+        seconds = time.time() - t0
+        counters = self._counters()
+        prefix = key_prefix(key)
+        self.stats_locker.acquire()
+        entry = counters.prefixes.get(prefix, None)
+        if not entry:
+            entry = counters.prefixes[prefix] = Storage(count=0,
+                    seconds=0.0)
+        entry.count += 1
+        entry.seconds += seconds
+        self.stats_locker.release()
+        return value
+
+    def stats(self):
+        """
+        returns a Storage with the counters hits, misses, stale (expired
+        values returned while being computed), evictions and expired, the
+        prefixes (see key_prefix) with the count and seconds of the
+        computations, and the entries and bytes stored if known
+        """
+
+        counters = self._counters()
+        self.stats_locker.acquire()
+        stats = Storage(counters)
+        stats.prefixes = dict([(prefix, Storage(entry)) for (prefix,
+                              entry) in counters.prefixes.items()])
+        self.stats_locker.release()
+        stats.entries = stats.bytes = None
+        stats.update(self._usage())
+        return stats
+
+    def _usage(self):
+        return {}
+
+    def _flight_key(self, key):
+        request = getattr(self, 'request', None)
+        return (self.__class__.__name__, request and request.application,
+                key)
+
+    def _acquire(self, key, blocking=True):
+        if not self.flights.acquire(self._flight_key(key), blocking):
+            return False
+        try:
+            if self._lock(key, blocking):
+                return True
+        except:
+            self.flights.release(self._flight_key(key))
+            raise
+        self.flights.release(self._flight_key(key))
+        return False
+
+    def _release(self, key):
+        try:
+            self._unlock(key)
+        finally:
+            self.flights.release(self._flight_key(key))
+
+    def _lock(self, key, blocking=True):
+        return True
+
+    def _unlock(self, key):
+        pass
+
+    def _refresh(
+        self,
+        key,
+        f,
+        time_expire,
+        tags=None,
+        ):
+        if not self._acquire(key, blocking=False):
+            return
+
+        def refresh():
+            try:
+                try:
+                    self._write(key, self._compute(key, f),
+                                time_expire, tags)
+                except Exception:
+                    logging.error('unable to refresh cache key %s' % key)
+            finally:
+                self._release(key)
+
+        thread.start_new_thread(refresh, ())
+
+
+class RamStorage(dict):
+
+    """
+    the cache.ram entries of one application, key -> (time, value, deadline),
+    iterated from the least to the most recently used: the keys are also
+    in a circular linked list of [previous, next, key] links
+    """
+
+    def __init__(self):
+        dict.__init__(self)
+        self.root = root = []
+        root[:] = [root, root, None]
+        self.links = {}
+        self.max_entries = None
+        self.max_bytes = None
+        self.sizes = {}
+        self.bytes = 0
+        self.deadlines = []  # ## heap of (deadline, key)
+        self.tags = {}  # ## tag -> set of keys
+        self.key_tags = {}  # ## key -> tags
+
+    def __setitem__(self, key, value):
+        if not dict.has_key(self, key):
+            root = self.root
+            last = root[0]
+            last[1] = root[0] = self.links[key] = [last, root, key]
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        (previous, next, key) = self.links.pop(key)
+        previous[1] = next
+        next[0] = previous
+
+    def touch(self, key):
+        """
+        makes key the most recently used
+        """
+
+        link = self.links[key]
+        if link[1] is not self.root:
+            (previous, next, key) = link
+            previous[1] = next
+            next[0] = previous
+            root = self.root
+            last = root[0]
+            link[:] = [last, root, key]
+            last[1] = root[0] = link
+
+    def __iter__(self):
+        (root, link) = (self.root, self.root[1])
+        while link is not root:
+            yield link[2]
+            link = link[1]
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def clear(self):
+        dict.clear(self)
+        root = self.root
+        root[:] = [root, root, None]
+        self.links.clear()
+        self.sizes.clear()
+        self.bytes = 0
+        del self.deadlines[:]
+        self.tags.clear()
+        self.key_tags.clear()
+
+
+def _size(value):
+    try:
+        return len(cPickle.dumps(value, -1))
+    except Exception:
+        return len(repr(value))  # ## not picklable, a rough estimate
+
+
+class CacheInRam(CacheAbstract):
+
+    """
+    cache shared by the threads of the process, one RamStorage per
+    application. an application can be limited to max_entries entries
+    and about max_bytes bytes (as pickled), for example in a model:
+
+        cache.ram = CacheInRam(request, max_entries=1000)
+
+    the class attributes are the limits of the applications that do not
+    set their own. the least recently used entries go first, and expired
+    ones are removed while storing new ones.
+    """
 
     locker = thread.allocate_lock()
     meta_storage = {}
+    max_entries = None
+    max_bytes = None
 
-    def __init__(self, request=None):
+    def __init__(
+        self,
+        request=None,
+        max_entries=None,
+        max_bytes=None,
+        ):
         self.locker.acquire()
         self.request = request
         if request:
@@ -36,9 +377,13 @@ class CacheInRam(object):
         else:
             app = ''
         if not self.meta_storage.has_key(app):
-            self.storage = self.meta_storage[app] = {}
+            self.storage = self.meta_storage[app] = RamStorage()
         else:
             self.storage = self.meta_storage[app]
+        if max_entries is not None:
+            self.storage.max_entries = max_entries
+        if max_bytes is not None:
+            self.storage.max_bytes = max_bytes
         self.locker.release()
 
     def clear(self, regex=None):
@@ -50,126 +395,1048 @@ class CacheInRam(object):
             r = re.compile(regex)
             for key in storage.keys():
                 if r.match(key):
-                    del storage[key]
+                    self._drop(key)
         self.locker.release()
 
-    def __call__(
+    def _read(self, key):
+        self.locker.acquire()
+        storage = self.storage
+        item = storage.get(key, None)
+        if item:
+            storage.touch(key)
+        self.locker.release()
+        return item
+
+    def _write(
         self,
         key,
-        f,
-        time_expire=300,
+        value,
+        time_expire,
+        tags=None,
         ):
-        dt = time_expire
         self.locker.acquire()
-        item = self.storage.get(key, None)
-        if item and f == None:
-            del self.storage[key]
-        self.locker.release()
-        if f is None:
-            return None
-        if item and item[0] > time.time() - dt:
-            return item[1]
-        value = f()
+        try:
+            self._store(key, value, time_expire, tags)
+        finally:
+            self.locker.release()
+
+    def _remove(self, key):
         self.locker.acquire()
-        self.storage[key] = (time.time(), value)
+        if key in self.storage:
+            self._drop(key)
         self.locker.release()
-        return value
 
     def increment(self, key, value=1):
         self.locker.acquire()
         try:
             if self.storage.has_key(key):
                 value = self.storage[key][1] + value
-            self.storage[key] = (time.time(), value)
+            self._store(key, value)
         except BaseException, e:
             self.locker.release()
             raise e
         self.locker.release()
         return value
 
+    def _usage(self):
+        self.locker.acquire()
+        storage = self.storage
+        values = [item[1] for item in storage.values()]
+        sized = storage.max_bytes or self.max_bytes
+        self.locker.release()
+        if sized:
+            size = storage.bytes
+        else:
+            size = sum([_size(value) for value in values])
+        return dict(entries=len(values), bytes=size)
+
+    def invalidate_tags(self, *tags):
+        self.locker.acquire()
+        try:
+            for tag in tags:
+                for key in list(self.storage.tags.get(tag, ())):
+                    self._drop(key)
+        finally:
+            self.locker.release()
+
+    def _store(
+        self,
+        key,
+        value,
+        time_expire=None,
+        tags=None,
+        ):
+        """
+        stores an entry, then drops the expired and the least recently
+        used ones above the limits. called with the lock held.
+        """
+
+        storage = self.storage
+        now = time.time()
+        if key in storage:
+            self._drop(key)
+        deadline = None
+        if time_expire is not None:
+            deadline = now + time_expire
+            heapq.heappush(storage.deadlines, (deadline, key))
+        storage[key] = (now, value, deadline)
+        if tags:
+            storage.key_tags[key] = tags
+            for tag in tags:
+                storage.tags.setdefault(tag, set()).add(key)
+        max_entries = storage.max_entries
+        if max_entries is None:
+            max_entries = self.max_entries
+        max_bytes = storage.max_bytes
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        if max_bytes:
+            size = storage.sizes[key] = _size(value)
+            storage.bytes += size
+        deadlines = storage.deadlines
+        while deadlines and deadlines[0][0] < now:
+            (deadline, old_key) = heapq.heappop(deadlines)
+            item = storage.get(old_key, None)
+            if item and item[2] == deadline:
+                self._drop(old_key)
+                self._count('expired')
+        if len(deadlines) > 2 * len(storage) + 100:
+
+            # ## forget the deadlines of entries stored again or dropped
 
-class CacheOnDisk(object):
+            deadlines[:] = [(item[2], k) for (k, item) in
+                            storage.items() if item[2] is not None]
+            heapq.heapify(deadlines)
+        while storage and (max_entries and len(storage) > max_entries
+                            or max_bytes and storage.bytes > max_bytes):
+            self._drop(iter(storage).next())
+            self._count('evictions')
+
+    def _drop(self, key):
+        storage = self.storage
+        del storage[key]
+        storage.bytes -= storage.sizes.pop(key, 0)
+        for tag in storage.key_tags.pop(key, ()):
+            keys = storage.tags[tag]
+            keys.discard(key)
+            if not keys:
+                del storage.tags[tag]
+
+
+def tag_folder(folder, tag):
+    return os.path.join(folder, '.tags', md5_hash(tag))
+
+
+class CacheOnDisk(CacheAbstract):
+
+    """
+    one file per key in cache/xx/<md5 of key>. a file holds the pickled
+    (key, time, deadline, tags) and then the pickled value, and is
+    replaced atomically, so readers take no lock and writers only lock
+    their key.
+
+    entries with a deadline are listed in cache/.expiry/<bucket>/ and
+    every expiry_bucket seconds a write removes the expired ones.
+    entries with tags are listed in cache/.tags/<md5 of tag>/, until they
+    are removed or stored again without the tag.
+    """
+
+    expiry_bucket = 60
+    last_sweep = {}
 
     def __init__(self, request):
         self.request = request
-        self.locker = open(os.path.join(request.folder,
-                           'cache/cache.lock'), 'a')
-        self.shelve_name = os.path.join(request.folder,
-                'cache/cache.shelve')
+        self.folder = os.path.join(request.folder, 'cache')
+        self.key_lockers = {}
+
+    def _path(self, key):
+        name = md5_hash(key)
+        return os.path.join(self.folder, name[:2], name)
+
+    def _files(self):
+        for (root, dirs, files) in os.walk(self.folder):
+            if root == self.folder:
+                dirs[:] = [d for d in dirs if regex_shard.match(d)]
+            else:
+                for name in files:
+                    if regex_entry.match(name):
+                        yield os.path.join(root, name)
+
+    def _header(self, filename):
+        """
+        the (key, time, deadline, tags) of the entry in filename or None
+        """
+
+        try:
+            f = open(filename, 'rb')
+        except IOError:
+            return None
+        try:
+            try:
+                return cPickle.load(f)
+            except Exception:
+                return None
+        finally:
+            f.close()
+
+    def _unmark(self, filename, tags):
+        """
+        removes the entry in filename from the lists of tags
+        """
+
+        for tag in tags or ():
+            folder = tag_folder(self.folder, tag)
+            try:
+                os.unlink(os.path.join(folder,
+                          os.path.basename(filename)))
+                os.rmdir(folder)
+            except OSError:
+                pass  # ## or the folder lists other entries
+
+    def _unlink(self, filename, header):
+        os.unlink(filename)
+        if header:
+            self._unmark(filename, header[3])
 
     def clear(self, regex=None):
-        portalocker.lock(self.locker, portalocker.LOCK_EX)
-        storage = shelve.open(self.shelve_name)
-        if regex == None:
-            storage.clear()
-        else:
+        if regex != None:
             r = re.compile(regex)
-            for key in storage.keys():
-                if r.match(key):
-                    del storage[key]
-            storage.sync()
-        portalocker.unlock(self.locker)
+        for filename in self._files():
+            header = self._header(filename)
+            if regex != None and (not header or not r.match(header[0])):
+                continue
+            try:
+                self._unlink(filename, header)
+            except Exception:
+                pass  # ## being replaced or removed by another thread
 
-    def __call__(
+    def _read(self, key):
+        try:
+            f = open(self._path(key), 'rb')
+        except IOError:
+            return None
+        try:
+            try:
+                header = cPickle.load(f)
+                if header[0] != key:
+                    return None
+                return (header[1], cPickle.load(f), header[2])
+            except Exception:
+                return None
+        finally:
+            f.close()
+
+    def _write(
         self,
         key,
-        f,
-        time_expire=300,
+        value,
+        time_expire,
+        tags=None,
         ):
-        dt = time_expire
-        portalocker.lock(self.locker, portalocker.LOCK_EX)
-        storage = shelve.open(self.shelve_name)
-        item = storage.get(key, None)
-        if item and f == None:
-            del storage[key]
-        portalocker.unlock(self.locker)
-        if f is None:
-            return None
-        if item and item[0] > time.time() - dt:
-            return item[1]
-        value = f()
-        portalocker.lock(self.locker, portalocker.LOCK_EX)
-        storage[key] = (time.time(), value)
-        storage.sync()
-        portalocker.unlock(self.locker)
+        now = time.time()
+        deadline = None
+        if time_expire is not None:
+            deadline = now + time_expire
+        path = self._path(key)
+        make_dirs(path)
+        old = self._header(path)
+        (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(path))
+        f = os.fdopen(fd, 'wb')
+        try:
+            try:
+                cPickle.dump((key, now, deadline, tags), f, 2)
+                cPickle.dump(value, f, 2)
+            finally:
+                f.close()
+            try:
+                os.rename(tmp, path)
+            except OSError:
+                os.unlink(path)  # ## windows does not replace files
+                os.rename(tmp, path)
+        except:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        if old and old[3]:
+            self._unmark(path, [tag for tag in old[3] if not tag
+                         in (tags or ())])
+        markers = [tag_folder(self.folder, tag) for tag in tags or []]
+        if deadline is not None:
+            markers.append(os.path.join(self.folder, '.expiry',
+                           str(int(deadline // self.expiry_bucket))))
+        for folder in markers:
+            marker = os.path.join(folder, os.path.basename(path))
+            make_dirs(marker)
+            open(marker, 'wb').close()
+        if now - self.last_sweep.get(self.folder, 0)\
+             > self.expiry_bucket:
+            self.last_sweep[self.folder] = now
+            self.sweep()
+
+    def _remove(self, key):
+        path = self._path(key)
+        try:
+            self._unlink(path, self._header(path))
+        except OSError:
+            pass
+
+    def _usage(self):
+        (entries, size) = (0, 0)
+        for filename in self._files():
+            try:
+                size += os.path.getsize(filename)
+                entries += 1
+            except OSError:
+                pass
+        return dict(entries=entries, bytes=size)
+
+    def invalidate_tags(self, *tags):
+        for tag in tags:
+            folder = tag_folder(self.folder, tag)
+            if not os.path.isdir(folder):
+                continue
+            for name in os.listdir(folder):
+                filename = os.path.join(self.folder, name[:2], name)
+                header = self._header(filename)
+                try:
+                    if header and tag in (header[3] or ()):
+                        self._unlink(filename, header)
+                    os.unlink(os.path.join(folder, name))
+                except OSError:
+                    pass
+            try:
+                os.rmdir(folder)
+            except OSError:
+                pass
+
+    def sweep(self):
+        """
+        removes the entries listed in the buckets that are over
+        """
+
+        now = time.time()
+        index = os.path.join(self.folder, '.expiry')
+        if not os.path.isdir(index):
+            return
+        for bucket in os.listdir(index):
+            try:
+                end = (int(bucket) + 1) * self.expiry_bucket
+            except ValueError:
+                continue
+            if end > now:
+                continue
+            path = os.path.join(index, bucket)
+            for name in os.listdir(path):
+                filename = os.path.join(self.folder, name[:2], name)
+                header = self._header(filename)
+                try:
+                    if header and header[2] is not None and header[2]\
+                         <= end:
+                        self._unlink(filename, header)  # ## else stored again
+                        self._count('expired')
+                except Exception:
+                    pass
+                os.unlink(os.path.join(path, name))
+            try:
+                os.rmdir(path)
+            except OSError:
+                pass
+
+    def _lock(self, key, blocking=True):
+        """
+        locks cache/.locks/<md5 of key>, so that other processes do not
+        compute key at once. _unlock removes the file while it is still
+        locked, so a process that gets the lock of a removed file tries
+        again with a new one.
+        """
+
+        name = os.path.join(self.folder, '.locks', md5_hash(key))
+        flags = portalocker.LOCK_EX
+        if not blocking and portalocker.LOCK_NB:
+            flags |= portalocker.LOCK_NB
+        while True:
+            make_dirs(name)
+            locker = open(name, 'a')
+            try:
+                portalocker.lock(locker, flags)
+            except IOError:
+                locker.close()
+                return False
+            if not hasattr(os.path, 'samestat'):
+                break  # ## windows, where open files are not removed
+            try:
+                if os.path.samestat(os.fstat(locker.fileno()),
+                                    os.stat(name)):
+                    break
+            except OSError:
+                pass
+            portalocker.unlock(locker)
+            locker.close()
+        self.key_lockers[key] = (name, locker)
+        return True
+
+    def _unlock(self, key):
+        (name, locker) = self.key_lockers.pop(key)
+        try:
+            os.unlink(name)
+        except OSError:
+            pass
+        portalocker.unlock(locker)
+        locker.close()
+
+    def increment(self, key, value=1):
+        self._acquire(key)
+        try:
+            item = self._read(key)
+            if item:
+                value = item[1] + value
+            self._write(key, value, None)
+        finally:
+            self._release(key)
         return value
 
+
+class MemcacheAbstract(CacheAbstract):
+
+    """
+    CacheAbstract for clients with the get/set/add/delete methods of
+    memcache, keys are prefixed with the application. the lock of a key
+    is a memcache key added with a lock_timeout, so it is shared by all
+    processes and machines using the same servers.
+
+    tags have a version, a memcache key set to a new uuid when they are
+    invalidated. entries store the versions of their tags and are
+    ignored when one has changed.
+    """
+
+    lock_timeout = 60
+
+    def _key(self, key):
+        return '%s/%s' % (self.request.application, key)
+
+    def _read(self, key):
+        item = self.get(self._key(key))
+        if item and len(item) > 2 and item[2]:
+            for (tag, version) in item[2].items():
+                if self._tag_version(tag) != version:
+                    return None
+        return item
+
+    def _write(
+        self,
+        key,
+        value,
+        time_expire,
+        tags=None,
+        ):
+        versions = None
+        if tags:
+            versions = dict([(tag, self._tag_version(tag)) for tag in
+                            tags])
+        self.set(self._key(key), (time.time(), value, versions))
+
+    def _tag_version(self, tag):
+        tag_key = self._key('tag/%s' % tag)
+        version = self.get(tag_key)
+        if not version:
+            self.add(tag_key, str(uuid.uuid4()))
+            version = self.get(tag_key)
+        return version
+
+    def invalidate_tags(self, *tags):
+        for tag in tags:
+            self.set(self._key('tag/%s' % tag), str(uuid.uuid4()))
+
+    def _usage(self):
+        """
+        entries and bytes of the memcache servers, used by all the
+        applications
+        """
+
+        try:
+            stats = self.get_stats()
+        except Exception:
+            return {}
+        if isinstance(stats, dict):  # ## google app engine
+            return dict(entries=stats.get('items'), bytes=stats.get('bytes'))
+        (entries, size) = (0, 0)
+        for (server, values) in stats:
+            entries += int(values.get('curr_items', 0))
+            size += int(values.get('bytes', 0))
+        return dict(entries=entries, bytes=size)
+
+    def _remove(self, key):
+        self.delete(self._key(key))
+
+    def clear(self, regex=None):
+        """
+        empties the memcache servers with flush_all, which removes the
+        entries of all the applications. memcache cannot list its keys,
+        so clearing the keys that match a regex is not supported.
+        """
+
+        if regex is not None:
+            raise SyntaxError, 'memcache does not support clear(regex)'
+        self.flush_all()
+
+    def _lock(self, key, blocking=True):
+        lock_key = self._key('lock/%s' % key)
+        deadline = time.time() + self.lock_timeout
+        while not self.add(lock_key, 1, self.lock_timeout):
+            if not blocking:
+                return False
+            if time.time() > deadline:
+                logging.warning('cache lock %s timed out' % lock_key)
+                self.delete(lock_key)
+            time.sleep(0.05)
+        return True
+
+    def _unlock(self, key):
+        self.delete(self._key('lock/%s' % key))
+
     def increment(self, key, value=1):
-        portalocker.lock(self.locker, portalocker.LOCK_EX)
-        storage = shelve.open(self.shelve_name)
+        key = self._key(key)
+        obj = self.get(key)
+        if obj:
+            value = obj[1] + value
+        self.set(key, (time.time(), value))
+        return value
+
+
+class CacheInDb(CacheAbstract):
+
+    """
+    a cache shared by the processes and machines using the same database,
+    for example in a model:
+
+        cache.db = CacheInDb(request, db)
+
+    one record per key in the table tablename (one table for all the
+    applications), looked up by the md5 of application/key which is
+    unique, and one record per tag of an entry in tablename_tag, indexed
+    by the md5 of application/tag. the indexes are created with the
+    tables. every expiry_bucket seconds a write deletes the expired
+    records, sweep_batch at a time. records are written in the
+    transaction of the request, and computations are only excluded
+    within a process. it is request_scoped: it must be created in the
+    models of each request, with the db of the request.
+    """
+
+    expiry_bucket = 60
+    sweep_batch = 1000
+    last_sweep = {}
+    request_scoped = True
+
+    def __init__(
+        self,
+        request,
+        db,
+        tablename='web2py_cache',
+        migrate=True,
+        ):
+        self.request = request
+        self.db = db
+        table = db.get(tablename, None)
+        if table is None:
+            table = db.define_table(
+                tablename,
+                db.Field('application', length=64),
+                db.Field('cache_key', length=512),
+                db.Field('key_hash', length=32, unique=True),
+                db.Field('created', 'double'),
+                db.Field('deadline', 'double'),
+                db.Field('value_size', 'integer'),
+                db.Field('cache_value', 'blob'),
+                migrate=migrate,
+                indexes=['deadline'],
+                )
+        self.table = table
+        tag_table = db.get(tablename + '_tag', None)
+        if tag_table is None:
+            tag_table = db.define_table(
+                tablename + '_tag',
+                db.Field('application', length=64),
+                db.Field('tag_hash', length=32),
+                db.Field('key_hash', length=32),
+                migrate=migrate,
+                indexes=[('tag_hash', 'key_hash'), 'key_hash'],
+                )
+        self.tag_table = tag_table
+
+    def _hash(self, key):
+        return md5_hash('%s/%s' % (self.request.application, key))
+
+    def _read(self, key):
+        table = self.table
+        query = table.key_hash == self._hash(key)
+        rows = self.db(query).select(table.cache_key, table.created,
+                table.deadline, table.cache_value, limitby=(0, 1))
+        if not rows or rows[0].cache_key != key:
+            return None
+        row = rows[0]
         try:
-            if storage.has_key(key):
-                value = storage[key][1] + value
-            storage[key] = (time.time(), value)
-            storage.sync()
-        except BaseException, e:
-            portalocker.unlock(self.locker)
-            raise e
-        portalocker.unlock(self.locker)
+            return (row.created, cPickle.loads(row.cache_value),
+                    row.deadline)
+        except Exception:
+            return None
+
+    def _insert(self, table, **fields):
+        """
+        inserts a record, returns False if it violates a unique
+        constraint. on postgres the insert is done in a savepoint since
+        an error aborts the whole transaction of the request
+        """
+
+        savepoint = self.db._dbname == 'postgres'
+        if savepoint:
+            self.db._execute('SAVEPOINT web2py_cache;')
+        try:
+            table.insert(**fields)
+        except Exception, e:
+            if savepoint:
+                self.db._execute('ROLLBACK TO SAVEPOINT web2py_cache;')
+            if e.__class__.__name__ != 'IntegrityError':
+                raise
+            return False
+        if savepoint:
+            self.db._execute('RELEASE SAVEPOINT web2py_cache;')
+        return True
+
+    def _write(
+        self,
+        key,
+        value,
+        time_expire,
+        tags=None,
+        ):
+        now = time.time()
+        deadline = None
+        if time_expire is not None:
+            deadline = now + time_expire
+        data = cPickle.dumps(value, 2)
+        fields = dict(created=now, deadline=deadline,
+                      value_size=len(data), cache_value=data)
+        (table, tag_table) = (self.table, self.tag_table)
+        application = self.request.application
+        key_hash = self._hash(key)
+        query = table.key_hash == key_hash
+        if not self.db(query).update(**fields):
+            if not self._insert(table, application=application,
+                                cache_key=key, key_hash=key_hash,
+                                **fields):
+                self.db(query).update(**fields)  # ## written meanwhile
+        self.db(tag_table.key_hash == key_hash).delete()
+        for tag in tags or []:
+            tag_table.insert(application=application,
+                             tag_hash=self._hash(tag), key_hash=key_hash)
+        name = table._tablename
+        if now - self.last_sweep.get(name, 0) > self.expiry_bucket:
+            self.last_sweep[name] = now
+            self.sweep()
+
+    def _remove(self, key):
+        self._delete([self._hash(key)])
+
+    def _delete(self, key_hashes):
+        (table, tag_table) = (self.table, self.tag_table)
+        for i in range(0, len(key_hashes), self.sweep_batch):
+            batch = key_hashes[i:i + self.sweep_batch]
+            self.db(table.key_hash.belongs(batch)).delete()
+            self.db(tag_table.key_hash.belongs(batch)).delete()
+
+    def clear(self, regex=None):
+        table = self.table
+        query = table.application == self.request.application
+        if regex is None:
+            self.db(query).delete()
+            tag_table = self.tag_table
+            self.db(tag_table.application
+                    == self.request.application).delete()
+            return
+        r = re.compile(regex)
+        self._delete([row.key_hash for row in
+                     self.db(query).select(table.key_hash,
+                     table.cache_key) if r.match(row.cache_key)])
+
+    def invalidate_tags(self, *tags):
+        tag_table = self.tag_table
+        for tag in tags:
+            query = tag_table.tag_hash == self._hash(tag)
+            while True:
+                rows = self.db(query).select(tag_table.key_hash,
+                        limitby=(0, self.sweep_batch))
+                self._delete([row.key_hash for row in rows])
+                if len(rows) < self.sweep_batch:
+                    break
+
+    def sweep(self):
+        """
+        deletes the expired records of all the applications
+        """
+
+        table = self.table
+        while True:
+            rows = self.db(table.deadline
+                            < time.time()).select(table.key_hash,
+                    limitby=(0, self.sweep_batch))
+            self._delete([row.key_hash for row in rows])
+            self._count('expired', len(rows))
+            if len(rows) < self.sweep_batch:
+                break
+
+    def _usage(self):
+        table = self.table
+        (count, size) = (table.id.count(), table.value_size.sum())
+        row = self.db(table.application
+                      == self.request.application).select(count,
+                size)[0]._extra
+        return dict(entries=row[str(count)], bytes=row[str(size)] or 0)
+
+    def increment(self, key, value=1):
+        self._acquire(key)
+        try:
+            item = self._read(key)
+            if item:
+                value = item[1] + value
+            self._write(key, value, None)
+        finally:
+            self._release(key)
+        return value
+
+
+class CacheTiered(CacheAbstract):
+
+    """
+    a ram cache in front of a shared model, by default cache.disk:
+
+        cache.tiered = CacheTiered(request, cache.memcache, local_expire=5)
+
+    entries found in the shared model are kept in ram for at most
+    local_expire seconds, so the hottest keys need no disk or network
+    access. the ram tier has its own storage, limited to local_max_entries.
+    invalidate_tags, clear and increment only reach the ram tier of this
+    process; the others see the change within local_expire seconds.
+    """
+
+    local_expire = 5
+    local_max_entries = 1000
+
+    def __init__(
+        self,
+        request,
+        shared=None,
+        local_expire=None,
+        ):
+        self.request = request
+        self.shared = shared or CacheOnDisk(request)
+        self.request_scoped = self.shared.request_scoped
+        if local_expire is not None:
+            self.local_expire = local_expire
+        local_request = Storage(application='%s/tiered'
+                                 % request.application)
+        self.local = CacheInRam(local_request)
+        if self.local.storage.max_entries is None:
+            self.local.storage.max_entries = self.local_max_entries
+
+    def _read(self, key):
+        item = self.local._read(key)
+        if item and item[0] > time.time() - self.local_expire:
+            return item[1]
+        item = self.shared._read(key)
+        if item:
+            self.local._write(key, item[:2], self.local_expire)
+        return item
+
+    def _write(
+        self,
+        key,
+        value,
+        time_expire,
+        tags=None,
+        ):
+        self.shared._write(key, value, time_expire, tags)
+        self.local._write(key, (time.time(), value), self.local_expire,
+                          tags)
+
+    def _remove(self, key):
+        self.shared._remove(key)
+        self.local._remove(key)
+
+    def _lock(self, key, blocking=True):
+        return self.shared._lock(key, blocking)
+
+    def _unlock(self, key):
+        self.shared._unlock(key)
+
+    def invalidate_tags(self, *tags):
+        self.shared.invalidate_tags(*tags)
+        self.local.invalidate_tags(*tags)
+
+    def _usage(self):
+        return self.local._usage()
+
+    def clear(self, regex=None):
+        self.shared.clear(regex)
+        self.local.clear(regex)
+
+    def increment(self, key, value=1):
+        value = self.shared.increment(key, value)
+        self.local._remove(key)
         return value
 
 
 class Cache(object):
 
+    """
+    the cache object of the environment. cache.ram, cache.disk and
+    cache.tiered are created on first use since most requests do not
+    use them.
+    """
+
     def __init__(self, request):
-        self.ram = CacheInRam(request)
-        try:
-            self.disk = CacheOnDisk(request)
-        except IOError:
-            logging.warning('no cache.disk')
+        self.request = request
+
+    def __getattr__(self, key):
+        if key == 'ram':
+            self.ram = CacheInRam(self.request)
+            return self.ram
+        elif key == 'disk':
+            self.disk = CacheOnDisk(self.request)
+            return self.disk
+        elif key == 'tiered':
+            self.tiered = CacheTiered(self.request, self.disk)
+            return self.tiered
+        raise AttributeError, key
 
     def __call__(
         self,
         key=None,
         time_expire=300,
         cache_model=None,
+        tags=None,
         ):
         if not cache_model:
             cache_model = self.ram
 
         def tmp(func):
+            if tags:
+                return lambda : cache_model(key, func, time_expire,
+                        tags=tags)
             return lambda : cache_model(key, func, time_expire)
 
         return tmp
 
+    def fragment(
+        self,
+        response,
+        key,
+        time_expire=300,
+        cache_model=None,
+        tags=None,
+        ):
+        """
+        used by the blocks of the views
+
+            {{cache(key, time_expire, cache_model):}}...{{pass}}
+
+        to write the output of the block cached under key, or else to run
+        the block once (yields) and cache what it writes
+        """
+
+        if not cache_model:
+            cache_model = self.ram
+        item = cache_model._read(key)
+        if item and item[0] > time.time() - time_expire:
+            cache_model._count('hits')
+            response.write(item[1], escape=False)
+            return
+        cache_model._count('misses')
+        (body, response.body) = (response.body, cStringIO.StringIO())
+        try:
+            yield None
+            value = response.body.getvalue()
+        finally:
+            response.body = body
+        cache_model._write(key, value, time_expire, tags)
+        response.write(value, escape=False)
+
+    def memoize(
+        self,
+        time_expire=300,
+        cache_model=None,
+        tags=None,
+        request_args=False,
+        key=None,
+        ):
+        """
+        decorator caching the result of a function for each of its
+        arguments:
+
+            @cache.memoize(3600, cache.disk)
+            def fib(n): ...
+
+        the key is the module and name of the function followed by a hash
+        of the repr of the arguments; with request_args=True it is a hash
+        of request.args and request.vars instead, for actions.
+        fib.invalidate(10) removes the value cached for fib(10) (for
+        actions the arguments are the request.args and request.vars).
+
+        the arguments must have a repr that does not change between
+        processes: objects with the default repr (which contains their
+        address) are rejected with a SyntaxError. for those pass
+        key=lambda *a, **b: ... returning a string which identifies the
+        arguments; it is called with the arguments of the function (with
+        request.args and request.vars for actions).
+        """
+
+        if not cache_model:
+            cache_model = self.ram
+        request = self.request
+        make_key = key
+
+        def tmp(func):
+            name = function_name(func)
+
+            def key(args, vars):
+                if make_key:
+                    return '%s:%s' % (name, make_key(*args, **vars))
+                text = repr((tuple(args), sorted(vars.items())))
+                if regex_default_repr.search(text):
+                    raise SyntaxError, \
+                        'arguments of %s have no stable repr, use key=' \
+                        % name
+                return '%s:%s' % (name, md5_hash(text))
+
+            def memoized(*a, **b):
+                if request_args:
+                    k = key(request.args, request.vars)
+                else:
+                    k = key(a, b)
+                if tags:
+                    return cache_model(k, lambda : func(*a, **b),
+                            time_expire, tags=tags)
+                return cache_model(k, lambda : func(*a, **b),
+                                   time_expire)
+
+            memoized.invalidate = lambda *a, **b: cache_model(key(a,
+                    b), None)
+            memoized.__name__ = func.__name__
+            memoized.__doc__ = func.__doc__
+            return memoized
+
+        return tmp
+
+    def _models(self):
+        models = [('ram', self.ram), ('disk', self.disk)]
+        for (name, model) in sorted(self.__dict__.items()):
+            if isinstance(model, CacheAbstract) and not model in [m
+                    for (n, m) in models]:
+                models.append((name, model))
+        return models
+
+    def invalidate_tags(self, *tags):
+        """
+        removes the entries with any of tags from cache.ram, cache.disk
+        and the other models set as attributes of cache
+        """
+
+        for (name, model) in self._models():
+            model.invalidate_tags(*tags)
+
+    def stats(self):
+        """
+        the stats() of cache.ram, cache.disk and the other models set as
+        attributes of cache, by name
+        """
+
+        return dict([(name, model.stats()) for (name, model) in
+                    self._models()])
+
+
+# ## the actions calling response.cache_page, by (application, controller,
+# ## function), so that their pages are served before running the models
+
+page_rules = {}
+
+
+def page_key(request, rule):
+    """
+    the key of the page requested: the path, the query string (or only the
+    vars of the rule) and the request headers the page varies on
+    """
+
+    vars = request.get_vars
+    if rule.vars is not None:
+        vars = dict([(name, vars[name]) for name in rule.vars
+                    if name in vars])
+    values = [sorted(vars.items())]
+    for header in rule.vary:
+        values.append(request.env.get('http_' + header.lower().replace('-',
+                      '_'), None))
+    if rule.session:
+        values.append(request.cookies.get(rule.session, None)
+                      and request.cookies[rule.session].value)
+    path = '/'.join([request.application, request.controller,
+                    request.function] + request.args)
+    return 'page/%s:%s' % (path, md5_hash(repr(values)))
+
+
+def serve_page(request):
+    """
+    returns the HTTP response cached for the page requested if any, called
+    by gluon.main.wsgibase before running the models
+    """
+
+    if not request.env.request_method in ('GET', 'HEAD'):
+        return
+    rule = page_rules.get((request.application, request.controller,
+                          request.function), None)
+    if not rule:
+        return
+    key = page_key(request, rule)
+    item = rule.cache_model._read(key)
+    if not item or item[0] <= time.time() - rule.time_expire:
+        rule.cache_model._count('misses')
+        return
+    rule.cache_model._count('hits')
+    (status, body, headers) = item[1]
+    return HTTP(status, body, **headers)
+
+
+def store_page(request, response, http_response):
+    """
+    caches the page of an action that called response.cache_page, unless
+    it is not a 200 with a string body or shows a flash, it sets cookies
+    or it changed the session; pages not cached per session are also not
+    cached if the action used a non empty session, since they may show it.
+    called by gluon.main.wsgibase with the HTTP response of the action.
+    """
 
+    name = (request.application, request.controller, request.function)
+    rule = response._cache_page
+    if not rule:
+        if name in page_rules:
+            del page_rules[name]  # ## the action no longer calls cache_page
+        return
+    if not rule.cache_model:
+        rule.cache_model = CacheInRam(request)
+    if rule.session:
+        rule.session = response.session_id_name
+    page_rules[name] = rule
+    if http_response.args[0] != 200 or not request.env.request_method \
+        in ('GET', 'HEAD') or not isinstance(http_response.body, str) \
+        or dict.get(response, 'flash', None):
+        return
+    for cookie in response.cookies or {}:
+        if cookie != response.session_id_name:
+            return
+    session = response._session
+    if session is not None and not session._loader:
+        if dict.__len__(session) and not rule.session or \
+            md5_hash(session._dumps()) != response.session_hash:
+            return
+    headers = dict([(key, value) for (key, value) in
+                   http_response.headers.items() if key != 'Set-Cookie'])
+    rule.cache_model._write(page_key(request, rule), (200,
+                            http_response.body, headers),
+                            rule.time_expire, rule.tags)
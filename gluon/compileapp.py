@@ -10,17 +10,16 @@ License: GPL v2
 import sys
 sys.path.append('../gluon')
 import os
-import stat
 import thread
-import copy
 from template import parse_template
 from restricted import restricted
-from fileutils import listdir
+from fileutils import listdir, file_version
 from myregex import regex_expose
 from languages import translator
 from sql import SQLDB, SQLField
 from sqlhtml import SQLFORM, SQLTABLE
 from cache import Cache
+from storage import Storage
 import html
 import validators
 from http import HTTP, redirect
@@ -72,15 +71,109 @@ _TEST()
 
 cfs = {}  # for speed-up
 cfs_lock = thread.allocate_lock()  # and thread safety
+cfs_stats = {'hits': 0, 'misses': 0}
+cfv = {}  # for views, stored with the files they depend on
 
+frozen = False  # if True all applications are frozen (web2py.py -Z)
+manifests = {}  # application folder -> manifest, see app_manifest()
 
-def getcfs(key, filename, filter=None):
-    t = os.stat(filename)[stat.ST_MTIME]
+
+def app_manifest(folder):
+    """
+    returns the manifest of the application in folder if the application
+    is frozen, None otherwise. an application is frozen if web2py runs
+    with -Z or if its folder contains a file called FROZEN.
+
+    the manifest is a Storage(compiled, models, files) built by scanning
+    the application folder once: compiled tells whether compiled/ exists,
+    models is the list of model files to run and files is the set of the
+    controllers, views and compiled files. frozen applications use it
+    instead of checking the filesystem at every request, and getcfs()
+    does not check mtimes for them. call unfreeze() to rescan.
+    """
+
+    if folder in manifests:
+        return manifests[folder]
+    if not os.path.isdir(folder):
+        return None
+    if not frozen and not os.path.exists(os.path.join(folder, 'FROZEN'
+            )):
+        manifest = None
+    else:
+        compiled = os.path.join(folder, 'compiled/')
+        if os.path.exists(compiled):
+            models = listdir(compiled, '^models_.+\.pyc$', 0)
+        else:
+            models = listdir(os.path.join(folder, 'models/'),
+                             '^\w+\.py$', 0)
+        files = set()
+        for path in ['controllers/', 'views/', 'compiled/']:
+            path = os.path.join(folder, path)
+            if os.path.exists(path):
+                files.update(listdir(path, '^.+$', 0))
+        manifest = Storage(compiled=os.path.exists(compiled),
+                           models=models, files=files)
+        logging.info('application %s is frozen' % folder)
     cfs_lock.acquire()
-    item = cfs.get(key, None)
+    manifests[folder] = manifest
+    cfs_lock.release()
+    return manifest
+
+
+def file_exists(filename, manifest=None):
+    """
+    like os.path.exists() but looks filename up in the manifest (if any)
+    of a frozen application
+    """
+
+    if manifest:
+        return filename in manifest.files
+    return os.path.exists(filename)
+
+
+def unfreeze():
+    """
+    forgets all the application manifests and cached code so that frozen
+    applications are scanned again and their new code is loaded.
+    web2py.py calls it on SIGHUP.
+    """
+
+    cfs_lock.acquire()
+    manifests.clear()
+    cfs.clear()
+    cfv.clear()
     cfs_lock.release()
+
+
+def getcfs(
+    key,
+    filename,
+    filter=None,
+    frozen=False,
+    ):
+    """
+    caches the content of filename (or the value returned by filter())
+    under key until the version (mtime and size) of filename changes.
+    this is the process-wide cache for models, controllers and views;
+    cfs_stats counts hits and misses. if frozen the file is not checked.
+    """
+
+    if frozen:
+        item = cfs.get(key, None)
+        if item:
+            cfs_lock.acquire()
+            cfs_stats['hits'] += 1
+            cfs_lock.release()
+            return item[1]
+    t = file_version(filename)
+    cfs_lock.acquire()
+    item = cfs.get(key, None)
     if item and item[0] == t:
+        cfs_stats['hits'] += 1
+        cfs_lock.release()
         return item[1]
+    cfs_stats['misses'] += 1
+    cfs_lock.release()
     if not filter:
         data = open(filename, 'r').read()
     else:
@@ -91,9 +184,68 @@ def getcfs(key, filename, filter=None):
     return data
 
 
-def build_environment(request, response, session):
+def getcfv(key, filter, frozen=False):
     """
-    Build and return evnironment dictionary for controller and view.
+    like getcfs() but for views. filter(dependencies) must return the value
+    to be cached and append to dependencies a (filename, version) tuple
+    for every file it reads (see template.parse_template and
+    fileutils.file_version). the value is kept until the version of any of
+    those files changes, or forever if frozen. it is not kept if any
+    version is None (the view depends on more than the files).
+    """
+
+    cfs_lock.acquire()
+    item = cfv.get(key, None)
+    cfs_lock.release()
+    if item:
+        try:
+            for (filename, t) in item[0]:
+                if frozen:
+                    continue
+                if file_version(filename) != t:
+                    break
+            else:
+                cfs_lock.acquire()
+                cfs_stats['hits'] += 1
+                cfs_lock.release()
+                return item[1]
+        except OSError:
+            pass
+    cfs_lock.acquire()
+    cfs_stats['misses'] += 1
+    cfs_lock.release()
+    dependencies = []
+    data = filter(dependencies)
+    cfs_lock.acquire()
+    if [t for (filename, t) in dependencies if t is None]:
+        if key in cfv:
+            del cfv[key]
+    else:
+        cfv[key] = (dependencies, data)
+    cfs_lock.release()
+    return data
+
+
+def compile2(code, layer):
+    """
+    compiles code for restricted(), returns (ccode, code): the code object,
+    or code itself if it does not compile so that restricted() reports the
+    error (and generates a ticket) every time it is run, and the source
+    compiled, cached with it for the tickets of the errors it raises.
+    """
+
+    try:
+        return (compile(code.replace('\r\n', '\n'), layer, 'exec'),
+                code)
+    except Exception:
+        return (code, code)
+
+
+def make_base_environment():
+    """
+    returns the part of the environment for controllers and views that is
+    the same for every request: the html helpers, the validators and the
+    DAL. it is built once, build_environment() copies it.
     """
 
     environment = {}
@@ -101,19 +253,31 @@ def build_environment(request, response, session):
         environment[key] = getattr(html, key)
     for key in validators.__all__:
         environment[key] = getattr(validators, key)
-    environment['T'] = translator(request)
     environment['HTTP'] = HTTP
     environment['redirect'] = redirect
+    environment['SQLDB'] = SQLDB
+    environment['SQLField'] = SQLField
+    environment['SQLFORM'] = SQLFORM
+    environment['SQLTABLE'] = SQLTABLE
+    return environment
+
+
+base_environment = make_base_environment()
+
+
+def build_environment(request, response, session):
+    """
+    Build and return evnironment dictionary for controller and view.
+    """
+
+    environment = base_environment.copy()
+    environment['T'] = translator(request)
     environment['request'] = request
     environment['response'] = response
     environment['session'] = session
     environment['cache'] = Cache(request)
-    environment['SQLDB'] = SQLDB
     SQLDB._set_thread_folder(os.path.join(request.folder, 'databases'))
-    environment['SQLField'] = SQLField
-    environment['SQLFORM'] = SQLFORM
-    environment['SQLTABLE'] = SQLTABLE
-    response._view_environment = copy.copy(environment)
+    response._view_environment = environment.copy()
     return environment
 
 
@@ -197,23 +361,26 @@ def run_models_in(environment):
     """
 
     folder = environment['request'].folder
+    manifest = app_manifest(folder)
     path = os.path.join(folder, 'compiled/')
-    if os.path.exists(path):
-        for model in listdir(path, '^models_.+\.pyc$', 0):
-            restricted(read_pyc(model), environment, layer=model)
+    if manifest:
+        (compiled, models) = (manifest.compiled, manifest.models)
+    elif os.path.exists(path):
+        (compiled, models) = (True, listdir(path, '^models_.+\.pyc$',
+                              0))
     else:
-        models = listdir(os.path.join(folder, 'models/'), '^\w+\.py$',
-                         0)
-        for model in models:
-            layer = model
-            if is_gae:
-                code = getcfs(model, model, lambda : \
-                              compile(open(model, 'r'
-                              ).read().replace('\r\n', '\n'), layer,
-                              'exec'))
-            else:
-                code = getcfs(model, model, None)
-            restricted(code, environment, layer)
+        (compiled, models) = (False, listdir(os.path.join(folder,
+                              'models/'), '^\w+\.py$', 0))
+    for model in models:
+        layer = model
+        if compiled:
+            (code, source) = (getcfs(model, model, lambda : \
+                              read_pyc(model), manifest), None)
+        else:
+            (code, source) = getcfs(model, model, lambda : \
+                                    compile2(open(model, 'r').read(),
+                                    layer), manifest)
+        restricted(code, environment, layer, source)
 
 
 def run_controller_in(controller, function, environment):
@@ -226,18 +393,22 @@ def run_controller_in(controller, function, environment):
     # if compiled should run compiled!
 
     folder = environment['request'].folder
+    manifest = app_manifest(folder)
     path = os.path.join(folder, 'compiled/')
-    if os.path.exists(path):
+    if manifest and manifest.compiled or not manifest\
+         and os.path.exists(path):
         filename = os.path.join(path, 'controllers_%s_%s.pyc'
                                  % (controller, function))
-        if not os.path.exists(filename):
+        if not file_exists(filename, manifest):
             raise HTTP(400, error_message_custom % 'invalid function',
                        web2py_error='invalid function')
-        restricted(read_pyc(filename), environment, layer=filename)
+        code = getcfs(filename, filename, lambda : read_pyc(filename),
+                      manifest)
+        restricted(code, environment, layer=filename)
     elif function == '_TEST':
         filename = os.path.join(folder, 'controllers/%s.py'
                                  % controller)
-        if not os.path.exists(filename):
+        if not file_exists(filename, manifest):
             raise HTTP(400, error_message_custom % 'invalid controller'
                        , web2py_error='invalid controller')
         environment['__symbols__'] = environment.keys()
@@ -247,25 +418,25 @@ def run_controller_in(controller, function, environment):
     else:
         filename = os.path.join(folder, 'controllers/%s.py'
                                  % controller)
-        if not os.path.exists(filename):
+        if not file_exists(filename, manifest):
             raise HTTP(400, error_message_custom % 'invalid controller'
                        , web2py_error='invalid controller')
-        code = open(filename, 'r').read()
-        exposed = regex_expose.findall(code)
-        if not function in exposed:
-            raise HTTP(400, error_message_custom % 'invalid function',
-                       web2py_error='invalid function')
-        code = '''%s
-
-response._vars=response._caller(%s)
-''' % (code,
-                function)
-        if is_gae:
-            layer = filename + ':' + function
-            code = getcfs(layer, filename, lambda : \
-                          compile(code.replace('\r\n', '\n'), layer,
-                          'exec'))
-        restricted(code, environment, filename)
+        layer = filename + ':' + function
+
+        def compile_controller():
+            code = open(filename, 'r').read()
+            exposed = regex_expose.findall(code)
+            if not function in exposed:
+                raise HTTP(400, error_message_custom
+                            % 'invalid function',
+                           web2py_error='invalid function')
+            code = '%s\n\nresponse._vars=response._caller(%s)\n'\
+                 % (code, function)
+            return compile2(code, filename)
+
+        (code, source) = getcfs(layer, filename, compile_controller,
+                                manifest)
+        restricted(code, environment, filename, source)
     response = environment['response']
     if response.postprocessing:
         for p in response.postprocessing:
@@ -286,37 +457,37 @@ def run_view_in(environment):
 
     folder = environment['request'].folder
     response = environment['response']
+    manifest = app_manifest(folder)
     path = os.path.join(folder, 'compiled/')
-    if os.path.exists(path):
+    if manifest and manifest.compiled or not manifest\
+         and os.path.exists(path):
         filename = os.path.join(path, 'views_%s.pyc'
                                  % response.view[:-5].replace('/', '_'))
-        if not os.path.exists(filename):
+        if not file_exists(filename, manifest):
             filename = os.path.join(folder, 'compiled/',
                                     'views_generic.pyc')
-        if not os.path.exists(filename):
+        if not file_exists(filename, manifest):
             raise HTTP(400, error_message_custom % 'invalid view',
                        web2py_error='invalid view')
-        code = read_pyc(filename)
+        code = getcfs(filename, filename, lambda : read_pyc(filename),
+                      manifest)
         restricted(code, environment, layer=filename)
     else:
         filename = os.path.join(folder, 'views/', response.view)
-        if not os.path.exists(filename):
+        if not file_exists(filename, manifest):
             response.view = 'generic.html'
         filename = os.path.join(folder, 'views/', response.view)
-        if not os.path.exists(filename):
+        if not file_exists(filename, manifest):
             raise HTTP(400, error_message_custom % 'invalid view',
                        web2py_error='invalid view')
         layer = filename
-        if is_gae:
-            ccode = getcfs(layer, filename, lambda : \
-                           compile(parse_template(response.view,
-                           os.path.join(folder, 'views/'),
-                           context=environment).replace('\r\n', '\n'),
-                           layer, 'exec'))
-        else:
-            ccode = parse_template(response.view, os.path.join(folder,
-                                   'views/'), context=environment)
-        restricted(ccode, environment, layer)
+        (ccode, source) = getcfv(layer, lambda dependencies: \
+                                 compile2(parse_template(response.view,
+                                 os.path.join(folder, 'views/'),
+                                 context=environment,
+                                 dependencies=dependencies), layer),
+                                 manifest)
+        restricted(ccode, environment, layer, source)
 
 
 def remove_compiled_application(folder):
@@ -13,6 +13,7 @@ import re
 import tarfile
 import sys
 from http import HTTP
+from utils import md5_hash
 
 __all__ = [
     'listdir',
@@ -22,8 +23,18 @@ __all__ = [
     'tar_compiled',
     'get_session',
     'check_credentials',
+    'sharded',
+    'locate',
+    'make_dirs',
+    'reshard',
     ]
 
+# ## levels of hashed subfolders used for files in sessions/ and uploads/,
+# ## 2 gives sessions/ab/cd/<id>. 0 is the flat layout. after changing it
+# ## move the existing files with scripts/reshard.py
+
+shard_levels = 0
+
 
 def listdir(
     path,
@@ -176,6 +187,85 @@ def up(path):
     return os.path.dirname(os.path.normpath(path))
 
 
+def file_version(filename):
+    """
+    the modification time (with the resolution of the filesystem, not
+    just seconds) and the size of filename: it changes when the file is
+    saved again, also within the same second
+    """
+
+    s = os.stat(filename)
+    return (s.st_mtime, s.st_size)
+
+
+def sharded(folder, name, levels=None):
+    """
+    the path of the file name in folder, according to shard_levels
+    """
+
+    if levels is None:
+        levels = shard_levels
+    if not levels:
+        return os.path.join(folder, name)
+    key = md5_hash(name)
+    parts = [key[2 * i:2 * i + 2] for i in range(levels)]
+    return os.path.join(folder, *parts + [name])
+
+
+def locate(folder, name):
+    """
+    the path of an existing file name in folder, also if it was stored
+    before shard_levels changed and has not been moved yet
+    """
+
+    path = sharded(folder, name)
+    if shard_levels and not os.path.exists(path):
+        flat = os.path.join(folder, name)
+        if os.path.exists(flat):
+            return flat
+    return path
+
+
+def make_dirs(path):
+    """
+    creates the folders that contain the file path
+    """
+
+    folder = os.path.dirname(path)
+    if not os.path.exists(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:
+            pass  # ## created by another thread
+
+
+def reshard(folder, levels=None):
+    """
+    moves the files in folder to the layout of levels (default
+    shard_levels) and removes the subfolders left empty. hidden
+    subfolders are left alone.
+    returns the number of files moved.
+    """
+
+    moved = 0
+    for (root, dirs, files) in os.walk(folder, topdown=False):
+        if [item for item in root[len(folder):].split(os.sep)
+                if item.startswith('.')]:
+            continue  # ## e.g. sessions/.expiry
+        for name in files:
+            if name.startswith('.'):
+                continue
+            path = os.path.join(root, name)
+            new_path = sharded(folder, name, levels)
+            if path != new_path:
+                make_dirs(new_path)
+                os.rename(path, new_path)
+                moved += 1
+        if root != folder and not os.listdir(root):
+            os.rmdir(root)
+    return moved
+
+
 def get_session(request, other_application='admin'):
     """ checks that user is authorized to access other_application"""
 
@@ -185,8 +275,8 @@ def get_session(request, other_application='admin'):
         session_id = request.cookies['session_id_'
                  + other_application].value
         osession = \
-            storage.load_storage(os.path.join(up(request.folder),
-                                 other_application, 'sessions',
+            storage.load_storage(locate(os.path.join(up(request.folder),
+                                 other_application, 'sessions'),
                                  session_id))
     except:
         osession = storage.Storage()
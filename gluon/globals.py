@@ -15,12 +15,19 @@ from contenttype import contenttype
 from html import xmlescape
 from http import HTTP
 from sql import SQLField
-from fileutils import up
+from fileutils import up, copystream, sharded, locate, make_dirs
+from utils import md5_hash, hmac_hash, compare
 import portalocker
 import sys
+import cgi
+import Cookie
+import tempfile
 import cPickle
 import cStringIO
+import base64
+import zlib
 import thread
+import threading
 import time
 import shelve
 import os
@@ -32,26 +39,243 @@ import logging
 
 regex_session_id = re.compile('^[\w\-]+$')
 
-__all__ = ['Request', 'Response', 'Session']
+# request bodies up to this size are kept in memory, not in a temp file
+
+MAX_BODY_IN_RAM = 10 ** 5
+
+# unchanged sessions are not written back but they are touched when
+# last stored more than this many seconds ago so they do not look expired
+
+SESSION_TOUCH_INTERVAL = 300
+
+# larger sessions are not kept in a signed cookie but on the server
+
+COOKIE_SESSION_MAX_SIZE = 3800
+
+# signed cookies are rejected when signed more than this many seconds ago
+# (see Session.connect(cookie_expiration=...))
+
+COOKIE_SESSION_EXPIRATION = 3600
+
+# the only classes a session in a cookie can contain, so that even with
+# the key a cookie cannot make the unpickler call anything else
+
+COOKIE_SESSION_GLOBALS = set([
+    ('copy_reg', '_reconstructor'),
+    ('__builtin__', 'object'),
+    ('__builtin__', 'dict'),
+    ('__builtin__', 'list'),
+    ('__builtin__', 'set'),
+    ('__builtin__', 'frozenset'),
+    ('datetime', 'date'),
+    ('datetime', 'datetime'),
+    ('datetime', 'time'),
+    ('datetime', 'timedelta'),
+    ('decimal', 'Decimal'),
+    ('storage', 'Storage'),
+    ('gluon.storage', 'Storage'),
+    ('languages', 'lazyT'),
+    ('gluon.languages', 'lazyT'),
+    ])
+
+# file sessions are listed in sessions/.expiry/<bucket>/ when stored, by
+# buckets of this many seconds, so sweep_sessions does not scan them all
+
+SESSION_EXPIRY_BUCKET = 600
+
+__all__ = [
+    'Request',
+    'Response',
+    'Session',
+    'Environ',
+    'DBSessionStore',
+    'MemcacheSessionStore',
+    'sweep_sessions',
+    'SessionSweeper',
+    ]
+
+
+class Environ(Storage):
+
+    """
+    request.env, the wsgi environ with keys lowercased and '.' replaced
+    by '_'. keys are translated when they are used, the whole environ
+    only if a key is missing or if the keys are listed.
+    """
+
+    def __init__(self, environ={}):
+        self.__dict__['_environ'] = environ
+        self.__dict__['_loaded'] = not environ
+
+    def _load(self):
+        if not self._loaded:
+            for (key, value) in self._environ.items():
+                key = key.lower().replace('.', '_')
+                if not dict.has_key(self, key):
+                    dict.__setitem__(self, key, value)
+            self.__dict__['_loaded'] = True
+
+    def __missing__(self, key):
+        if not self._loaded:
+            for name in (key.upper(), key, key.replace('_', '.', 1)):
+                if name in self._environ:
+                    value = self[key] = self._environ[name]
+                    return value
+            self._load()
+            if dict.has_key(self, key):
+                return dict.__getitem__(self, key)
+        raise KeyError, key
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def has_key(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    __contains__ = has_key
+
+    def keys(self):
+        self._load()
+        return dict.keys(self)
+
+    def values(self):
+        self._load()
+        return dict.values(self)
+
+    def items(self):
+        self._load()
+        return dict.items(self)
+
+    def __iter__(self):
+        self._load()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        self._load()
+        return dict.__len__(self)
+
+    def __repr__(self):
+        self._load()
+        return Storage.__repr__(self)
+
+    def __getstate__(self):
+        self._load()
+        return dict(self)
+
+    def copy(self):
+        return Storage(self.__getstate__())
 
 
 class Request(Storage):
 
     """
-    defines the request object and the default values of its members
+    defines the request object and the default values of its members.
+    vars, get_vars, post_vars, cookies and body are parsed from
+    request.env the first time they are used.
     """
 
     def __init__(self):
-        self.env = Storage()
-        self.cookies = Storage()
-        self.get_vars = Storage()
-        self.post_vars = Storage()
-        self.vars = Storage()
+        self.env = Environ()
         self.application = None
         self.function = None
         self.args = []
         self.now = datetime.datetime.today()
 
+    def __missing__(self, key):
+        if key in ('vars', 'get_vars', 'post_vars'):
+            self._parse_vars()
+        elif key == 'cookies':
+            self.cookies = Cookie.SimpleCookie()
+            if self.env.http_cookie:
+                self.cookies.load(self.env.http_cookie)
+        elif key == 'body':
+            self._parse_body()
+        else:
+            raise KeyError, key
+        return dict.__getitem__(self, key)
+
+    def _parse_body(self):
+        """
+        copies the request body from wsgi_input into request.body,
+        a StringIO if small or a temporary file if large
+        """
+
+        length = int(self.env.content_length or 0)
+        if length > MAX_BODY_IN_RAM:
+            self.body = tempfile.TemporaryFile()
+        else:
+            self.body = cStringIO.StringIO()
+        if length:
+            copystream(self.env.wsgi_input, self.body, length)
+
+    def _parse_vars(self):
+        (self.vars, self.get_vars, self.post_vars) = (Storage(),
+                Storage(), Storage())
+
+        # ## parse GET vars, even if POST
+
+        dget = cgi.parse_qsl(self.env.query_string or '',
+                             keep_blank_values=1)
+        for (key, value) in dget:
+            if self.vars.has_key(key):
+                if isinstance(self.vars[key], list):
+                    self.vars[key].append(value)
+                else:
+                    self.vars[key] = [self.vars[key], value]
+            else:
+                self.vars[key] = value
+            self.get_vars[key] = self.vars[key]
+
+        # ## parse POST vars if any
+
+        if self.env.request_method in ['POST', 'BOTH']:
+            environ = {}
+            for key in ['request_method', 'content_type',
+                        'content_length', 'query_string']:
+                value = self.env.get(key)
+                if value != None:
+                    environ[key.upper()] = value
+            self.body.seek(0)  # ## the controller may have read it
+            dpost = cgi.FieldStorage(fp=self.body, environ=environ,
+                                     keep_blank_values=1)
+            self.body.seek(0)
+            try:
+                keys = dpost.keys()
+            except TypeError:
+                keys = []
+            for key in keys:
+                dpk = dpost[key]
+                if isinstance(dpk, list):
+                    value = [x.value for x in dpk]
+                elif not dpk.filename:
+                    value = dpk.value
+                else:
+                    value = dpk
+                self.post_vars[key] = self.vars[key] = value
+
+    def _parse_all(self):
+        for key in ('vars', 'cookies', 'body'):
+            self[key]
+
+    def keys(self):
+        self._parse_all()
+        return dict.keys(self)
+
+    def items(self):
+        self._parse_all()
+        return dict.items(self)
+
+    def __iter__(self):
+        self._parse_all()
+        return dict.__iter__(self)
+
 
 class Response(Storage):
 
@@ -65,17 +289,32 @@ class Response(Storage):
         self.headers = Storage()
         self.body = cStringIO.StringIO()
         self.session_id = None
-        self.cookies = Storage()
+        self.cookies = Cookie.SimpleCookie()
         self.postprocessing = []
         self.keywords = ''  # used by the default view layout
         self.description = ''  # used by the default view layout
-        self.flash = None  # used by the default view layout
         self.menu = None  # used by the default view layout
         self._vars = None
         self._caller = lambda f: f()
         self._view_environment = None
         self._custom_commit = None
         self._custom_rollback = None
+        self._session = None
+        self._cache_page = None
+
+    def __missing__(self, key):
+
+        # ## response.flash (used by the default view layout) is None
+        # ## unless the session has a flash, the session is loaded
+        # ## (if lazy) only when the flash is needed
+
+        if key != 'flash':
+            raise KeyError, key
+        if self._session:
+            self._session._load()
+        if not dict.has_key(self, 'flash'):
+            self.flash = None
+        return dict.__getitem__(self, 'flash')
 
     def write(self, data, escape=True):
         if not escape:
@@ -108,6 +347,38 @@ class Response(Storage):
             page = self.body.getvalue()
         return page
 
+    def cache_page(
+        self,
+        time_expire=300,
+        cache_model=None,
+        vars=None,
+        vary=None,
+        session=False,
+        tags=None,
+        ):
+        """
+        caches the whole page of the current action (status 200 only) so
+        that the following requests for it are served without running the
+        models and the controller. pages are cached by path and query
+        string, or only by the vars listed; vary lists request headers
+        (e.g. ['Accept-Language']) the page also depends on, and
+        session=True caches a page per session. defaults to cache.ram.
+        pages setting cookies or changing the session are never cached,
+        and without session=True neither are pages using a non empty
+        session. the cache_model is used by later requests before their
+        models run, so it cannot be request_scoped (like CacheInDb).
+        """
+
+        if getattr(cache_model, 'request_scoped', False):
+            raise SyntaxError, \
+                'cache_page cannot use a request scoped cache model'
+        vary = vary or []
+        if vary:
+            self.headers['Vary'] = ', '.join(vary)
+        self._cache_page = Storage(time_expire=time_expire,
+                                   cache_model=cache_model, vars=vars,
+                                   vary=vary, session=session, tags=tags)
+
     def stream(
         self,
         stream,
@@ -173,8 +444,8 @@ class Response(Storage):
 
               # ## if file is on filesystem
 
-            return self.stream(os.path.join(request.folder, 'uploads',
-                               name))
+            return self.stream(locate(os.path.join(request.folder,
+                               'uploads'), name))
 
     def json(self, data):
         import gluon.contrib.simplejson as sj
@@ -201,8 +472,97 @@ class Session(Storage):
 
     """
     defines the session object and the default values of its members (None)
+
+    a session stored on disk is loaded, and its file locked, the first
+    time the session is used; it is written back only if it changed.
+    requests that never use the session never touch its file.
+    the state of the session object itself (_loader, _secure, _forget)
+    is kept in its __dict__, every key is session data.
     """
 
+    def __init__(self):
+        self.__dict__.update(_loader=None, _secure=False, _forget=False)
+
+    def _dumps(self):
+        """
+        the pickled session data. every hash of the session is computed
+        from it, since cPickle writes different bytes for the same data
+        depending on the references to it
+        """
+
+        return cPickle.dumps(dict(self))
+
+    def _load(self):
+        loader = self.__dict__.get('_loader', None)
+        if loader:
+            self.__dict__['_loader'] = None
+            loader()
+
+    def __missing__(self, key):
+        if self.__dict__.get('_loader', None):
+            self._load()
+            if dict.has_key(self, key):
+                return dict.__getitem__(self, key)
+        raise KeyError, key
+
+    def __setitem__(self, key, value):
+        self._load()
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self._load()
+        dict.__delitem__(self, key)
+
+    def get(self, key, default=None):
+        self._load()
+        return dict.get(self, key, default)
+
+    def has_key(self, key):
+        self._load()
+        return dict.has_key(self, key)
+
+    __contains__ = has_key
+
+    def keys(self):
+        self._load()
+        return dict.keys(self)
+
+    def values(self):
+        self._load()
+        return dict.values(self)
+
+    def items(self):
+        self._load()
+        return dict.items(self)
+
+    def __iter__(self):
+        self._load()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        self._load()
+        return dict.__len__(self)
+
+    def update(self, *a, **b):
+        self._load()
+        dict.update(self, *a, **b)
+
+    def pop(self, *a):
+        self._load()
+        return dict.pop(self, *a)
+
+    def clear(self):
+        self._load()
+        dict.clear(self)
+
+    def __repr__(self):
+        self._load()
+        return Storage.__repr__(self)
+
+    def __getstate__(self):
+        self._load()
+        return dict(self)
+
     def connect(
         self,
         request,
@@ -211,125 +571,544 @@ class Session(Storage):
         tablename='web2py_session',
         masterapp=None,
         migrate=True,
+        store=None,
+        cookie_key=None,
+        compression_level=None,
+        cookie_expiration=COOKIE_SESSION_EXPIRATION,
         ):
+        """
+        sessions are stored in files under masterapp/sessions unless a
+        store is given. db=... is a shortcut for
+        store=DBSessionStore(db, tablename)
+
+        a store (see DBSessionStore and MemcacheSessionStore) is created
+        for every request, like db, and has the methods
+        connect(request, masterapp, migrate), called once the cookie name
+        is known, read(session_id), returning the pickled session or None,
+        and write(session_id, data, changed), storing it and returning the
+        session_id for the cookie (a new one if session_id is None); if
+        the session did not change write only has to keep it from expiring.
+
+        with a cookie_key, sessions up to COOKIE_SESSION_MAX_SIZE are kept
+        in the cookie itself, signed with the key and zlib compressed if
+        compression_level is given; larger ones go to the files or store.
+        the signature covers the time of signing, cookies signed more than
+        cookie_expiration seconds ago are ignored, and they can only
+        contain the types in COOKIE_SESSION_GLOBALS.
+        """
+
         self._unlock(response)
+        self.__dict__['_loader'] = None
         if not masterapp:
             masterapp = request.application
         response.session_id_name = 'session_id_%s' % masterapp
-        if not db:
-            if request.cookies.has_key(response.session_id_name):
-                response.session_id = \
-                    request.cookies[response.session_id_name].value
-                if regex_session_id.match(response.session_id):
-                    response.session_filename = \
-                        os.path.join(up(request.folder), masterapp,
-                            'sessions', response.session_id)
-                else:
-                    response.session_id = None
-            if response.session_id:
-                try:
-                    response.session_file = \
-                        open(response.session_filename, 'rb+')
-                    portalocker.lock(response.session_file,
-                            portalocker.LOCK_EX)
-                    self.update(cPickle.load(response.session_file))
-                    response.session_file.seek(0)
-                except:
-                    self._unlock(response)
-                    response.session_id = None
-            if not response.session_id:
-                response.session_id = '%s-%s'\
-                     % (request.client.replace(':', '-').replace('.',
-                        '-'), uuid.uuid4())
+        response.session_cookie_key = cookie_key
+        response.session_compression_level = compression_level
+        response.session_cookie_expiration = cookie_expiration
+        response.session_in_cookie = False
+        cookie = data = None
+        if request.cookies.has_key(response.session_id_name):
+            cookie = request.cookies[response.session_id_name].value
+        if cookie and cookie_key:
+            data = self._decode_cookie(response, cookie)
+            if data is not None:
+                cookie = None
+        if db:
+            store = DBSessionStore(db, tablename)
+        if not store:
+            response.session_folder = os.path.join(up(request.folder),
+                    masterapp, 'sessions')
+            response.session_id = cookie
+            if cookie and regex_session_id.match(cookie):
                 response.session_filename = \
-                    os.path.join(up(request.folder), masterapp,
-                                 'sessions', response.session_id)
-                response.session_new = True
-        else:
-            if masterapp == request.application:
-                table_migrate = migrate
+                    locate(response.session_folder, cookie)
+                self.__dict__['_loader'] = lambda : \
+                    self._load_from_disk(request, response, masterapp)
             else:
-                table_migrate = False
-            tname = tablename + '_' + masterapp
-            table = db.get(tname,None)
-            if table is None:
-                table = db.define_table(
-                    tname,
-                    db.Field('locked', 'boolean', default=False),
-                    db.Field('client_ip', length=64),
-                    db.Field('created_datetime', 'datetime',
-                             default=request.now),
-                    db.Field('modified_datetime', 'datetime'),
-                    db.Field('unique_key', length=64),
-                    db.Field('session_data', 'blob'),
-                    migrate=table_migrate,
-                    )   
+                self._new_session_file(request, response, masterapp)
+        else:
+            store.connect(request, masterapp, masterapp
+                          == request.application and migrate)
+            response._session_store = store
+            response.session_id = cookie
+            self.__dict__['_loader'] = lambda : \
+                self._load_from_store(request, response)
+        response._session = self
+        if data is not None:
+            self.__dict__['_loader'] = None
             try:
-                key = request.cookies[response.session_id_name].value
-                (record_id, unique_key) = key.split(':')
-                if record_id == '0':
-                    raise Exception
-                rows = db(table.id == record_id).select()
-                if len(rows) == 0 or rows[0].unique_key != unique_key:
-                    raise Exception, 'No record'
-
-                 # rows[0].update_record(locked=True)
-
-                session_data = cPickle.loads(rows[0].session_data)
-                self.update(session_data)
-            except Exception, e:
-                (record_id, unique_key, session_data) = (None,
-                        str(uuid.uuid4()), {})
-            finally:
-                response._dbtable_and_field = \
-                    (response.session_id_name, table, record_id,
-                     unique_key)
-                response.session_id = '%s:%s' % (record_id, unique_key)
+                dict.update(self, loads_cookie_session(data))
+            except:
+                logging.warning('unable to read session cookie')
+            response.session_in_cookie = True
+            response.session_hash = md5_hash(self._dumps())
+            self._after_load(response)
+        if (store or cookie_key) and (not cookie or response.session_id
+                 != cookie):
+
+            # ## nothing on the server to point the cookie to yet
+
+            if response.cookies.has_key(response.session_id_name):
+                del response.cookies[response.session_id_name]
+            return
         response.cookies[response.session_id_name] = response.session_id
         response.cookies[response.session_id_name]['path'] = '/'
-        if self.flash:
-            (response.flash, self.flash) = (self.flash, None)
+
+    def _encode_cookie(self, response, data):
+        if response.session_compression_level:
+            data = 'z' + zlib.compress(data,
+                    response.session_compression_level)
+        else:
+            data = 'p' + data
+        signed = '%i.%s' % (time.time(),
+                            base64.urlsafe_b64encode(data).rstrip('='))
+        signature = hmac_hash(response.session_id_name + signed,
+                              response.session_cookie_key)
+        return '%s.%s' % (signed, signature)
+
+    def _decode_cookie(self, response, value):
+        """
+        returns the pickled session in a signed cookie value, or None
+        if value is not one or it was signed too long ago. the time of
+        signing goes in response.session_cookie_time
+        """
+
+        try:
+            (signed, signature) = value.rsplit('.', 1)
+            (t, payload) = signed.split('.')
+            t = int(t)
+        except ValueError:
+            return None
+        if not compare(signature, hmac_hash(response.session_id_name
+                        + signed, response.session_cookie_key)):
+            return None
+        expiration = response.session_cookie_expiration
+        if expiration and t < time.time() - expiration:
+            return None
+        response.session_cookie_time = t
+        data = base64.urlsafe_b64decode(payload + '=' * (-len(payload)
+                 % 4))
+        if data[:1] == 'z':
+            return zlib.decompress(data[1:])
+        return data[1:]
+
+    def _new_session_file(self, request, response, masterapp):
+        response.session_id = '%s-%s'\
+             % (request.client.replace(':', '-').replace('.', '-'),
+                uuid.uuid4())
+        response.session_filename = sharded(response.session_folder,
+                response.session_id)
+        response.session_new = True
+        response.session_hash = md5_hash(self._dumps())
+
+    def _load_from_disk(self, request, response, masterapp):
+        """
+        called the first time the session is used: locks and reads the
+        session file, or starts a new session if there is none
+        """
+
+        try:
+            response.session_file = open(response.session_filename,
+                    'rb+')
+            portalocker.lock(response.session_file, portalocker.LOCK_EX)
+            for (key, value) in \
+                cPickle.load(response.session_file).items():
+                if not dict.has_key(self, key):
+                    dict.__setitem__(self, key, value)
+            response.session_file.seek(0)
+            response.session_hash = md5_hash(self._dumps())
+            response.session_mtime = \
+                os.fstat(response.session_file.fileno())[stat.ST_MTIME]
+        except:
+            self._unlock(response)
+            self._new_session_file(request, response, masterapp)
+            response.cookies[response.session_id_name] = \
+                response.session_id
+            response.cookies[response.session_id_name]['path'] = '/'
+        self._after_load(response)
+
+    def _load_from_store(self, request, response):
+        """
+        called the first time the session is used: reads the session
+        from response._session_store, or starts a new one if there is none
+        """
+
+        data = None
+        if response.session_id:
+            try:
+                data = response._session_store.read(response.session_id)
+                if data:
+                    for (key, value) in cPickle.loads(data).items():
+                        if not dict.has_key(self, key):
+                            dict.__setitem__(self, key, value)
+            except:
+                logging.warning('unable to read session %s'
+                                 % response.session_id)
+                data = None
+        if not data:
+            response.session_id = None
+        response.session_hash = md5_hash(self._dumps())
+        self._after_load(response)
+
+    def _after_load(self, response):
+        if dict.get(self, '_secure', None):
+            self.__dict__['_secure'] = True
+        if dict.get(self, 'flash', None):
+            if not dict.has_key(response, 'flash'):
+                response.flash = self.flash
+            self.flash = None
 
     def secure(self):
-        self._secure = True
+        self['_secure'] = True  # ## kept for the next requests
+        self.__dict__['_secure'] = True
 
     def forget(self, response=None):
         self._unlock(response)
-        self._forget = True
+        self.__dict__['_forget'] = True
 
-    def _try_store_in_db(self, request, response):
-        if not response._dbtable_and_field or not response.session_id\
-             or self._forget:
+    def _try_store_in_cookie(self, request, response):
+        if not response.session_cookie_key or self._forget\
+             or self._loader:
             return
-        (record_id_name, table, record_id, unique_key) = \
-            response._dbtable_and_field
-        dd = dict(locked=False, client_ip=request.env.remote_addr,
-                  modified_datetime=request.now,
-                  session_data=cPickle.dumps(dict(self)),
-                  unique_key=unique_key)
-        if record_id:
-            table._db(table.id == record_id).update(**dd)
+        data = self._dumps()
+        if md5_hash(data) == response.session_hash:
+            interval = SESSION_TOUCH_INTERVAL
+            if response.session_cookie_expiration:
+                interval = min(interval,
+                               response.session_cookie_expiration / 2)
+            if response.session_cookie_time is None or time.time()\
+                 - response.session_cookie_time <= interval:
+                return  # ## else signed again so that it does not expire
+        value = self._encode_cookie(response, data)
+        if len(value) <= COOKIE_SESSION_MAX_SIZE:
+            self._unlock(response)
+            response.session_in_cookie = True
+            response.cookies[response.session_id_name] = value
+            response.cookies[response.session_id_name]['path'] = '/'
         else:
-            record_id = table.insert(**dd)
-        response.cookies[response.session_id_name] = '%s:%s'\
-             % (record_id, unique_key)
-        response.cookies[response.session_id_name]['path'] = '/'
+
+            # ## too large for a cookie, store it on the server instead
+
+            if response.session_in_cookie:
+                response.session_in_cookie = False
+                response.session_hash = None
+            if not response._session_store:
+                response.cookies[response.session_id_name] = \
+                    response.session_id
+                response.cookies[response.session_id_name]['path'] = '/'
+
+    def _try_store_in_db(self, request, response):
+        store = response._session_store
+        if not store or self._forget or self._loader\
+             or response.session_in_cookie:
+            return
+        data = self._dumps()
+        changed = md5_hash(data) != response.session_hash
+        if not response.session_id and not changed:
+            return
+        session_id = store.write(response.session_id, data, changed)
+        if session_id != response.session_id:
+            response.session_id = session_id
+            response.cookies[response.session_id_name] = session_id
+            response.cookies[response.session_id_name]['path'] = '/'
 
     def _try_store_on_disk(self, request, response):
-        if response._dbtable_and_field or not response.session_id\
-             or self._forget:
+        if response._session_store or not response.session_id\
+             or self._forget or self._loader or response.session_in_cookie:
             self._unlock(response)
             return
+        data = self._dumps()
+        now = time.time()
+        if md5_hash(data) == response.session_hash:
+            if response.session_mtime is None or now\
+                 - response.session_mtime <= SESSION_TOUCH_INTERVAL:
+                self._unlock(response)
+                return
+            try:
+                os.utime(response.session_filename, None)
+                self._index_expiry(response, now)
+                self._unlock(response)
+                return
+            except OSError:
+
+                # ## just removed by the sweeper, write it again
+
+                self._unlock(response)
+                response.session_new = True
         if response.session_new:
+            make_dirs(response.session_filename)
             response.session_file = open(response.session_filename, 'wb'
                     )
             portalocker.lock(response.session_file, portalocker.LOCK_EX)
-        cPickle.dump(dict(self), response.session_file)
+        response.session_file.write(data)
+        response.session_file.truncate()
+        self._index_expiry(response, now)
         self._unlock(response)
 
+    def _index_expiry(self, response, now):
+        """
+        lists the session stored at time now in its expiry bucket, unless
+        it was already stored during that bucket
+        """
+
+        bucket = int(now // SESSION_EXPIRY_BUCKET)
+        if response.session_mtime is not None\
+             and int(response.session_mtime // SESSION_EXPIRY_BUCKET)\
+             == bucket:
+            return
+        marker = os.path.join(response.session_folder, '.expiry',
+                              str(bucket), response.session_id)
+        make_dirs(marker)
+        open(marker, 'wb').close()
+
     def _unlock(self, response):
         if response and response.session_file:
             portalocker.unlock(response.session_file)
             del response.session_file
 
 
+class DBSessionStore(object):
+
+    """
+    stores sessions in the table tablename_masterapp, one record per
+    session. the cookie is 'record_id:unique_key'.
+
+    if expiration (in seconds) is given, sessions not stored for longer
+    than that are ignored.
+
+    modified_datetime is indexed, for sweep(), when the table is created
+    (tables created by older versions need the index created by hand).
+    """
+
+    def __init__(
+        self,
+        db,
+        tablename='web2py_session',
+        expiration=None,
+        ):
+        self.db = db
+        self.tablename = tablename
+        self.expiration = expiration
+        self.modified = None
+
+    def connect(self, request, masterapp, migrate=True):
+        self.request = request
+        db = self.db
+        tname = self.tablename + '_' + masterapp
+        table = db.get(tname, None)
+        if table is None:
+            table = db.define_table(
+                tname,
+                db.Field('locked', 'boolean', default=False),
+                db.Field('client_ip', length=64),
+                db.Field('created_datetime', 'datetime',
+                         default=request.now),
+                db.Field('modified_datetime', 'datetime'),
+                db.Field('unique_key', length=64),
+                db.Field('session_data', 'blob'),
+                migrate=migrate,
+                indexes=['modified_datetime'],
+                )
+        self.table = table
+
+    def read(self, session_id):
+        try:
+            (record_id, unique_key) = session_id.split(':')
+            record_id = int(record_id)
+        except ValueError:
+            return None
+        table = self.table
+        rows = self.db(table.id == record_id).select(table.unique_key,
+                table.modified_datetime, table.session_data)
+        if len(rows) == 0 or rows[0].unique_key != unique_key:
+            return None
+        modified = rows[0].modified_datetime
+        if self.expiration and (not modified or modified
+                                 < self.request.now
+                                 - datetime.timedelta(seconds=self.expiration)):
+            return None
+        self.modified = modified
+        return rows[0].session_data
+
+    def sweep(self, expiration):
+        """
+        deletes the sessions not stored for expiration seconds.
+        the caller commits.
+        """
+
+        table = self.table
+        limit = datetime.datetime.now()\
+             - datetime.timedelta(seconds=expiration)
+        self.db(table.modified_datetime < limit).delete()
+
+    def write(self, session_id, data, changed=True):
+        table = self.table
+        now = self.request.now
+        if not session_id:
+            unique_key = str(uuid.uuid4())
+            record_id = table.insert(locked=False,
+                    client_ip=self.request.env.remote_addr,
+                    modified_datetime=now, unique_key=unique_key,
+                    session_data=data)
+            return '%s:%s' % (record_id, unique_key)
+        record_id = int(session_id.split(':')[0])
+        if changed:
+            self.db(table.id == record_id).update(locked=False,
+                    client_ip=self.request.env.remote_addr,
+                    modified_datetime=now, session_data=data)
+        else:
+            interval = SESSION_TOUCH_INTERVAL
+            if self.expiration:
+                interval = min(interval, self.expiration / 2)
+            if not self.modified or now - self.modified\
+                 > datetime.timedelta(seconds=interval):
+                self.db(table.id
+                         == record_id).update(modified_datetime=now)
+        return session_id
+
+
+class MemcacheSessionStore(object):
+
+    """
+    stores sessions in memcache, for example in a model
+
+        from gluon.contrib.memcache import MemcacheClient
+        cache.memcache = MemcacheClient(request, ['127.0.0.1:11211'])
+        session.connect(request, response,
+                        store=MemcacheSessionStore(cache.memcache))
+
+    client is anything with the get/set methods of memcache.Client.
+    sessions expire after expiration seconds without being stored.
+    """
+
+    def __init__(self, client, expiration=3600):
+        self.client = client
+        self.expiration = expiration
+        self.stored = None
+
+    def connect(self, request, masterapp, migrate=True):
+        self.request = request
+        self.prefix = 'session/%s/' % masterapp
+
+    def read(self, session_id):
+        if not regex_session_id.match(session_id):
+            return None
+        obj = self.client.get(self.prefix + session_id)
+        if not obj:
+            return None
+        (self.stored, data) = obj
+        return data
+
+    def write(self, session_id, data, changed=True):
+        now = time.time()
+        if not session_id:
+            session_id = '%s-%s' % (self.request.client.replace(':', '-'
+                                    ).replace('.', '-'), uuid.uuid4())
+        elif not changed and self.stored and now - self.stored\
+             < min(SESSION_TOUCH_INTERVAL, self.expiration / 2):
+            return session_id
+        self.client.set(self.prefix + session_id, (now, data),
+                        self.expiration)
+        return session_id
+
+
+def find_cookie_global(module, name):
+    if not (module, name) in COOKIE_SESSION_GLOBALS:
+        raise cPickle.UnpicklingError, '%s.%s not allowed in a session cookie'\
+             % (module, name)
+    __import__(module)
+    return getattr(sys.modules[module], name)
+
+
+def loads_cookie_session(data):
+    """
+    unpickles a session read from a cookie, allowing only the classes in
+    COOKIE_SESSION_GLOBALS
+    """
+
+    unpickler = cPickle.Unpickler(cStringIO.StringIO(data))
+    unpickler.find_global = find_cookie_global
+    return unpickler.load()
+
+
+def _remove_expired(filename, limit):
+    try:
+        if os.stat(filename)[stat.ST_MTIME] < limit:
+            os.unlink(filename)
+            return True
+    except OSError:
+        pass
+    return False
+
+
+def sweep_sessions(folder, expiration, full=False):
+    """
+    deletes the session files in folder not stored for expiration seconds
+    and returns how many. only the expiry buckets that are old enough are
+    visited; full=True also scans all the files, which is needed once for
+    sessions stored before the index existed.
+    """
+
+    now = time.time()
+    limit = now - expiration
+    deleted = 0
+    if full:
+        for (root, dirs, files) in os.walk(folder):
+            if '.expiry' in dirs:
+                dirs.remove('.expiry')
+            for name in files:
+                if not name.startswith('.')\
+                     and _remove_expired(os.path.join(root, name), limit):
+                    deleted += 1
+    index = os.path.join(folder, '.expiry')
+    if not os.path.isdir(index):
+        return deleted
+    for bucket in os.listdir(index):
+        try:
+            end = (int(bucket) + 1) * SESSION_EXPIRY_BUCKET
+        except ValueError:
+            continue
+        if end > limit:
+            continue
+        path = os.path.join(index, bucket)
+        for name in os.listdir(path):
+            if _remove_expired(locate(folder, name), limit):
+                deleted += 1
+            os.unlink(os.path.join(path, name))
+        try:
+            os.rmdir(path)
+        except OSError:
+            pass
+    return deleted
+
+
+class SessionSweeper(threading.Thread):
+
+    """
+    deletes the expired file sessions of all applications in the
+    background, every SESSION_EXPIRY_BUCKET seconds
+    """
+
+    def __init__(self, expiration, path='applications'):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.expiration = expiration
+        self.path = os.path.join(os.getcwd(), path)
+
+    def run(self):
+        full = True
+        while True:
+            for app in os.listdir(self.path):
+                folder = os.path.join(self.path, app, 'sessions')
+                if not os.path.isdir(folder):
+                    continue
+                try:
+                    deleted = sweep_sessions(folder, self.expiration,
+                            full)
+                    logging.debug('%s expired sessions deleted from %s'
+                                   % (deleted, folder))
+                except Exception:
+                    logging.warning('unable to sweep sessions in %s'
+                                     % folder)
+            full = False
+            time.sleep(SESSION_EXPIRY_BUCKET)
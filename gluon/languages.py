@@ -75,14 +75,24 @@ class translator(object):
     to determine a translation file. 
 
     notice 2: en and en-en are considered different languages!
+
+    notice 3: request.env is read the first time T is called, so building
+    T costs nothing to the requests that do not translate.
     """
 
     def __init__(self, request):
+        self.request = request
         self.folder = request.folder
         self.current_languages = []
-        self.http_accept_language = request.env.http_accept_language
         self.forced = False
 
+    def __getattr__(self, key):
+        if key == 'http_accept_language':
+            self.http_accept_language = \
+                self.request.env.http_accept_language
+            return self.http_accept_language
+        raise AttributeError, key
+
     def force(self, languages=None):
         self.forced = True
         if languages:
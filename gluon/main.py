@@ -13,7 +13,6 @@ import Cookie
 import cPickle
 import os
 import re
-import copy
 import sys
 import types
 import time
@@ -22,7 +21,6 @@ import datetime
 import signal
 import socket
 import stat
-import tempfile
 import logging
 
 # from wsgiref.simple_server import make_server, demo_app
@@ -31,15 +29,16 @@ from random import random
 from storage import Storage, load_storage, save_storage
 from restricted import RestrictedError
 from http import HTTP, redirect
-from globals import Request, Response, Session
+from globals import Request, Response, Session, Environ
 from compileapp import build_environment, run_models_in, \
-    run_controller_in, run_view_in
-from fileutils import listdir, copystream
+    run_controller_in, run_view_in, app_manifest, unfreeze
+from fileutils import listdir
 from contenttype import contenttype
 from rewrite import rewrite, error_message, error_message_ticket, \
     symbols as rewriteSymbols
 from xmlrpc import handler
 from sql import SQLDB
+from cache import page_rules, serve_page, store_page
 import html
 import myregex
 try:
@@ -119,7 +118,7 @@ def serve_controller(request, response, session):
     # ##################################################
 
     run_models_in(environment)
-    response._view_environment = copy.copy(environment)
+    response._view_environment = environment.copy()
     run_controller_in(request.controller, request.function, environment)
     if not type(response.body) in [types.StringType,
                                    types.GeneratorType]:
@@ -162,13 +161,13 @@ def wsgibase(environ, responder):
         try:
             session_file = None
             session_new = False
+            page_cached = False
 
             # ##################################################
             # parse the environment variables - DONE
             # ##################################################
 
-            for (key, value) in environ.items():
-                request.env[key.lower().replace('.', '_')] = value
+            request.env = Environ(environ)
             request.env.web2py_path = web2py_path
             request.env.web2py_version = web2py_version
 
@@ -232,7 +231,8 @@ def wsgibase(environ, responder):
             # access the requested application
             # ##################################################
 
-            if not os.path.exists(request.folder):
+            if not app_manifest(request.folder)\
+                 and not os.path.exists(request.folder):
                 if items == ['init', 'default', 'index']:
                     items[0] = 'welcome'
                     redirect(html.URL(*items))
@@ -240,57 +240,10 @@ def wsgibase(environ, responder):
                            web2py_error='invalid application')
 
             # ##################################################
-            # get the GET and POST data -DONE
+            # request.vars, request.cookies and request.body are
+            # parsed by request the first time they are used
             # ##################################################
 
-            request.body = tempfile.TemporaryFile()
-            if request.env.content_length:
-                copystream(request.env.wsgi_input, request.body,
-                           int(request.env.content_length))
-
-            # ## parse GET vars, even if POST
-
-            dget = cgi.parse_qsl(request.env.query_string,
-                                 keep_blank_values=1)
-            for (key, value) in dget:
-                if request.vars.has_key(key):
-                    if isinstance(request.vars[key], list):
-                        request.vars[key].append(value)
-                    else:
-                        request.vars[key] = [request.vars[key], value]
-                else:
-                    request.vars[key] = value
-                request.get_vars[key] = request.vars[key]
-
-            # ## parse POST vars if any
-
-            if request.env.request_method in ['POST', 'BOTH']:
-                dpost = cgi.FieldStorage(fp=request.body,
-                        environ=environ, keep_blank_values=1)
-                request.body.seek(0)
-                try:
-                    keys = dpost.keys()
-                except TypeError:
-                    keys = []
-                for key in keys:
-                    dpk = dpost[key]
-                    if isinstance(dpk, list):
-                        value = [x.value for x in dpk]
-                    elif not dpk.filename:
-                        value = dpk.value
-                    else:
-                        value = dpk
-                    request.post_vars[key] = request.vars[key] = value
-
-            # ##################################################
-            # load cookies
-            # ##################################################
-
-            request.cookies = Cookie.SimpleCookie()
-            response.cookies = Cookie.SimpleCookie()
-            if request.env.http_cookie:
-                request.cookies.load(request.env.http_cookie)
-
             # ##################################################
             # try load session or create new session file
             # ##################################################
@@ -312,12 +265,35 @@ def wsgibase(environ, responder):
             # run controller
             # ##################################################
 
+            # ##################################################
+            # serve the page if cached by response.cache_page
+            # ##################################################
+
+            if page_rules:
+                page = serve_page(request)
+                if page:
+                    page_cached = True
+                    raise page
+
             if not items[1] == 'static':
                 serve_controller(request, response, session)
         except HTTP, http_response:
 
             # ##################################################
-            # on sucess, try store session in database
+            # cache the page if the action called cache_page
+            # ##################################################
+
+            if not page_cached and (page_rules or response._cache_page):
+                store_page(request, response, http_response)
+
+            # ##################################################
+            # on sucess, try store session in a signed cookie
+            # ##################################################
+
+            session._try_store_in_cookie(request, response)
+
+            # ##################################################
+            # or else try store session in database
             # ##################################################
 
             session._try_store_in_db(request, response)
@@ -341,7 +317,14 @@ def wsgibase(environ, responder):
             # store cookies in headers
             # ##################################################
 
-            if session._secure:
+            if session._loader and \
+                response.cookies.has_key(response.session_id_name):
+
+                # ## the session was not used, its cookie is unchanged
+
+                del response.cookies[response.session_id_name]
+            if session._secure and \
+                response.cookies.has_key(response.session_id_name):
                 response.cookies[response.session_id_name]['secure'] = \
                     True
             http_response.headers['Set-Cookie'] = [str(cookie)[11:]
@@ -551,6 +534,10 @@ class HttpServer(object):
             signal.signal(signal.SIGTERM, lambda a, b, s=self: s.stop())
         except:
             pass
+        try:
+            signal.signal(signal.SIGHUP, lambda a, b: unfreeze())
+        except:
+            pass
         open(self.pid_filename, 'w').write(str(os.getpid()))
         self.server.start()
 
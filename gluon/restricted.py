@@ -83,11 +83,18 @@ class RestrictedError:
         self.traceback = d['traceback']
 
 
-def restricted(code, environment={}, layer='Unkown'):
+def restricted(
+    code,
+    environment={},
+    layer='Unkown',
+    source=None,
+    ):
     """
     runs code in evrionment and returns the output. if an exeception occurs 
     in code it raises a RestrictedError containg the traceback. layer is passed
-    to RestrictedError to identify where the error occurred.
+    to RestrictedError to identify where the error occurred. source is the
+    text code was compiled from (if code is a code object), logged instead
+    of code.
     """
 
     try:
@@ -99,6 +106,6 @@ def restricted(code, environment={}, layer='Unkown'):
     except HTTP:
         raise
     except Exception, exception:
-        raise RestrictedError(layer, code, '', environment)
+        raise RestrictedError(layer, source or code, '', environment)
 
 
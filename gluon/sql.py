@@ -26,10 +26,12 @@ import socket
 import logging
 import copy_reg
 import base64
+import itertools
 
 import contrib.simplejson as json
 
 from gluon.utils import md5_hash
+from gluon.fileutils import locate
 
 table_field = re.compile('[\w_]+\.[\w_]+')
 
@@ -86,6 +88,7 @@ import portalocker
 import validators
 
 sql_locker = thread.allocate_lock()
+sql_cursors = itertools.count(1)  # ## names of the server side cursors
 
 SQL_DIALECTS = {
     'sqlite': {
@@ -111,6 +114,7 @@ SQL_DIALECTS = {
         'random': 'Random()',
         'notnull': 'NOT NULL DEFAULT %(default)s',
         'substring': 'SUBSTR(%(field)s,%(pos)s,%(length)s)',
+        'placeholder': '?',
         },
     'mysql': {
         'boolean': 'CHAR(1)',
@@ -135,6 +139,7 @@ SQL_DIALECTS = {
         'random': 'RAND()',
         'notnull': 'NOT NULL DEFAULT %(default)s',
         'substring': 'SUBSTRING(%(field)s,%(pos)s,%(length)s)',
+        'placeholder': '%s',
         },
     'postgres': {
         'boolean': 'CHAR(1)',
@@ -159,6 +164,7 @@ SQL_DIALECTS = {
         'random': 'RANDOM()',
         'notnull': 'NOT NULL DEFAULT %(default)s',
         'substring': 'SUBSTR(%(field)s,%(pos)s,%(length)s)',
+        'placeholder': '%s',
         },
     'oracle': {
         'boolean': 'CHAR(1)',
@@ -207,6 +213,7 @@ SQL_DIALECTS = {
         'random': 'NEWID()',
         'notnull': 'NOT NULL DEFAULT %(default)s',
         'substring': 'SUBSTRING(%(field)s,%(pos)s,%(length)s)',
+        'placeholder': '?',
         },
     'mssql2': {
         'boolean': 'CHAR(1)',
@@ -255,6 +262,7 @@ SQL_DIALECTS = {
         'random': 'RANDOM()',
         'notnull': 'DEFAULT %(default)s NOT NULL',
         'substring': 'SUBSTRING(%(field)s,%(pos)s,%(length)s)',
+        'placeholder': '?',
         },
     'informix': {
         'boolean': 'CHAR(1)',
@@ -334,7 +342,7 @@ def sql_represent(obj, fieldtype, dbname):
     elif fieldtype[0] == 'r':
         return str(int(obj))
     elif fieldtype == 'double':
-        return str(float(obj))
+        return repr(float(obj))  # ## str() keeps 12 digits only
     if isinstance(obj, unicode):
         obj = obj.encode('utf-8')
     if fieldtype == 'blob':
@@ -371,6 +379,77 @@ def sql_represent(obj, fieldtype, dbname):
     return "'%s'" % obj.replace("'", "''")
 
 
+# ## stands for a bound parameter in the queries being built, it is
+# ## replaced by the placeholder of the dialect when executed
+
+SQL_PARAM = '\x00'
+regex_literal = re.compile("^(NULL|-?\d+(\.\d+)?(e[+-]\d+)?|'.*')$",
+                           re.DOTALL)
+
+
+def sql_parameter(obj, fieldtype, dbname):
+    """
+    returns (text, params): SQL_PARAM and [the literal of obj], or else the
+    literal itself and [] if it cannot be bound (an expression or a dialect
+    specific literal like to_date(...))
+    """
+
+    literal = sql_represent(obj, fieldtype, dbname)
+    if isinstance(literal, str) and regex_literal.match(literal):
+        return (SQL_PARAM, [literal])
+    return (str(literal), [])
+
+
+def sql_value(literal, dbname):
+    """
+    the value to bind for a literal returned by sql_represent
+    """
+
+    if literal == 'NULL':
+        return None
+    elif literal[0] == "'":
+        value = literal[1:-1].replace("''", "'")
+        if dbname == 'sqlite':
+            try:
+                value.decode('ascii')
+            except UnicodeDecodeError:
+                value = value.decode('utf8')  # ## sqlite3 binds unicode only
+        return value
+    elif literal.isdigit() or literal[1:].isdigit():
+        return int(literal)
+    return float(literal)
+
+
+def sql_inline(query, params):
+    """
+    query with the literals in params in place of SQL_PARAM, None if they
+    do not match
+    """
+
+    parts = query.split(SQL_PARAM)
+    if len(parts) != len(params) + 1:
+        return None
+    items = [parts[0]]
+    for (literal, part) in zip(params, parts[1:]):
+        items.append(literal)
+        items.append(part)
+    return ''.join(items)
+
+
+def sql_bound(query):
+    """
+    returns (text, params) of a SQLQuery or of a string, params is None if
+    the query cannot be executed with bound parameters
+    """
+
+    if isinstance(query, SQLQuery):
+        return (query._bsql, query._params)
+    text = str(query)
+    if SQL_PARAM in text:
+        return (text, None)
+    return (text, [])
+
+
 def cleanup(text):
     if re.compile('[^0-9a-zA-Z_]').findall(text):
         raise SyntaxError, \
@@ -442,6 +521,10 @@ class SQLDB(SQLStorage):
        db.define_table('tablename',SQLField('fieldname1'),
                                    SQLField('fieldname2'))
 
+    define_table(..., indexes=['fieldname1', ('fieldname1','fieldname2')])
+    also creates the indexes, named tablename_fieldname1... , when it
+    creates the table.
+
     """
 
     # ## this allows gluon to comunite a folder for this thread
@@ -552,7 +635,7 @@ class SQLDB(SQLStorage):
             self._connection.create_function('web2py_extract', 2,
                     sqlite3_web2py_extract)
             self._cursor = self._connection.cursor()
-            self._execute = lambda *a, **b: self._cursor.execute(*a, **b)
+            self._execute_on = lambda cursor, *a, **b: cursor.execute(*a, **b)
         elif self._uri[:9] == 'sqlite://':
             self._dbname = 'sqlite'
             if uri[9] != '/':
@@ -565,7 +648,7 @@ class SQLDB(SQLStorage):
             self._connection.create_function('web2py_extract', 2,
                     sqlite3_web2py_extract)
             self._cursor = self._connection.cursor()
-            self._execute = lambda *a, **b: self._cursor.execute(*a,
+            self._execute_on = lambda cursor, *a, **b: cursor.execute(*a,
                     **b)
         elif self._uri[:8] == 'mysql://':
             self._dbname = 'mysql'
@@ -596,7 +679,7 @@ class SQLDB(SQLStorage):
                     charset='utf8',
                     ))
             self._cursor = self._connection.cursor()
-            self._execute = lambda *a, **b: self._cursor.execute(*a,
+            self._execute_on = lambda cursor, *a, **b: cursor.execute(*a,
                     **b)
             self._execute('SET FOREIGN_KEY_CHECKS=0;')
             self._execute("SET sql_mode='NO_BACKSLASH_ESCAPES';")
@@ -626,7 +709,7 @@ class SQLDB(SQLStorage):
             self._pool_connection(lambda : psycopg2.connect(msg))
             self._connection.set_client_encoding('UTF8')
             self._cursor = self._connection.cursor()
-            self._execute = lambda *a, **b: self._cursor.execute(*a,
+            self._execute_on = lambda cursor, *a, **b: cursor.execute(*a,
                     **b)
             query = 'BEGIN;'
             self['_lastsql'] = query
@@ -637,7 +720,7 @@ class SQLDB(SQLStorage):
             self._pool_connection(lambda : \
                                   cx_Oracle.connect(self._uri[9:]))
             self._cursor = self._connection.cursor()
-            self._execute = lambda a: self._cursor.execute(a[:-1])  # ##
+            self._execute_on = lambda cursor, a: cursor.execute(a[:-1])  # ##
             self._execute("ALTER SESSION SET NLS_DATE_FORMAT = 'YYYY-MM-DD';"
                           )
             self._execute("ALTER SESSION SET NLS_TIMESTAMP_FORMAT = 'YYYY-MM-DD HH24:MI:SS';"
@@ -694,11 +777,11 @@ class SQLDB(SQLStorage):
             self._pool_connection(lambda : pyodbc.connect(cnxn))
             self._cursor = self._connection.cursor()
             if self._uri[:8] == 'mssql://':
-                self._execute = lambda *a, **b: \
-                    self._cursor.execute(*a, **b)
+                self._execute_on = lambda cursor, *a, **b: \
+                    cursor.execute(*a, **b)
             elif self._uri[:9] == 'mssql2://':
-                self._execute = lambda a: \
-                    self._cursor.execute(unicode(a, 'utf8'))
+                self._execute_on = lambda cursor, a: \
+                    cursor.execute(unicode(a, 'utf8'))
         elif self._uri[:11] == 'firebird://':
             self._dbname = 'firebird'
             m = \
@@ -724,7 +807,7 @@ class SQLDB(SQLStorage):
                                    % (host, db), user=user,
                                   password=passwd))
             self._cursor = self._connection.cursor()
-            self._execute = lambda *a, **b: self._cursor.execute(*a,
+            self._execute_on = lambda cursor, *a, **b: cursor.execute(*a,
                     **b)
             self._execute('SET NAMES UTF8;')
         elif self._uri[:11] == 'informix://':
@@ -751,7 +834,7 @@ class SQLDB(SQLStorage):
                                    % (db, host), user=user,
                                   password=passwd))
             self._cursor = self._connection.cursor()
-            self._execute = lambda a: self._cursor.execute(a[:-1])
+            self._execute_on = lambda cursor, a: cursor.execute(a[:-1])
         elif self._uri[:5] == 'jdbc:':
             self._dbname = self._uri.split(':')[1]
             if self._dbname=='sqlite':
@@ -765,7 +848,8 @@ class SQLDB(SQLStorage):
             else:
                 raise SyntaxError, "sorry only sqlite on jdbc for now"
             self._cursor = self._connection.cursor()
-            self._execute = lambda a: self._cursor.execute(a[:-1])
+            self._execute_on = lambda cursor, a, *b: cursor.execute(a[:-1],
+                    *b)
         elif self._uri == 'None':
 
 
@@ -780,7 +864,7 @@ class SQLDB(SQLStorage):
             self._dbname = 'sqlite'
             self._connection = Dummy()
             self._cursor = Dummy()
-            self._execute = lambda a: []
+            self._execute_on = lambda cursor, *a: []
         else:
             raise SyntaxError, 'database type not supported'
         self._translator = SQL_DIALECTS[self._dbname]
@@ -802,7 +886,8 @@ class SQLDB(SQLStorage):
         ):
         if not args.has_key('migrate'):
             args['migrate'] = True
-        if args.keys() != ['migrate']:
+        if [key for key in args.keys() if not key in ['migrate',
+            'indexes']]:
             raise SyntaxError, 'invalid table attribute'
         tablename = cleanup(tablename)
         if tablename in dir(self) or tablename[0] == '_':
@@ -815,7 +900,8 @@ class SQLDB(SQLStorage):
             return t
         sql_locker.acquire()
         try:
-            query = t._create(migrate=args['migrate'])
+            query = t._create(migrate=args['migrate'],
+                              indexes=args.get('indexes', None) or [])
         except BaseException, e:
             sql_locker.release()
             raise e
@@ -832,11 +918,65 @@ class SQLDB(SQLStorage):
     def rollback(self):
         self._connection.rollback()
 
+    def _execute(self, *a, **b):
+        return self._execute_on(self._cursor, *a, **b)
+
     def executesql(self, query):
         self['_lastsql'] = query
         self._execute(query)
         return self._cursor.fetchall()
 
+    def _iter_cursor(self):
+        """
+        a new cursor for iterselect, a named (server side) one on postgres
+        so that the rows are sent as they are fetched
+        """
+
+        if self._dbname == 'postgres':
+            return self._connection.cursor('web2py_cursor_%i'
+                     % sql_cursors.next())
+        return self._connection.cursor()
+
+    def _execute_bound(
+        self,
+        query,
+        params,
+        inline,
+        cursor=None,
+        ):
+        """
+        executes query, where SQL_PARAM stands for each of the literals in
+        params, with the placeholders of the dialect and the values bound,
+        so that the text of the statement depends only on the shape of the
+        query and the database can reuse its plan. dialects without
+        placeholders get the literals in the text instead, and so do the
+        queries that cannot be bound (params is None), for which inline()
+        returns the text. the query runs on cursor if given, else on the
+        cursor of the connection.
+        """
+
+        cursor = cursor or self._cursor
+
+        placeholder = self._translator.get('placeholder', None)
+        if params and placeholder and query.count(SQL_PARAM)\
+             == len(params):
+            try:
+                values = [sql_value(p, self._dbname) for p in params]
+            except UnicodeDecodeError:
+                values = None
+            if values is not None:
+                if placeholder == '%s':
+                    query = query.replace('%', '%%')
+                query = query.replace(SQL_PARAM, placeholder)
+                self['_lastsql'] = query
+                return self._execute_on(cursor, query, values)
+        if params is not None:
+            query = sql_inline(query, params)
+        if query is None or params is None:
+            query = inline()
+        self['_lastsql'] = query
+        return self._execute_on(cursor, query)
+
     def _update_referenced_by(self, other):
         for tablename in self.tables:
             by = self[tablename]._referenced_by
@@ -1034,7 +1174,7 @@ class SQLTable(dict):
         self._db[alias] = self
         return other
 
-    def _create(self, migrate=True):
+    def _create(self, migrate=True, indexes=[]):
         fields = []
         sql_fields = {}
         sql_fields_aux = {}
@@ -1107,6 +1247,20 @@ class SQLTable(dict):
                 logfile.write(query + '\n')
             self._db['_lastsql'] = query
             self._db._execute(query)
+            for fieldnames in indexes:
+                if isinstance(fieldnames, str):
+                    fieldnames = [fieldnames]
+                for fieldname in fieldnames:
+                    if not fieldname in self.fields:
+                        raise SyntaxError, 'SQLTable: no such field %s'\
+                             % fieldname
+                index = 'CREATE INDEX %s_%s ON %s (%s);'\
+                     % (self._tablename, '_'.join(fieldnames),
+                        self._tablename, ', '.join(fieldnames))
+                if self._dbt:
+                    logfile.write(index + '\n')
+                self._db['_lastsql'] = index
+                self._db._execute(index)
             if self._db._dbname == 'oracle':
                 t = self._tablename
                 self._db._execute('CREATE SEQUENCE %s_sequence START WITH 1 INCREMENT BY 1 NOMAXVALUE;'
@@ -1236,9 +1390,19 @@ end;
             logfile.write('success!\n')
 
     def _insert(self, **fields):
-        (fs, vs) = ([], [])
+        return self._insert_sql(fields, False)[0]
+
+    def _insert_sql(self, fields, bind):
+        """
+        returns (query, params), with bind the values are SQL_PARAM in
+        query and their literals in params (None if it cannot be bound)
+        """
+
+        (fs, vs, params) = ([], [], [])
         if [key for key in fields.keys() if not key in self.fields]:
             raise SyntaxError, 'invalid field name'
+        represent = bind and sql_parameter or (lambda *a: \
+                (sql_represent(*a), []))
         for fieldname in self.fields:
             if fieldname == 'id':
                 continue
@@ -1248,45 +1412,56 @@ end;
                 fs.append(fieldname)
                 value = fields[fieldname]
                 try:
-                    vs.append(sql_represent(value.id, ft, fd))
+                    (text, p) = represent(value.id, ft, fd)
                 except:
-                    vs.append(sql_represent(value, ft, fd))
+                    (text, p) = represent(value, ft, fd)
             elif field.default != None:
                 fs.append(fieldname)
-                vs.append(sql_represent(field.default, ft, fd))
+                (text, p) = represent(field.default, ft, fd)
             elif field.required is True:
                 raise SyntaxError, 'SQLTable: missing required field'
+            else:
+                continue
+            vs.append(str(text))
+            params += p
         sql_f = ', '.join(fs)
         sql_v = ', '.join(vs)
         sql_t = self._tablename
-        return 'INSERT INTO %s(%s) VALUES (%s);' % (sql_t, sql_f, sql_v)
+        return ('INSERT INTO %s(%s) VALUES (%s);' % (sql_t, sql_f,
+                sql_v), params)
+
+    def _returning(self, query):
+        """
+        query (an INSERT) also returning the id where the dialect can
+        """
+
+        dbname = self._db._dbname
+        if dbname in ('postgres', 'firebird'):
+            return query[:-1] + ' RETURNING id;'
+        elif dbname in ('mssql', 'mssql2'):
+            return query.replace(') VALUES (',
+                                 ') OUTPUT INSERTED.id VALUES (', 1)
+        return query
 
     def insert(self, **fields):
-        query = self._insert(**fields)
-        self._db['_lastsql'] = query
-        self._db._execute(query)
-        if self._db._dbname == 'sqlite':
+        (query, params) = self._insert_sql(fields, True)
+        self._db._execute_bound(self._returning(query), params,
+                                lambda : \
+                                self._returning(self._insert(**fields)))
+
+        # ## the id is returned by the INSERT, except on oracle and
+        # ## informix, and given by the driver on sqlite and mysql
+
+        if self._db._dbname in ('sqlite', 'mysql'):
             id = self._db._cursor.lastrowid
-        elif self._db._dbname == 'postgres':
-            self._db._execute("select currval('%s_id_Seq')"
-                               % self._tablename)
-            id = int(self._db._cursor.fetchone()[0])
-        elif self._db._dbname == 'mysql':
-            self._db._execute('select last_insert_id();')
+        elif self._db._dbname in ('postgres', 'firebird', 'mssql',
+                                  'mssql2'):
             id = int(self._db._cursor.fetchone()[0])
         elif self._db._dbname == 'oracle':
             t = self._tablename
             self._db._execute('SELECT %s_sequence.currval FROM dual;'
                                % t)
             id = int(self._db._cursor.fetchone()[0])
-        elif self._db._dbname == 'mssql' or self._db._dbname\
-             == 'mssql2':
-            self._db._execute('SELECT @@IDENTITY;')
-            id = int(self._db._cursor.fetchone()[0])
-        elif self._db._dbname == 'firebird':
-            self._db._execute('SELECT gen_id(GENID_%s, 0) FROM rdb$database'
-                               % self._tablename)
-            id = int(self._db._cursor.fetchone()[0])
         elif self._db._dbname == 'informix':
             self._db._execute('SELECT LOCAL_SQLCA^.sqlerrd[1]')
             id = int(self._db._cursor.fetchone()[0])
@@ -1294,6 +1469,109 @@ end;
             id = None
         return id
 
+    def bulk_insert(self, items, batch_size=500):
+        """
+        inserts the records in items (a list of dicts like the arguments
+        of insert), up to batch_size records per statement: one INSERT
+        with many VALUES on sqlite, mysql and postgres, executemany on the
+        other dialects with placeholders, one insert each on the others.
+
+        returns the list of the ids, or None if they are not known: with
+        executemany, and on mysql when innodb_autoinc_lock_mode is 2 (the
+        default of mysql 8) since the ids of a statement may then not be
+        consecutive. on mysql they are counted by auto_increment_increment,
+        on postgres they are taken from the sequence tablename_id_seq
+        before the insert.
+        """
+
+        db = self._db
+        placeholder = db._translator.get('placeholder', None)
+        if not placeholder:
+            return [self.insert(**fields) for fields in items]
+        (ids, query, batch) = ([], None, [])
+        for fields in items:
+            (text, params) = self._insert_sql(fields, True)
+            bound = params and text.count(SQL_PARAM) == len(params)
+            if not bound or text != query or len(batch) >= batch_size:
+                ids += self._insert_batch(query, batch)
+                (query, batch) = (text, [])
+            if bound:
+                batch.append((fields, params))
+            else:
+                ids.append(self.insert(**fields))
+        ids += self._insert_batch(query, batch)
+        if None in ids:
+            return None
+        return ids
+
+    def _insert_batch(self, query, batch):
+        if not batch:
+            return []
+        db = self._db
+        size = max(1, 999 / len(batch[0][1]))
+        if db._dbname == 'sqlite' and len(batch) > size:
+
+            # ## sqlite takes at most 999 variables per statement
+
+            return self._insert_batch(query, batch[:size])\
+                 + self._insert_batch(query, batch[size:])
+        try:
+            values = [[sql_value(p, db._dbname) for p in params]
+                      for (fields, params) in batch]
+        except UnicodeDecodeError:
+            return [self.insert(**fields) for (fields, params) in batch]
+        placeholder = db._translator['placeholder']
+        if placeholder == '%s':
+            query = query.replace('%', '%%')
+        query = query.replace(SQL_PARAM, placeholder)
+        if not db._dbname in ('sqlite', 'mysql', 'postgres'):
+            db['_lastsql'] = query
+            db._cursor.executemany(query, values)
+            return [None] * len(batch)
+        n = len(batch)
+        i = query.index(' VALUES ') + 8
+        if db._dbname == 'postgres':
+
+            # ## the ids are taken first so that each row gets a known one
+
+            db._execute("SELECT nextval('%s_id_seq') FROM generate_series(1, %i);"
+                         % (self._tablename, n))
+            ids = [int(row[0]) for row in db._cursor.fetchall()]
+            values = [[new_id] + row for (new_id, row) in zip(ids,
+                      values)]
+            query = query.replace('(', '(id, ', 1)
+            i += 4
+            query = query[:i] + '(%s, ' % placeholder + query[i + 1:]
+        elif db._dbname == 'mysql':
+            (step, mode) = self._mysql_autoinc()
+        query = query[:i] + ', '.join([query[i:-1]] * n)
+        db['_lastsql'] = query + ';'
+        db._execute(query + ';', [value for row in values for value in
+                    row])
+        if db._dbname == 'postgres':
+            return ids
+        elif db._dbname == 'mysql':
+            if mode == 2:
+                return [None] * n  # ## interleaved, maybe not consecutive
+            first = int(db._cursor.lastrowid)  # ## of the first row
+            return range(first, first + n * step, step)
+        last = db._cursor.lastrowid
+        return range(last - n + 1, last + 1)
+
+    def _mysql_autoinc(self):
+        """
+        (auto_increment_increment, innodb_autoinc_lock_mode) of the
+        mysql connection, read once
+        """
+
+        db = self._db
+        if not db.get('_autoinc', None):
+            db._execute('SELECT @@auto_increment_increment, @@innodb_autoinc_lock_mode;'
+                        )
+            db['_autoinc'] = tuple([int(x) for x in
+                                   db._cursor.fetchone()])
+        return db._autoinc
+
     def import_from_csv_file(
         self,
         csvfile,
@@ -1633,40 +1911,68 @@ class SQLQuery(object):
         op=None,
         right=None,
         ):
+
+        # ## self.sql has the literals of the values, self._bsql has
+        # ## SQL_PARAM in place of those in self._params (see sql_bound)
+
+        (bsql, params) = (None, [])
         if op is None and right is None:
-            self.sql = left
+            sql = left
         elif right is None:
             if op == '=':
-                self.sql = '%s %s' % (left,
-                        left._db._translator['is null'])
+                sql = '%s %s' % (left, left._db._translator['is null'])
             elif op == '<>':
-                self.sql = '%s %s' % (left,
-                        left._db._translator['is not null'])
+                sql = '%s %s' % (left,
+                                 left._db._translator['is not null'])
             else:
                 raise SyntaxError, 'do not know what to do'
         elif op == ' IN ':
             if isinstance(right, str):
-                self.sql = '%s%s(%s)' % (left, op, right[:-1])
+                sql = '%s%s(%s)' % (left, op, right[:-1])
             elif hasattr(right, '__iter__'):
-                r = ','.join([sql_represent(i, left.type, left._db)
-                             for i in right])
-                self.sql = '%s%s(%s)' % (left, op, r)
+                items = [sql_parameter(i, left.type, left._db._dbname)
+                         for i in right]
+                sql = '%s%s(%s)' % (left, op, ','.join([p and p[0]
+                                    or text for (text, p) in items]))
+                bsql = '%s%s(%s)' % (left, op, ','.join([text for (text,
+                        p) in items]))
+                for (text, p) in items:
+                    params += p
             else:
                 raise SyntaxError, 'do not know what to do'
         elif isinstance(right, (SQLField, SQLXorable)):
-            self.sql = '%s%s%s' % (left, op, right)
+            sql = '%s%s%s' % (left, op, right)
         else:
-            right = sql_represent(right, left.type, left._db._dbname)
-            self.sql = '%s%s%s' % (left, op, right)
+            (text, params) = sql_parameter(right, left.type,
+                    left._db._dbname)
+            sql = '%s%s%s' % (left, op, params and params[0] or text)
+            bsql = '%s%s%s' % (left, op, text)
+        self.sql = sql
+        self._bsql = bsql or str(sql)
+        self._params = params
+        if self._bsql.count(SQL_PARAM) != len(params):
+            self._params = None  # ## in a literal, cannot be bound
+
+    def _combine(self, format, *queries):
+        bound = [sql_bound(query) for query in queries]
+        query = SQLQuery(format % queries)
+        query._bsql = format % tuple([text for (text, params) in bound])
+        query._params = []
+        for (text, params) in bound:
+            if params is None or query._params is None:
+                query._params = None
+            else:
+                query._params += params
+        return query
 
     def __and__(self, other):
-        return SQLQuery('(%s AND %s)' % (self, other))
+        return self._combine('(%s AND %s)', self, other)
 
     def __or__(self, other):
-        return SQLQuery('(%s OR %s)' % (self, other))
+        return self._combine('(%s OR %s)', self, other)
 
     def __invert__(self):
-        return SQLQuery('(NOT %s)' % self)
+        return self._combine('(NOT %s)', self)
 
     def __str__(self):
         return self.sql
@@ -1731,6 +2037,8 @@ class SQLSet(object):
         # find out wchich tables are involved
 
         self.sql_w = str(where or '')
+        (self._bsql_w, self._params) = sql_bound(where or '')
+        self._where = where
 
         # print self.sql_w
 
@@ -1739,12 +2047,22 @@ class SQLSet(object):
         # print self._tables
 
     def __call__(self, where):
-        if self.sql_w:
-            return SQLSet(self._db, SQLQuery(self.sql_w) & where)
-        else:
+        if not self.sql_w:
             return SQLSet(self._db, where)
+        elif isinstance(self._where, SQLQuery):
+            return SQLSet(self._db, self._where & where)
+        else:
+            return SQLSet(self._db, SQLQuery(self.sql_w) & where)
 
     def _select(self, *fields, **attributes):
+        return self._select_sql(self.sql_w, fields, attributes)
+
+    def _select_sql(
+        self,
+        sql_w,
+        fields,
+        attributes,
+        ):
         valid_attributes = [
             'orderby',
             'groupby',
@@ -1770,8 +2088,8 @@ class SQLSet(object):
         if len(tablenames) < 1:
             raise SyntaxError, 'SQLSet: no tables selected'
         self.colnames = [c.strip() for c in sql_f.split(', ')]
-        if self.sql_w:
-            sql_w = ' WHERE ' + self.sql_w
+        if sql_w:
+            sql_w = ' WHERE ' + sql_w
         else:
             sql_w = ''
         sql_o = ''
@@ -1855,51 +2173,108 @@ class SQLSet(object):
         """
 
         def response(query):
-            self._db['_lastsql'] = query
-            self._db._execute(query)
+            self._db._execute_bound(query, self._params, lambda : \
+                                    self._select(*fields, **attributes))
             return self._db._cursor.fetchall()
 
         if not attributes.get('cache', None):
-            query = self._select(*fields, **attributes)
+            query = self._select_sql(self._bsql_w, fields, attributes)
             r = response(query)
         else:
-            (cache_model, time_expire) = attributes['cache']
+            cache = attributes['cache']
             del attributes['cache']
-            query = self._select(*fields, **attributes)
-            key = self._db._uri + '/' + query
-            r = cache_model(key, lambda : response(query), time_expire)
+            query = self._select_sql(self._bsql_w, fields, attributes)
+            key = self._db._uri + '/' + (self._params is not None
+                    and sql_inline(query, self._params)
+                    or self._select(*fields, **attributes))
+            if len(cache) > 2:  # ## (cache_model, time_expire, tags)
+                r = cache[0](key, lambda : response(query), cache[1],
+                             tags=cache[2])
+            else:
+                (cache_model, time_expire) = cache
+                r = cache_model(key, lambda : response(query), time_expire)
         if self._db._dbname == 'mssql' or self._db._dbname == 'mssql2':
             r = r[(attributes.get('limitby',None) or (0,))[0]:]
         return SQLRows(self._db, r, *self.colnames)
 
+    def iterselect(self, *fields, **attributes):
+        """
+        like select but yields the records one by one, fetching them
+        batch_size (default 1000) at a time from a cursor of its own, so
+        that the whole response is never in memory. the cursor lives in
+        the current transaction: do not commit or rollback before the loop
+        is over, on any database. postgres closes the cursor then, sqlite
+        raises an InterfaceError after a rollback (and after a commit too
+        before python 2.7.13) and other drivers may lose the rows not yet
+        fetched.
+        """
+
+        batch_size = attributes.pop('batch_size', 1000)
+        if attributes.get('cache', None):
+            raise SyntaxError, 'iterselect: cache not supported'
+        query = self._select_sql(self._bsql_w, fields, attributes)
+        colnames = self.colnames
+        db = self._db
+        cursor = db._iter_cursor()
+        db._execute_bound(query, self._params, lambda : \
+                          self._select(*fields, **attributes), cursor)
+        skip = 0
+        if db._dbname == 'mssql' or db._dbname == 'mssql2':
+            skip = (attributes.get('limitby', None) or (0, ))[0]
+        rows = None
+        try:
+            while True:
+                batch = cursor.fetchmany(batch_size)
+                if not batch:
+                    break
+                if skip:
+                    (batch, skip) = (batch[skip:], max(0, skip
+                             - len(batch)))
+                    if not batch:
+                        continue
+                if rows is None:
+                    rows = SQLRows(db, batch, *colnames)
+                    rows._compile()
+                for values in batch:
+                    yield rows._decode(values)
+        finally:
+            cursor.close()
+
     def _count(self):
         return self._select('count(*)')
 
     def count(self):
         return self.select('count(*)').response[0][0]
 
-    def _delete(self):
+    def _delete(self, sql_w=None):
         if len(self._tables) != 1:
             raise SyntaxError, \
                 'SQLSet: unable to determine what to delete'
         tablename = self._tables[0]
-        if self.sql_w:
-            sql_w = ' WHERE ' + self.sql_w
-        else:
-            sql_w = ''
+        if sql_w is None:
+            sql_w = self.sql_w
+        if sql_w:
+            sql_w = ' WHERE ' + sql_w
         return 'DELETE FROM %s%s;' % (tablename, sql_w)
 
     def delete(self):
-        query = self._delete()
+        query = self._delete(self._bsql_w)
         self.delete_uploaded_files()
-        self._db['_lastsql'] = query
-        self._db._execute(query)
+        self._db._execute_bound(query, self._params, self._delete)
         try:
             return self._db._cursor.rowcount
         except:
             return None
 
     def _update(self, **update_fields):
+        return self._update_sql(update_fields, False)[0]
+
+    def _update_sql(self, update_fields, bind):
+        """
+        returns (query, params), with bind the values are SQL_PARAM in
+        query and their literals in params (None if it cannot be bound)
+        """
+
         tablenames = self._tables
         if len(tablenames) != 1:
             raise SyntaxError, 'SQLSet: unable to determine what to do'
@@ -1909,22 +2284,32 @@ class SQLSet(object):
                              for field in table.fields if not field
                               in update_fields and table[field].update
                               != None]))
-        sql_v = 'SET ' + ', '.join(['%s=%s' % (field,
-                                   sql_represent(value,
-                                   table[field].type, dbname))
-                                   for (field, value) in
-                                   update_fields.items()])
-        if self.sql_w:
-            sql_w = ' WHERE ' + self.sql_w
-        else:
-            sql_w = ''
-        return 'UPDATE %s %s%s;' % (sql_t, sql_v, sql_w)
+        (vs, params) = ([], [])
+        for (field, value) in update_fields.items():
+            if bind:
+                (text, p) = sql_parameter(value, table[field].type,
+                        dbname)
+                params += p
+            else:
+                text = sql_represent(value, table[field].type, dbname)
+            vs.append('%s=%s' % (field, text))
+        sql_v = 'SET ' + ', '.join(vs)
+        sql_w = self.sql_w
+        if bind:
+            sql_w = self._bsql_w
+            if self._params is None:
+                params = None
+            else:
+                params += self._params
+        if sql_w:
+            sql_w = ' WHERE ' + sql_w
+        return ('UPDATE %s %s%s;' % (sql_t, sql_v, sql_w), params)
 
     def update(self, **update_fields):
-        query = self._update(**update_fields)
+        (query, params) = self._update_sql(update_fields, True)
         self.delete_uploaded_files(update_fields)
-        self._db['_lastsql'] = query
-        self._db._execute(query)
+        self._db._execute_bound(query, params, lambda : \
+                                self._update(**update_fields))
         try:
             return self._db._cursor.rowcount
         except:
@@ -1952,8 +2337,8 @@ class SQLSet(object):
                 if upload_fields and oldname\
                      == upload_fields[fieldname]:
                     continue
-                oldpath = os.path.join(self._db._folder, '..', 'uploads'
-                        , oldname)
+                oldpath = locate(os.path.join(self._db._folder, '..',
+                                 'uploads'), oldname)
                 if os.path.exists(oldpath):
                     os.unlink(oldpath)
 
@@ -1964,11 +2349,106 @@ def update_record(t, s, a):
         t[str(key)] = value
 
 
+def decode_blob(value):
+    return base64.b64decode(str(value))
+
+
+def decode_boolean(value):
+    return value == True or value == 'T' or value == 't'
+
+
+def decode_date(value):
+    if isinstance(value, datetime.date):
+        return value
+    (y, m, d) = [int(x) for x in str(value)[:10].strip().split('-')]
+    return datetime.date(y, m, d)
+
+
+def decode_time(value):
+    if isinstance(value, datetime.time):
+        return value
+    time_items = [int(x) for x in str(value)[:8].strip().split(':')[:3]]
+    if len(time_items) == 3:
+        (h, mi, s) = time_items
+    else:
+        (h, mi, s) = time_items + [0]
+    return datetime.time(h, mi, s)
+
+
+def decode_datetime(value):
+    if isinstance(value, datetime.datetime):
+        return value
+    (y, m, d) = [int(x) for x in str(value)[:10].strip().split('-')]
+    time_items = [int(x) for x in str(value)[11:19].strip().split(':'
+                  )[:3]]
+    if len(time_items) == 3:
+        (h, mi, s) = time_items
+    else:
+        (h, mi, s) = time_items + [0]
+    return datetime.datetime(y, m, d, h, mi, s)
+
+
+# ## converters of the values read by SQLRows, by field type
+
+decoders = {
+    'blob': decode_blob,
+    'boolean': decode_boolean,
+    'date': decode_date,
+    'time': decode_time,
+    'datetime': decode_datetime,
+    }
+
+
+class SQLRecord(SQLStorage):
+
+    """
+    a record of SQLRows that includes the id of its table. update_record
+    and the SQLSets of the records referencing it (by their table name)
+    are created the first time they are used.
+    """
+
+    def __init__(self, db, table):
+        SQLStorage.__init__(self)
+        self.__dict__['_db'] = db
+        self.__dict__['_table'] = table
+
+    def __missing__(self, key):
+        (db, table) = (self.__dict__['_db'], self.__dict__['_table'])
+        id = dict.get(self, 'id', None)
+        if key == 'update_record':
+            s = db(table.id == id)
+            value = lambda **a: update_record(self, s, a)
+        else:
+            value = None
+            for (referee_table, referee_name) in table._referenced_by:
+                if referee_table == key:
+                    value = SQLSet(db, db[referee_table][referee_name]
+                                    == id)
+            if value is None:
+                raise KeyError, key
+        dict.__setitem__(self, key, value)
+        return value
+
+    def __reduce__(self):
+        """
+        a record is pickled (e.g. by cache.disk) as a SQLStorage of its
+        values, without the db, update_record and the SQLSets
+        """
+
+        return (SQLStorage, (dict([(key, value) for (key, value) in
+                self.items() if key != 'update_record'
+                and not isinstance(value, SQLSet)]), ))
+
+
 class SQLRows(object):
 
     """
     A wrapper for the retun value of a select. It basically represents a table.
     It has an iterator and each row is represented as a dictionary.
+
+    rows[i] is decoded once and the same object is returned every time,
+    so a change made to it is seen by the next rows[i]; iterating decodes
+    the rows not read by index into new objects.
     """
 
     # ## this class still needs some work to care for ID/OID
@@ -1982,6 +2462,8 @@ class SQLRows(object):
         self._db = db
         self.colnames = colnames
         self.response = response
+        self._plan = None
+        self._records = {}  # ## rows decoded by __getitem__
 
     def __nonzero__(self):
         if len(self.response):
@@ -1991,87 +2473,79 @@ class SQLRows(object):
     def __len__(self):
         return len(self.response)
 
-    def __getitem__(self, i):
-        if i >= len(self.response) or i < 0:
-            raise SyntaxError, 'SQLRows: no such row'
+    def _compile(self):
+        """
+        the plan to decode the rows, computed once: the columns of tables
+        with their table, field and decoder, and the other (_extra) ones
+        """
+
         if len(self.response[0]) != len(self.colnames):
             raise SyntaxError, 'SQLRows: internal error'
-        row = SQLStorage()
-        for j in xrange(len(self.colnames)):
-            value = self.response[i][j]
-            if isinstance(value, unicode):
-                value = value.encode('utf-8')
-            if not table_field.match(self.colnames[j]):
-                if not row.has_key('_extra'):
-                    row['_extra'] = SQLStorage()
-                row['_extra'][self.colnames[j]] = value
+        (columns, extra, tables) = ([], [], {})
+        for (j, colname) in enumerate(self.colnames):
+            if not table_field.match(colname):
+                extra.append((j, colname))
                 continue
-            (tablename, fieldname) = self.colnames[j].split('.')
+            (tablename, fieldname) = colname.split('.')
             table = self._db[tablename]
-            field = table[fieldname]
-            if not row.has_key(tablename):
-                row[tablename] = SQLStorage()
-            if field.type[:9] == 'reference':
-                referee = field.type[10:].strip()
-                rid = value
-                row[tablename][fieldname] = rid
-            elif field.type == 'blob' and value != None:
-
-                # row[tablename][fieldname]=SQLSet(self._db[referee].id==rid)
-
-                row[tablename][fieldname] = base64.b64decode(str(value))
-            elif field.type == 'boolean' and value != None:
-                if value == True or value == 'T' or value == 't':
-                    row[tablename][fieldname] = True
-                else:
-                    row[tablename][fieldname] = False
-            elif field.type == 'date' and value != None\
-                 and not isinstance(value, datetime.date):
-                (y, m, d) = [int(x) for x in
-                             str(value)[:10].strip().split('-')]
-                row[tablename][fieldname] = datetime.date(y, m, d)
-            elif field.type == 'time' and value != None\
-                 and not isinstance(value, datetime.time):
-                time_items = [int(x) for x in
-                              str(value)[:8].strip().split(':')[:3]]
-                if len(time_items) == 3:
-                    (h, mi, s) = time_items
-                else:
-                    (h, mi, s) = time_items + [0]
-                row[tablename][fieldname] = datetime.time(h, mi, s)
-            elif field.type == 'datetime' and value != None\
-                 and not isinstance(value, datetime.datetime):
-                (y, m, d) = [int(x) for x in
-                             str(value)[:10].strip().split('-')]
-                time_items = [int(x) for x in
-                              str(value)[11:19].strip().split(':')[:3]]
-                if len(time_items) == 3:
-                    (h, mi, s) = time_items
-                else:
-                    (h, mi, s) = time_items + [0]
-                row[tablename][fieldname] = datetime.datetime(y,m,d,h,mi,s)
-            else:
-                row[tablename][fieldname] = value
+            tables.setdefault(tablename, None)
             if fieldname == 'id':
-                id = row[tablename].id
-                row[tablename].update_record = lambda t=row[tablename], \
-                    s=self._db(table.id == id), **a: update_record(t,s, a)
-                for (referee_table, referee_name) in \
-                    table._referenced_by:
-                    s = self._db[referee_table][referee_name]
-                    row[tablename][referee_table] = SQLSet(self._db, s == id)
-        keys = row.keys()
-        if len(keys) == 1 and keys[0] != '_extra':
-            return row[row.keys()[0]]
+                tables[tablename] = table  # ## records get update_record
+            columns.append((j, tablename, fieldname,
+                           decoders.get(table[fieldname].type, None)))
+        self._plan = (columns, extra, tables.items())
+
+    def _decode(self, values):
+        (columns, extra, tables) = self._plan
+        records = {}
+        for (tablename, table) in tables:
+            if table:
+                records[tablename] = SQLRecord(self._db, table)
+            else:
+                records[tablename] = SQLStorage()
+        for (j, tablename, fieldname, decoder) in columns:
+            value = values[j]
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            if decoder and value != None:
+                value = decoder(value)
+            dict.__setitem__(records[tablename], fieldname, value)
+        if not extra and len(records) == 1:
+            return records.values()[0]
+        row = SQLStorage(records)
+        if extra:
+            row['_extra'] = SQLStorage()
+            for (j, colname) in extra:
+                value = values[j]
+                if isinstance(value, unicode):
+                    value = value.encode('utf-8')
+                row['_extra'][colname] = value
         return row
 
+    def __getitem__(self, i):
+        if i >= len(self.response) or i < 0:
+            raise SyntaxError, 'SQLRows: no such row'
+        if not i in self._records:
+            if self._plan is None:
+                self._compile()
+            self._records[i] = self._decode(self.response[i])
+        return self._records[i]
+
     def __iter__(self):
         """
         iterator over records
         """
 
-        for i in xrange(len(self)):
-            yield self[i]
+        if not self.response:
+            return
+        if self._plan is None:
+            self._compile()
+        records = self._records
+        for (i, values) in enumerate(self.response):
+            if i in records:
+                yield records[i]
+            else:
+                yield self._decode(values)
 
     def export_to_csv_file(self, ofile, null='<NULL>'):
         writer = csv.writer(ofile)
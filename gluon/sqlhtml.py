@@ -19,6 +19,7 @@ from html import *
 from validators import *
 from sql import SQLStorage, SQLDB
 from storage import Storage
+from fileutils import sharded, make_dirs
 
 table_field = re.compile('[\w_]+\.[\w_]+')
 re_extension = re.compile('\.\w+$')
@@ -519,8 +520,9 @@ class SQLFORM(FORM):
                     fields[fieldname] = newfilename
                     if field.uploadfield == True:
                         pathfilename = \
-                            os.path.join(self.table._db._folder,
-                                '../uploads/', newfilename)
+                            sharded(os.path.join(self.table._db._folder,
+                                '../uploads/'), newfilename)
+                        make_dirs(pathfilename)
                         dest_file = open(pathfilename, 'wb')
                         shutil.copyfileobj(source_file, dest_file)
                         dest_file.close()
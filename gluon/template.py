@@ -10,6 +10,7 @@ License: GPL v2
 import re
 import sys
 import os
+from fileutils import file_version
 
 __all__ = ['parse', 'reindent', 'parse_template']
 
@@ -30,6 +31,8 @@ re_include = re.compile('\{\{\s*include\s+(?P<name>.+?)\s*\}\}',
                         re.DOTALL)
 re_extend = re.compile('\{\{\s*extend\s+(?P<name>.+?)\s*\}\}',
                        re.DOTALL)
+re_cache = re.compile('^cache\((?P<args>.+)\):$', re.DOTALL)
+re_literal = re.compile(r'^[uU]?[rR]?(\'[^\'\\]*\'|"[^"\\]*")$')
 
 
 def reindent(text):
@@ -40,6 +43,12 @@ def reindent(text):
             continue
         if line[0] == '=':
             line = 'response.write(%s)' % line[1:]
+        elif re_cache.match(line):
+
+            # ## {{cache(key, time_expire, cache_model):}}...{{pass}}
+
+            line = 'for _fragment in cache.fragment(response, %s):' \
+                % re_cache.match(line).group('args')
         if re_block.match(line):
             k = (k + credit) - 1
         if k < 0:
@@ -84,18 +93,47 @@ def replace(
     return ''.join(output)
 
 
+def depend(dependencies, filename, name=None):
+    """
+    records that the template being parsed reads filename.
+    name is the expression that was evaluated to get the filename (if any),
+    when it is not a string literal the version is None because the
+    template depends on the context as well.
+    """
+
+    if dependencies is None:
+        return
+    if name and not re_literal.match(name.strip()):
+        dependencies.append((filename, None))
+    else:
+        try:
+            dependencies.append((filename, file_version(filename)))
+        except OSError:
+            dependencies.append((filename, None))
+
+
 def parse_template(
     filename,
     path='views/',
     cache='cache/',
     context=dict(),
+    dependencies=None,
     ):
+    """
+    parses the template in path/filename, and all the templates it
+    extends or includes, and returns the equivalent python code.
+    if dependencies is a list a (filename, version) tuple is appended to it
+    for every file read, see depend().
+    """
+
     import restricted
 
     # ## read the template
 
+    t = os.path.join(path, filename)
+    depend(dependencies, t)
     try:
-        text = open(os.path.join(path, filename), 'rb').read()
+        text = open(t, 'rb').read()
     except IOError:
         raise restricted.RestrictedError('Processing View ' + filename,
                 '', 'Unable to find the file')
@@ -107,6 +145,7 @@ def parse_template(
         if not match:
             break
         t = os.path.join(path, eval(match.group('name'), context))
+        depend(dependencies, t, match.group('name'))
         try:
             parent = open(t, 'rb').read()
         except IOError:
@@ -124,6 +163,7 @@ def parse_template(
         if not match:
             break
         t = os.path.join(path, eval(match.group('name'), context))
+        depend(dependencies, t, match.group('name'))
         try:
             child = open(t, 'rb').read()
         except IOError:
@@ -7,15 +7,34 @@
 
 import sys
 import os
+import time
+import threading
+import tempfile
+import shutil
+import cPickle
+import cStringIO
 sys.path.append(os.path.realpath('../'))
 
 import unittest
 from storage import Storage
-from cache import CacheInRam, CacheOnDisk
+from cache import CacheInRam, CacheOnDisk, Cache, MemcacheAbstract, \
+    CacheTiered, CacheInDb, RamStorage, page_rules, serve_page, \
+    store_page
+from http import HTTP
+from template import parse
+from globals import Response, Session
+from sql import SQLDB
+from utils import md5_hash
 
 
 class TestCache(unittest.TestCase):
 
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
     def testCacheInRam(self):
 
         # defaults to mode='http'
@@ -31,12 +50,62 @@ class TestCache(unittest.TestCase):
         self.assertEqual(cache('a', lambda : 3, 100), 3)
         self.assertEqual(cache('a', lambda : 4, 0), 4)
 
+    def testLimits(self):
+        cache = CacheInRam(Storage(application='lru'), max_entries=3)
+        for key in 'abc':
+            cache(key, lambda : key, 100)
+        cache('a', lambda : 'x', 100)
+        cache('d', lambda : 'd', 100)
+        self.assertEqual(cache.storage.keys(), ['c', 'a', 'd'])
+        self.assertEqual(cache('b', lambda : 'y', 100), 'y')
+
+        # the storage keeps the keys from the least recently used
+
+        storage = RamStorage()
+        for key in 'abcd':
+            storage[key] = key
+        storage.touch('b')
+        storage.touch('b')
+        storage['c'] = 'x'
+        del storage['a']
+        self.assertEqual(storage.keys(), ['c', 'd', 'b'])
+        self.assertEqual(storage.items()[0], ('c', 'x'))
+        storage.clear()
+        storage['e'] = 'e'
+        self.assertEqual((storage.keys(), storage.links.keys()), (['e'],
+                         ['e']))
+
+        # quotas are per application
+
+        other = CacheInRam(Storage(application='other'), max_bytes=1000)
+        for i in range(10):
+            other(str(i), lambda : 'x' * 300, 100)
+        self.assertEqual(len(other.storage), 3)
+        self.assertTrue(other.storage.bytes <= 1000)
+        self.assertEqual(len(CacheInRam(Storage(application='lru'
+                         )).storage), 3)
+
+    def testExpiry(self):
+        cache = CacheInRam(Storage(application='expiry'))
+        cache('a', lambda : 1, 0)
+        cache('b', lambda : 2, 100)
+        cache('c', lambda : 3, 0)
+        self.assertEqual(sorted(cache.storage.keys()), ['b', 'c'])
+        cache.increment('d')
+        cache('e', lambda : 4, 100)
+        self.assertEqual(sorted(cache.storage.keys()), ['b', 'd', 'e'])
+        for i in range(200):
+            cache.clear('b')
+            cache('b', lambda : i, 100)
+        self.assertTrue(len(cache.storage.deadlines) < 110)
+        self.assertEqual(cache('b', lambda : 0, 100), 199)
+
     def testCacheOnDisk(self):
 
         # defaults to mode='http'
 
         s = Storage({'application': 'admin', 'folder'
-                    : 'applications/admin'})
+                    : self.folder})
         cache = CacheOnDisk(s)
         self.assertEqual(cache('a', lambda : 1, 0), 1)
         self.assertEqual(cache('a', lambda : 2, 100), 1)
@@ -48,6 +117,540 @@ class TestCache(unittest.TestCase):
         self.assertEqual(cache('a', lambda : 3, 100), 3)
         self.assertEqual(cache('a', lambda : 4, 0), 4)
 
+    def concurrent(
+        self,
+        cache,
+        key,
+        value,
+        n=5,
+        time_expire=100,
+        ):
+        calls = []
+
+        def f():
+            calls.append(1)
+            time.sleep(0.1)
+            return value
+
+        results = []
+        threads = [threading.Thread(target=lambda : \
+                   results.append(cache(key, f, time_expire)))
+                   for i in range(n)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return (len(calls), results)
+
+    def testSingleFlight(self):
+        s = Storage({'application': 'admin', 'folder'
+                    : self.folder})
+        for cache in [CacheInRam(Storage(application='flight')),
+                      CacheOnDisk(s), FakeMemcacheClient(s)]:
+            cache.clear()
+            self.assertEqual(self.concurrent(cache, 'a', 1), (1, [1] * 5))
+
+            # while an expired key is computed the others get the old value
+
+            (calls, results) = self.concurrent(cache, 'a', 2, 3, 0)
+            self.assertEqual((calls, sorted(results)), (1, [1, 1, 2]))
+            cache.clear()
+
+    def testStaleWhileRevalidate(self):
+        cache = CacheInRam(Storage(application='stale'))
+        cache('a', lambda : 1, 100)
+        cache.storage['a'] = (time.time() - 10, 1, None)
+        self.assertEqual(cache('a', lambda : 2, 5,
+                         stale_while_revalidate=10), 1)
+        time.sleep(0.1)
+        self.assertEqual(cache('a', lambda : 3, 5), 2)
+        cache.storage['a'] = (time.time() - 20, 2, None)
+        self.assertEqual(cache('a', lambda : 4, 5,
+                         stale_while_revalidate=10), 4)
+
+        # expired entries are kept while they can be returned stale
+
+        s = Storage({'application': 'admin', 'folder'
+                    : self.folder})
+        disk = CacheOnDisk(s)
+        disk.expiry_bucket = 0.01
+        for cache in [CacheInRam(Storage(application='stale')), disk]:
+            cache('b', lambda : 1, 0, stale_while_revalidate=10)
+            cache('c', lambda : 1, 0)
+            time.sleep(0.05)
+            cache('d', lambda : 1, 100)
+            if cache is disk:
+                cache.sweep()
+                self.assertFalse(os.path.exists(cache._path('c')))
+            t0 = time.time()
+            self.assertEqual(cache('b', lambda : time.sleep(0.5) or 2,
+                             0, stale_while_revalidate=10), 1)
+            self.assertTrue(time.time() - t0 < 0.4)
+            time.sleep(0.7)
+            self.assertEqual(cache('b', lambda : 3, 100), 2)
+            cache.clear()
+
+    def testNestedDiskLocks(self):
+
+        # keys with the same md5 prefix do not share a lock
+
+        s = Storage({'application': 'admin', 'folder'
+                    : self.folder})
+        cache = CacheOnDisk(s)
+        cache.clear()
+        (a, i) = ('a', 0)
+        while True:
+            i += 1
+            b = 'b%i' % i
+            if md5_hash(a)[:2] == md5_hash(b)[:2]:
+                break
+        results = []
+        t = threading.Thread(target=lambda : results.append(cache(a,
+                             lambda : cache(b, lambda : 2, 100) + 1, 100)))
+        t.setDaemon(True)
+        t.start()
+        t.join(5)
+        self.assertEqual(results, [3])
+        self.assertEqual(os.listdir(os.path.join(cache.folder, '.locks'
+                         )), [])
+        cache.clear()
+
+    def testDiskFiles(self):
+        s = Storage({'application': 'admin', 'folder'
+                    : self.folder})
+        cache = CacheOnDisk(s)
+        cache.clear()
+        cache('a', lambda : 1, 100)
+        cache('b', lambda : 2, -100)
+        self.assertEqual(cache.increment('c'), 1)
+        self.assertEqual(cache.increment('c', 2), 3)
+        self.assertEqual(len(list(cache._files())), 3)
+        self.assertTrue(os.path.exists(cache._path('b')))
+        cache.sweep()
+        self.assertFalse(os.path.exists(cache._path('b')))
+        self.assertTrue(os.path.exists(cache._path('a')))
+        cache.clear('^c$')
+        self.assertEqual(list(cache._files()), [cache._path('a')])
+        self.assertEqual(cache('a', lambda : 2, 100), 1)
+
+    def testTags(self):
+        s = Storage({'application': 'admin', 'folder'
+                    : self.folder})
+        for model in [CacheInRam(Storage(application='tags')),
+                      CacheOnDisk(s), FakeMemcacheClient(s)]:
+            model.clear()
+            model('a', lambda : 1, 100, tags=['x', 'y'])
+            model('b', lambda : 2, 100, tags=['y'])
+            model('c', lambda : 3, 100)
+            model.invalidate_tags('x')
+            self.assertEqual(model('a', lambda : 4, 100), 4)
+            self.assertEqual(model('b', lambda : 5, 100), 2)
+            model.invalidate_tags('y', 'z')
+            self.assertEqual(model('a', lambda : 6, 100), 4)
+            self.assertEqual(model('b', lambda : 7, 100), 7)
+            self.assertEqual(model('c', lambda : 8, 100), 3)
+
+            # entries stored again without the tag are kept
+
+            model('d', lambda : 1, 100, tags=['x'])
+            model('d', None)
+            model('d', lambda : 2, 100)
+            model.invalidate_tags('x')
+            self.assertEqual(model('d', lambda : 3, 100), 2)
+            model.clear()
+        self.assertEqual(CacheInRam(Storage(application='tags'
+                         )).storage.tags, {})
+
+        # the lists of tags of the disk cache only hold existing entries
+
+        disk = CacheOnDisk(s)
+        disk.expiry_bucket = 0.01
+        disk('a', lambda : 1, 0, tags=['x', 'y'])
+        disk('b', lambda : 1, 100, tags=['x'])
+        disk._write('b', 2, 100, tags=['z'])
+        disk('c', lambda : 1, 100, tags=['w'])
+        disk('c', None)
+        time.sleep(0.05)
+        disk.sweep()
+        self.assertEqual(os.listdir(os.path.join(disk.folder, '.tags')),
+                         [md5_hash('z')])
+        disk.invalidate_tags('z')
+        self.assertEqual(os.listdir(os.path.join(disk.folder, '.tags')),
+                         [])
+
+        cache = Cache(s)
+        cache.memcache = FakeMemcacheClient(s)
+        cache.ram('a', lambda : 1, 100, tags=['x'])
+        cache.memcache('a', lambda : 1, 100, tags=['x'])
+        cache.invalidate_tags('x')
+        self.assertEqual(cache.ram('a', lambda : 2, 100), 2)
+        self.assertEqual(cache.memcache('a', lambda : 2, 100), 2)
+
+    def testTiered(self):
+        s = Storage({'application': 'admin', 'folder'
+                    : self.folder})
+        shared = FakeMemcacheClient(s)
+        shared.clear()
+        cache = CacheTiered(s, shared, local_expire=60)
+        cache.local.clear()
+        self.assertEqual(cache('a', lambda : 1, 100), 1)
+        self.assertTrue('a' in cache.local.storage)
+
+        # hits are served by the ram tier
+
+        shared._write('a', 2, 100)
+        self.assertEqual(cache('a', lambda : 3, 100), 1)
+        cache.local.storage['a'] = (time.time() - 61, ) \
+            + cache.local.storage['a'][1:]
+        self.assertEqual(cache('a', lambda : 3, 100), 2)
+        shared._write('a', 4, 100)
+        self.assertEqual(cache('a', lambda : 3, 100), 2)
+
+        # values found in the shared tier are promoted
+
+        other = CacheTiered(s, shared)
+        other.local.clear()
+        shared._write('b', 5, 100)
+        self.assertEqual(other('b', lambda : 6, 100), 5)
+        self.assertTrue('b' in other.local.storage)
+        cache.clear()
+        self.assertEqual(cache('a', lambda : 7, 100), 7)
+        self.assertEqual(shared.get('admin/a')[1], 7)
+        self.assertTrue(isinstance(Cache(s).tiered.shared, CacheOnDisk))
+        self.assertRaises(SyntaxError, cache.clear, '^a$')
+
+    def testLazyCache(self):
+        s = Storage({'application': 'admin', 'folder'
+                    : self.folder})
+        cache = Cache(s)
+        self.assertFalse('ram' in cache.__dict__)
+        self.assertTrue(isinstance(cache.ram, CacheInRam))
+        self.assertTrue(isinstance(cache.disk, CacheOnDisk))
+        self.assertTrue(cache.ram is cache.ram)
+
+    def testMemoize(self):
+        s = Storage({'application': 'admin', 'folder'
+                    : self.folder, 'args': [], 'vars'
+                    : Storage()})
+        cache = Cache(s)
+        calls = []
+
+        @cache.memoize(100)
+        def square(n, offset=0):
+            calls.append(n)
+            return n * n + offset
+
+        self.assertEqual(square(3), 9)
+        self.assertEqual(square(3), 9)
+        self.assertEqual(square(4), 16)
+        self.assertEqual(square(3, offset=1), 10)
+        self.assertEqual(calls, [3, 4, 3])
+        square.invalidate(3)
+        self.assertEqual(square(3), 9)
+        self.assertEqual(calls, [3, 4, 3, 3])
+        self.assertEqual(square.__name__, 'square')
+
+        # objects with the default repr differ per process, use key=
+
+        class Point(object):
+
+            def __init__(self, x):
+                self.x = x
+
+        @cache.memoize(100)
+        def norm(point):
+            return abs(point.x)
+
+        self.assertRaises(SyntaxError, norm, Point(-2))
+
+        @cache.memoize(100, key=lambda point: str(point.x))
+        def norm(point):
+            calls.append(point.x)
+            return abs(point.x)
+
+        del calls[:]
+        self.assertEqual(norm(Point(-2)), 2)
+        self.assertEqual(norm(Point(-2)), 2)
+        self.assertEqual(calls, [-2])
+        norm.invalidate(Point(-2))
+        self.assertEqual(norm(Point(-2)), 2)
+        self.assertEqual(calls, [-2, -2])
+
+        # actions are cached per request.args and request.vars
+
+        @cache.memoize(100, request_args=True)
+        def index():
+            calls.append(s.args[:])
+            return dict(args=s.args[:])
+
+        del calls[:]
+        s.args = ['a']
+        index()
+        index()
+        s.args = ['b']
+        index()
+        s.vars.page = '2'
+        index()
+        self.assertEqual(calls, [['a'], ['b'], ['b']])
+        index.invalidate('a')
+        s.args = ['a']
+        s.vars = Storage()
+        self.assertEqual(index(), dict(args=['a']))
+        self.assertEqual(len(calls), 4)
+
+    def testPage(self):
+
+        def request(page=None, language=None):
+            return Storage(application='admin', controller='default',
+                           function='index', args=['a'],
+                           get_vars=Storage(page=page, other=1),
+                           env=Storage(request_method='GET',
+                           http_accept_language=language))
+
+        response = Storage(_cache_page=Storage(time_expire=100,
+                           cache_model=None, vars=['page'],
+                           vary=['Accept-Language'], session=False,
+                           tags=None))
+        store_page(request(), response, HTTP(200, 'first'))
+        self.assertEqual(serve_page(request()).body, 'first')
+        self.assertEqual(serve_page(request(page=2)), None)
+        self.assertEqual(serve_page(request(language='it')), None)
+        store_page(request(page=2), response, HTTP(200, 'second'))
+        self.assertEqual(serve_page(request(page=2)).body, 'second')
+        store_page(request(page=3), response, HTTP(404, 'missing'))
+        self.assertEqual(serve_page(request(page=3)), None)
+
+        # pages setting cookies or using the session are not shared
+
+        session = Session()
+        response.session_id_name = 'session_id_admin'
+        response._session = session
+        response.session_hash = md5_hash(cPickle.dumps({}))
+        response.cookies = {'session_id_admin': 'x', 'theme': 'dark'}
+        store_page(request(page=4), response, HTTP(200, 'cookie'))
+        self.assertEqual(serve_page(request(page=4)), None)
+        del response.cookies['theme']
+        session.user = 'me'
+        store_page(request(page=4), response, HTTP(200, 'user'))
+        self.assertEqual(serve_page(request(page=4)), None)
+        response.session_hash = md5_hash(cPickle.dumps(dict(session)))
+        store_page(request(page=4), response, HTTP(200, 'user'))
+        self.assertEqual(serve_page(request(page=4)), None)
+        session.__dict__['_loader'] = lambda : None
+        store_page(request(page=4), response, HTTP(200, 'fourth'))
+        self.assertEqual(serve_page(request(page=4)).body, 'fourth')
+
+        # the page is no longer cached once the action stops caching it
+
+        store_page(request(), Storage(), HTTP(200, 'third'))
+        self.assertEqual(page_rules, {})
+        self.assertEqual(serve_page(request()), None)
+
+    def testFragment(self):
+        s = Storage({'application': 'admin', 'folder'
+                    : self.folder})
+        cache = Cache(s)
+        cache.ram.clear()
+        code = parse('<ul>{{cache("menu", 100):}}{{for i in items:}}'
+                     '<li>{{=i}}</li>{{pass}}{{pass}}</ul>')
+
+        def render(items):
+            response = Response()
+            exec code in dict(response=response, cache=cache,
+                              items=items)
+            return response.body.getvalue()
+
+        self.assertEqual(render([1, 2]), '<ul><li>1</li><li>2</li></ul>')
+        self.assertEqual(render([3]), '<ul><li>1</li><li>2</li></ul>')
+        cache.ram('menu', None)
+        self.assertEqual(render([3]), '<ul><li>3</li></ul>')
+
+    def testCacheInDb(self):
+        db = SQLDB('sqlite:memory:')
+        cache = CacheInDb(Storage(application='admin'), db)
+        self.assertEqual(cache('a', lambda : [1, 2], 100), [1, 2])
+        self.assertEqual(cache('a', lambda : 3, 100), [1, 2])
+        self.assertEqual(cache('a', lambda : 3, 0), 3)
+        self.assertEqual(db(db.web2py_cache.id > 0).count(), 1)
+        self.assertEqual(cache.increment('i'), 1)
+        self.assertEqual(cache.increment('i', 2), 3)
+
+        # keys are per application, the table is shared
+
+        other = CacheInDb(Storage(application='other'), db)
+        self.assertEqual(other('a', lambda : 4, 100), 4)
+        self.assertEqual(cache('a', lambda : 5, 100), 3)
+        cache.clear('^i$')
+        self.assertEqual(cache.increment('i'), 1)
+        cache('t', lambda : 't', 100, tags=['x'])
+        cache.invalidate_tags('x')
+        self.assertEqual(cache('t', lambda : 'u', 100, tags=['x']), 'u')
+        cache('e', lambda : 'e', -1, tags=['x'])
+        cache.sweep()
+        self.assertEqual(cache._read('e'), None)
+        self.assertEqual(cache.stats().entries, 2)  # ## i and t
+        self.assertEqual(cache.stats().bytes, len(cPickle.dumps(1, 2))
+                         + len(cPickle.dumps('u', 2)))
+        tag_table = db.web2py_cache_tag
+        self.assertEqual(db(tag_table.id > 0).count(), 1)  # ## t only
+
+        # tags are matched exactly, and are replaced on write
+
+        cache('y', lambda : 'y', 100, tags=['x%'])
+        cache.invalidate_tags('%')
+        self.assertEqual(cache._read('y')[1], 'y')
+        cache('t', lambda : 'v', 0, tags=['z'])
+        cache.invalidate_tags('x')
+        self.assertEqual(cache._read('t')[1], 'v')
+        cache.invalidate_tags('z', 'x%')
+        self.assertEqual((cache._read('t'), cache._read('y')), (None,
+                         None))
+        self.assertEqual(db(tag_table.id > 0).count(), 0)
+
+        # a record inserted meanwhile is updated, the key is unique
+
+        table = db.web2py_cache
+        self.assertFalse(cache._insert(table, application='admin',
+                         cache_key='i', key_hash=cache._hash('i')))
+        self.assertEqual(cache.increment('i'), 2)
+        indexes = [row[0] for row in
+                   db.executesql('SELECT name FROM sqlite_master;')]
+        self.assertTrue('web2py_cache_deadline' in indexes)
+        self.assertTrue('web2py_cache_tag_tag_hash_key_hash' in indexes)
+        cache.clear()
+        self.assertEqual(other('a', lambda : 6, 100), 4)
+        self.assertEqual(cache.stats().entries, 0)
+
+        # the db of the request is not used by other threads or requests
+
+        cache('s', lambda : 1, 100)
+        self.assertEqual(cache('s', lambda : 2, 0,
+                         stale_while_revalidate=100), 2)
+        self.assertRaises(SyntaxError, Response().cache_page,
+                          cache_model=cache)
+        self.assertTrue(CacheTiered(Storage(application='admin'),
+                        cache).request_scoped)
+
+    def testStats(self):
+        cache = CacheInRam(Storage(application='stats'), max_entries=2)
+        cache.clear()
+        cache.meta_stats.clear()
+        cache('/stats/a', lambda : 'a', 100)
+        cache('/stats/a', lambda : 'x', 100)
+        cache('/stats/b', lambda : 'b', 100)
+        cache('query:1', lambda : 'c', 100)
+        stats = cache.stats()
+        self.assertEqual((stats.hits, stats.misses, stats.evictions),
+                         (1, 3, 1))
+        self.assertEqual(stats.prefixes['/stats'].count, 2)
+        self.assertEqual(stats.prefixes['query'].count, 1)
+        self.assertEqual(stats.entries, 2)
+        self.assertTrue(stats.bytes > 0)
+
+        # counters are per application and model
+
+        self.assertEqual(CacheInRam(Storage(application='other'
+                         )).stats().hits, 0)
+        s = Storage({'application': 'admin', 'folder'
+                    : self.folder})
+        disk = CacheOnDisk(s)
+        disk.clear()
+        disk('a', lambda : 'a', 100)
+        stats = Cache(s).stats()
+        self.assertEqual(stats['disk'].misses, 1)
+        self.assertEqual(stats['disk'].entries, 1)
+        self.assertTrue(stats['disk'].bytes > 0)
+        disk.clear()
+
+
+class TestPageThroughMain(unittest.TestCase):
+
+    """
+    response.cache_page as used by actions, through gluon.main.wsgibase
+    """
+
+    def setUp(self):
+        self.app = 'test_page_%i' % os.getpid()
+        self.folder = os.path.join('applications', self.app)
+        os.makedirs(os.path.join(self.folder, 'controllers'))
+        open(os.path.join(self.folder, 'controllers', 'default.py'), 'w'
+             ).write("""import time
+def index():
+    response.cache_page(100, vary=['Accept-Language'])
+    return repr(time.time())
+def counter():
+    response.cache_page(100)
+    session.counter = (session.counter or 0) + 1
+    return repr(time.time())
+""")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def call(self, function, cookie=None):
+        from main import wsgibase
+        environ = {
+            'PATH_INFO': '/%s/default/%s' % (self.app, function),
+            'REQUEST_METHOD': 'GET',
+            'QUERY_STRING': '',
+            'REMOTE_ADDR': '127.0.0.1',
+            'HTTP_ACCEPT_LANGUAGE': 'en',
+            'wsgi.input': cStringIO.StringIO(''),
+            }
+        if cookie:
+            environ['HTTP_COOKIE'] = cookie
+        status = []
+        body = wsgibase(environ, lambda s, h: status.append(s))
+        self.assertEqual(status[0][:3], '200')
+        return ''.join(body)
+
+    def testCookieless(self):
+        first = self.call('index')
+        time.sleep(0.01)
+        self.assertEqual(self.call('index'), first)
+
+    def testSessionChanged(self):
+        first = self.call('counter')
+        time.sleep(0.01)
+        self.assertNotEqual(self.call('counter'), first)
+
+
+class FakeMemcacheClient(MemcacheAbstract):
+
+    """
+    in-process stand-in for gluon.contrib.memcache.MemcacheClient
+    """
+
+    data = {}
+    locker = threading.Lock()
+
+    def __init__(self, request):
+        self.request = request
+
+    def get(self, key):
+        return self.data.get(key, None)
+
+    def set(self, key, value, time=0):
+        self.data[key] = value
+        return True
+
+    def add(self, key, value, time=0):
+        self.locker.acquire()
+        try:
+            if key in self.data:
+                return False
+            self.data[key] = value
+            return True
+        finally:
+            self.locker.release()
+
+    def delete(self, key):
+        self.data.pop(key, None)
+        return 1
+
+    def flush_all(self):
+        self.data.clear()
+
 
 if __name__ == '__main__':
     oldpwd = os.getcwd()
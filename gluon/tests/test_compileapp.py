@@ -0,0 +1,199 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+    Unit tests for gluon.compileapp
+"""
+
+import sys
+import os
+import types
+import tempfile
+import shutil
+sys.path.append(os.path.realpath('../'))
+
+import unittest
+from compileapp import getcfs, getcfv, compile2, cfs_stats, \
+    app_manifest, file_exists, unfreeze, build_environment
+from template import parse_template
+from storage import Storage
+from globals import Response
+from restricted import restricted, RestrictedError
+
+
+class TestCompiledFileCache(unittest.TestCase):
+
+    def setUp(self):
+        (fd, self.filename) = tempfile.mkstemp(suffix='.py')
+        os.write(fd, 'a = 1\n')
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.filename)
+
+    def testGetcfs(self):
+        filename = self.filename
+        calls = []
+
+        def filter():
+            calls.append(1)
+            return compile2(open(filename).read(), filename)
+
+        (hits, misses) = (cfs_stats['hits'], cfs_stats['misses'])
+        item = getcfs(filename, filename, filter)
+        self.assertEqual((type(item[0]), item[1]), (types.CodeType,
+                         'a = 1\n'))
+        self.assertEqual(getcfs(filename, filename, filter), item)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(cfs_stats['hits'], hits + 1)
+        self.assertEqual(cfs_stats['misses'], misses + 1)
+
+        # a new mtime invalidates the cached code
+
+        t = os.stat(filename).st_mtime
+        os.utime(filename, (t + 10, t + 10))
+        getcfs(filename, filename, filter)
+        self.assertEqual(len(calls), 2)
+
+        # and so do edits saved within the same second
+
+        os.utime(filename, (t + 10.5, t + 10.5))
+        getcfs(filename, filename, filter)
+        self.assertEqual(len(calls), 3)
+        open(filename, 'w').write('a = 12\n')
+        os.utime(filename, (t + 10.5, t + 10.5))
+        self.assertEqual(getcfs(filename, filename, lambda : \
+                         open(filename).read()), 'a = 12\n')
+
+    def testCompile2(self):
+        self.assertEqual(type(compile2('a = 1', 'test')[0]),
+                         types.CodeType)
+        self.assertEqual(compile2('a = ', 'test'), ('a = ', 'a = '))
+
+        # tickets show the source compiled, whose lines match the traceback
+
+        (code, source) = compile2('a = 1\nb = a / 0\n', 'test')
+        try:
+            restricted(code, {}, 'test', source)
+        except RestrictedError, e:
+            self.assertEqual(e.code, source)
+            self.assertTrue('line 2' in e.traceback)
+        else:
+            self.fail('no RestrictedError')
+
+
+class TestCompiledViewCache(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        open(os.path.join(self.path, 'layout.html'), 'w'
+             ).write('<b>{{include}}</b>')
+        open(os.path.join(self.path, 'index.html'), 'w'
+             ).write("{{extend 'layout.html'}}{{=x}}")
+        open(os.path.join(self.path, 'dynamic.html'), 'w'
+             ).write('{{extend layout}}{{=x}}')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def render(self, view, context={}):
+        calls = []
+
+        def filter(dependencies):
+            calls.append(1)
+            return compile2(parse_template(view, self.path,
+                            context=context,
+                            dependencies=dependencies), view)
+
+        return (getcfv(os.path.join(self.path, view), filter), calls)
+
+    def testDependencies(self):
+        dependencies = []
+        parse_template('index.html', self.path,
+                       dependencies=dependencies)
+        self.assertEqual([os.path.basename(f) for (f, t) in
+                         dependencies], ['index.html', 'layout.html'])
+        dependencies = []
+        parse_template('dynamic.html', self.path,
+                       context=dict(layout='layout.html'),
+                       dependencies=dependencies)
+        self.assertEqual(dependencies[1][1], None)
+
+    def testGetcfv(self):
+        (code, calls) = self.render('index.html')
+        self.assertEqual(type(code[0]), types.CodeType)
+        self.assertTrue('response.write' in code[1])  # ## not the html
+        self.assertEqual(self.render('index.html'), (code, []))
+
+        # touching the layout invalidates the view that extends it
+
+        filename = os.path.join(self.path, 'layout.html')
+        t = os.stat(filename).st_mtime
+        os.utime(filename, (t + 10, t + 10))
+        self.assertEqual(self.render('index.html')[1], [1])
+
+        # views that extend a computed name are never cached
+
+        context = dict(layout='layout.html')
+        self.assertEqual(self.render('dynamic.html', context)[1], [1])
+        self.assertEqual(self.render('dynamic.html', context)[1], [1])
+
+
+class TestFrozen(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp() + '/'
+        for path in ['models', 'controllers', 'views/default']:
+            os.makedirs(os.path.join(self.folder, path))
+        open(os.path.join(self.folder, 'models/db.py'), 'w').write('')
+        open(os.path.join(self.folder, 'controllers/default.py'), 'w'
+             ).write('def index(): return 1')
+        open(os.path.join(self.folder, 'views/default/index.html'), 'w'
+             ).write('')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+        unfreeze()
+
+    def testManifest(self):
+        self.assertEqual(app_manifest(self.folder), None)
+        open(os.path.join(self.folder, 'FROZEN'), 'w').write('')
+
+        # the result is kept until unfreeze()
+
+        self.assertEqual(app_manifest(self.folder), None)
+        unfreeze()
+        manifest = app_manifest(self.folder)
+        self.assertEqual(manifest.compiled, False)
+        self.assertEqual(manifest.models, [os.path.join(self.folder,
+                         'models/db.py')])
+        filename = os.path.join(self.folder, 'views/', 'default/index.html')
+        self.assertTrue(file_exists(filename, manifest))
+        os.unlink(filename)
+        self.assertTrue(file_exists(filename, manifest))
+        self.assertFalse(file_exists(filename))
+
+
+class TestEnvironment(unittest.TestCase):
+
+    def testBuildEnvironment(self):
+        request = Storage(folder=tempfile.gettempdir(),
+                          env=Storage(http_accept_language='it'))
+        response = Response()
+        environment = build_environment(request, response, Storage())
+
+        # T reads request.env only when it is called
+
+        T = environment['T']
+        self.assertFalse('http_accept_language' in T.__dict__)
+        self.assertEqual(str(T('hello')), 'hello')
+        self.assertEqual(T.http_accept_language, 'it')
+
+        # the view environment is a copy
+
+        response._view_environment['x'] = 1
+        self.assertFalse('x' in environment)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -10,8 +10,9 @@ sys.path.append(os.path.realpath('../'))
 
 import unittest
 import datetime
+import cPickle
 from sql import *
-from sql import SQLTable, SQLALL
+from sql import SQLTable, SQLALL, SQLStorage
 
 ALLOWED_DATATYPES = [
     'string',
@@ -408,17 +409,147 @@ class TestMinMaxSum(unittest.TestCase):
         db.t.drop()
 
 
-#class TestCache(unittest.
-#    def testRun(self):
-#        cache = cache.ram
-#        db = SQLDB('sqlite:memory:')
-#        db.define_table('t', db.Field('a'))
-#        db.t.insert(a='1')
-#        r1 = db().select(db.t.ALL, cache=(cache, 1000))
-#        db.t.insert(a='1')
-#        r2 = db().select(db.t.ALL, cache=(cache, 1000))
-#        self.assertEqual(r1.response, r2.response)
-#        db.t.drop()
+class TestCache(unittest.TestCase):
+
+    def testRun(self):
+        from cache import CacheInRam
+        cache = CacheInRam()
+        db = SQLDB('sqlite:memory:')
+        db.define_table('t', db.Field('a'))
+        db.t.insert(a='1')
+        r1 = db().select(db.t.ALL, cache=(cache, 1000))
+        db.t.insert(a='1')
+        r2 = db().select(db.t.ALL, cache=(cache, 1000))
+        self.assertEqual(r1.response, r2.response)
+        cache.clear()
+        r1 = db().select(db.t.ALL, cache=(cache, 1000, ['t']))
+        db.t.insert(a='1')
+        cache.invalidate_tags('t')
+        r2 = db().select(db.t.ALL, cache=(cache, 1000, ['t']))
+        self.assertEqual(len(r2), 3)
+        db.t.drop()
+
+
+class TestRows(unittest.TestCase):
+
+    def testRun(self):
+        db = SQLDB('sqlite:memory:')
+        db.define_table('person', db.Field('name'), db.Field('born',
+                        'date'), db.Field('alive', 'boolean'))
+        db.define_table('dog', db.Field('name'), db.Field('owner',
+                        db.person))
+        db.person.insert(name='max', born=datetime.date(1971, 1, 2),
+                         alive=True)
+        db.dog.insert(name='rex', owner=1)
+        rows = db(db.person.id > 0).select()
+        self.assertEqual(rows[0] is rows[0], True)
+        self.assertEqual(sorted(rows[0].keys()), ['alive', 'born', 'id',
+                         'name'])
+        self.assertEqual((rows[0].born, rows[0].alive),
+                         (datetime.date(1971, 1, 2), True))
+        self.assertEqual(rows[0].dog.count(), 1)
+        rows[0].update_record(name='tom')
+        self.assertEqual(rows[0].name, 'tom')
+        self.assertEqual(db(db.person.id == 1).select()[0].name, 'tom')
+        self.assertRaises(KeyError, lambda : rows[0].cat)
+        record = cPickle.loads(cPickle.dumps(rows[0], 2))
+        self.assertEqual((record.__class__, record), (SQLStorage,
+                         {'id': 1, 'name': 'tom', 'born'
+                         : datetime.date(1971, 1, 2), 'alive': True}))
+        rows = db(db.person.id == db.dog.owner).select(db.person.name,
+                db.dog.name)
+        self.assertEqual([(row.person.name, row.dog.name) for row in
+                         rows], [('tom', 'rex')])
+        self.assertEqual(db(db.person.id > 0).select(db.person.name)[0],
+                         {'name': 'tom'})
+        db.dog.drop()
+        db.person.drop()
+
+
+class TestIterselect(unittest.TestCase):
+
+    def testRun(self):
+        db = SQLDB('sqlite:memory:')
+        db.define_table('t', db.Field('a', 'integer'))
+        db.t.bulk_insert([dict(a=i) for i in range(10)])
+        names = [row.a for row in db(db.t.a < 7).iterselect(orderby=db.t.a,
+                 batch_size=3)]
+        self.assertEqual(names, range(7))
+        for row in db(db.t.id > 0).iterselect(batch_size=4):
+            row.update_record(a=row.a + 1)
+        self.assertEqual(db(db.t.a == 10).count(), 1)
+        rows = db(db.t.id > 0).iterselect(db.t.a, limitby=(2, 5),
+                orderby=db.t.a)
+        self.assertEqual(rows.next(), {'a': 3})
+        self.assertEqual(db(db.t.a == 1).count(), 1)  # ## on db._cursor
+        self.assertEqual(rows.next(), {'a': 4})
+        rows.close()
+        self.assertEqual(list(db(db.t.a > 100).iterselect()), [])
+        db.t.drop()
+
+
+class TestReturning(unittest.TestCase):
+
+    def testRun(self):
+        for (dbname, query) in [('postgres',
+                                "INSERT INTO t(a) VALUES ('x') RETURNING id;"
+                                ), ('mssql',
+                                "INSERT INTO t(a) OUTPUT INSERTED.id VALUES ('x');"
+                                ), ('oracle',
+                                "INSERT INTO t(a) VALUES ('x');")]:
+            db = SQLDB('None')
+            db['_dbname'] = dbname
+            db.define_table('t', db.Field('a'))
+            self.assertEqual(db.t._returning(db.t._insert(a='x')), query)
+
+
+class TestBulkInsert(unittest.TestCase):
+
+    def testRun(self):
+        db = SQLDB('sqlite:memory:')
+        db.define_table('t', db.Field('a'), db.Field('b', 'integer'))
+        self.assertEqual(db.t.insert(a='x'), 1)
+        items = [dict(a=str(i), b=i) for i in range(600)] + [dict(b=1),
+                 dict(a='\xff')]
+        ids = db.t.bulk_insert(items, batch_size=100)
+        self.assertEqual(ids, range(2, 604))
+        self.assertEqual(db(db.t.id > 0).count(), 603)
+        self.assertEqual(db(db.t.id == ids[42]).select()[0].a, '42')
+        self.assertEqual(db(db.t.id == 602).select()[0].a, None)
+        self.assertEqual(db.t.bulk_insert([]), [])
+        db.t.drop()
+
+
+class TestParameters(unittest.TestCase):
+
+    def testRun(self):
+        db = SQLDB('sqlite:memory:')
+        db.define_table('t', db.Field('a'), db.Field('b', 'integer'),
+                        db.Field('c', 'blob'))
+        value = "it's 50%, caff\xc3\xa8"
+        self.assertEqual(db.t.insert(a=value, b=1, c='\x00\xff'), 1)
+        self.assertEqual(db._lastsql,
+                         'INSERT INTO t(a, b, c) VALUES (?, ?, ?);')
+        rows = db((db.t.a == value) & db.t.b.belongs([1, 2])).select()
+        self.assertEqual(db._lastsql,
+                         'SELECT t.id, t.a, t.b, t.c FROM t WHERE (t.a=? AND t.b IN (?,?));'
+                         )
+        self.assertEqual((rows[0].a, rows[0].c), (value, '\x00\xff'))
+        db(db.t.id == 1).update(b=db.t.b + 1)
+        self.assertEqual(db._lastsql,
+                         'UPDATE t SET b=(t.b+1) WHERE t.id=?;')
+        self.assertEqual(db(db.t.b == 2).count(), 1)
+        self.assertEqual(db(db.t.a == '\x00').count(), 0)
+
+        # _select and the other methods returning SQL inline the values
+
+        self.assertEqual(db(db.t.a == "'")._select(db.t.id),
+                         "SELECT t.id FROM t WHERE t.a='''';")
+        self.assertEqual(db(db.t.id.belongs(db(db.t.b
+                         == 2)._select(db.t.id))).count(), 1)
+        db(db.t.id > 0).delete()
+        self.assertEqual(db._lastsql, 'DELETE FROM t WHERE t.id>?;')
+        db.t.drop()
 
 
 class TestMigrations(unittest.TestCase):
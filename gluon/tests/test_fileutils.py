@@ -0,0 +1,63 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+    Unit tests for gluon.fileutils
+"""
+
+import sys
+import os
+import shutil
+import tempfile
+sys.path.append(os.path.realpath('../'))
+
+import unittest
+import fileutils
+from fileutils import sharded, locate, make_dirs, reshard
+
+
+class TestSharding(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        fileutils.shard_levels = 0
+        shutil.rmtree(self.path)
+
+    def touch(self, path):
+        make_dirs(path)
+        open(path, 'w').close()
+
+    def testSharded(self):
+        self.assertEqual(sharded('a', 'x'), os.path.join('a', 'x'))
+        path = sharded('a', 'x', 2)
+        self.assertEqual(path.split(os.sep)[-1], 'x')
+        self.assertEqual(len(path.split(os.sep)), 4)
+        self.assertEqual(path, sharded('a', 'x', 2))
+        fileutils.shard_levels = 2
+        self.assertEqual(sharded('a', 'x'), path)
+
+    def testLocate(self):
+        flat = os.path.join(self.path, 'x')
+        self.touch(flat)
+        fileutils.shard_levels = 1
+        self.assertEqual(locate(self.path, 'x'), flat)
+        self.assertEqual(locate(self.path, 'y'), sharded(self.path, 'y'))
+
+    def testReshard(self):
+        names = ['s%i' % i for i in range(20)]
+        for name in names:
+            self.touch(os.path.join(self.path, name))
+        self.touch(os.path.join(self.path, '.keep'))
+        self.assertEqual(reshard(self.path, 2), 20)
+        for name in names:
+            self.assertTrue(os.path.exists(sharded(self.path, name, 2)))
+        self.assertEqual(reshard(self.path, 2), 0)
+        self.assertEqual(reshard(self.path, 0), 20)
+        self.assertEqual(sorted(os.listdir(self.path)), sorted(names
+                          + ['.keep']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,490 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+    Unit tests for gluon.globals
+"""
+
+import sys
+import os
+import cStringIO
+import shutil
+import tempfile
+import time
+import datetime
+import base64
+import cPickle
+sys.path.append(os.path.realpath('../'))
+
+import unittest
+from globals import Request, Response, Session, Environ, \
+    DBSessionStore, MemcacheSessionStore, sweep_sessions
+import globals
+from sql import SQLDB
+import fileutils
+from storage import Storage
+from utils import hmac_hash
+
+
+def make_request(method='GET', query_string='', body='',
+                 content_type=None, cookie=None):
+    environ = {
+        'REQUEST_METHOD': method,
+        'QUERY_STRING': query_string,
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.input': cStringIO.StringIO(body),
+        }
+    if content_type:
+        environ['CONTENT_TYPE'] = content_type
+    if cookie:
+        environ['HTTP_COOKIE'] = cookie
+    request = Request()
+    request.env = Environ(environ)
+    return request
+
+
+class TestEnviron(unittest.TestCase):
+
+    def testLazyKeys(self):
+        env = Environ({'PATH_INFO': '/a', 'wsgi.url_scheme': 'http',
+                      'Mixed.Case': 1})
+        self.assertEqual(env.path_info, '/a')
+        self.assertEqual(dict.keys(env), ['path_info'])
+        self.assertEqual(env['wsgi_url_scheme'], 'http')
+        self.assertEqual(env.get('http_host', 'x'), 'x')
+        self.assertFalse('http_host' in env)
+        self.assertEqual(env.http_host, None)
+        self.assertEqual(env.mixed_case, 1)
+        self.assertEqual(sorted(env.keys()), ['mixed_case', 'path_info'
+                         , 'wsgi_url_scheme'])
+
+    def testSetBeforeLoad(self):
+        env = Environ({'PATH_INFO': '/a'})
+        env.path_info = '/b'
+        self.assertEqual(env.items(), [('path_info', '/b')])
+
+
+class TestRequest(unittest.TestCase):
+
+    def testGet(self):
+        request = make_request(query_string='a=1&b=2&b=3')
+        self.assertFalse(dict.has_key(request, 'body'))
+        self.assertEqual(request.vars, {'a': '1', 'b': ['2', '3']})
+        self.assertEqual(request.get_vars.a, '1')
+        self.assertEqual(request.post_vars, {})
+        self.assertFalse(dict.has_key(request, 'body'))
+        self.assertEqual(request.body.read(), '')
+
+    def testPost(self):
+        request = make_request('POST', 'a=1', 'b=2&c=3',
+                               'application/x-www-form-urlencoded')
+        self.assertEqual(request.vars, {'a': '1', 'b': '2', 'c': '3'})
+        self.assertEqual(request.post_vars.b, '2')
+        self.assertEqual(request.body.read(), 'b=2&c=3')
+
+    def testBodyReadFirst(self):
+        request = make_request('POST', '', 'b=2&c=3',
+                               'application/x-www-form-urlencoded')
+        self.assertEqual(request.body.read(), 'b=2&c=3')
+        self.assertEqual(request.post_vars, {'b': '2', 'c': '3'})
+        self.assertEqual(request.body.read(), 'b=2&c=3')
+
+    def testMultipart(self):
+        body = '\r\n'.join([
+            '--xxx',
+            'Content-Disposition: form-data; name="a"',
+            '',
+            'hello',
+            '--xxx',
+            'Content-Disposition: form-data; name="f"; filename="f.txt"',
+            'Content-Type: text/plain',
+            '',
+            'world',
+            '--xxx--',
+            '',
+            ])
+        request = make_request('POST', body=body,
+                               content_type='multipart/form-data; boundary=xxx')
+        self.assertEqual(request.vars.a, 'hello')
+        self.assertEqual(request.vars.f.filename, 'f.txt')
+        self.assertEqual(request.vars.f.file.read(), 'world')
+
+    def testCookies(self):
+        request = make_request(cookie='a=1; b=2')
+        self.assertEqual(request.cookies['b'].value, '2')
+        self.assertEqual(len(make_request().cookies), 0)
+
+    def testListing(self):
+        request = make_request(query_string='a=1')
+        self.assertTrue('vars' in list(request))
+        self.assertTrue('body' in request.keys())
+
+
+class TestSession(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.path, 'app', 'sessions'))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def connect(self, cookie=None, **attributes):
+        request = make_request(cookie=cookie)
+        request.application = 'app'
+        request.folder = os.path.join(self.path, 'app') + '/'
+        request.client = '127.0.0.1'
+        request.now = datetime.datetime.now()
+        (response, session) = (Response(), Session())
+        session.connect(request, response, **attributes)
+        return (request, response, session)
+
+    def store(self, request, response, session):
+        session._try_store_in_cookie(request, response)
+        session._try_store_in_db(request, response)
+        session._try_store_on_disk(request, response)
+        return 'session_id_app=%s' % response.session_id
+
+    def files(self):
+        return [name for name in os.listdir(os.path.join(self.path,
+                'app', 'sessions')) if not name.startswith('.')]
+
+    def testLazySession(self):
+
+        # a session that is not used is not stored
+
+        (request, response, session) = self.connect()
+        self.store(request, response, session)
+        self.assertEqual(self.files(), [])
+
+        session.a = 1
+        session.flash = 'hello'
+        cookie = self.store(request, response, session)
+        self.assertEqual(len(self.files()), 1)
+        filename = response.session_filename
+
+        # the file is not opened unless the session is used
+
+        (request, response, session) = self.connect(cookie)
+        self.assertEqual(response.session_file, None)
+        self.assertEqual(dict(session), {})
+        self.assertEqual(response.flash, 'hello')
+        self.assertEqual(session.a, 1)
+        self.assertEqual(session.flash, None)
+        self.assertNotEqual(response.session_file, None)
+        self.store(request, response, session)
+
+        # an unchanged session is not written back
+
+        os.utime(filename, (0, 0))
+        (request, response, session) = self.connect(cookie)
+        self.assertEqual(session.a, 1)
+        response.session_mtime = time.time()
+        self.store(request, response, session)
+        self.assertEqual(os.stat(filename).st_mtime, 0)
+
+        # but it is touched from time to time so it does not expire
+
+        (request, response, session) = self.connect(cookie)
+        self.assertEqual(session.a, 1)
+        self.store(request, response, session)
+        self.assertNotEqual(os.stat(filename).st_mtime, 0)
+        os.utime(filename, (0, 0))
+        (request, response, session) = self.connect(cookie)
+        session.a = 2
+        self.store(request, response, session)
+        self.assertNotEqual(os.stat(filename).st_mtime, 0)
+        (request, response, session) = self.connect(cookie)
+        self.assertEqual(session.a, 2)
+
+        # a session swept while it is used is written again
+
+        (request, response, session) = self.connect(cookie)
+        self.assertEqual(session.a, 2)
+        os.unlink(filename)
+        response.session_mtime = 0
+        self.store(request, response, session)
+        (request, response, session) = self.connect(cookie)
+        self.assertEqual(session.a, 2)
+
+    def testPrivateKeys(self):
+
+        # keys starting with _ are session data like any other
+
+        (request, response, session) = self.connect()
+        session['_formkey[f]'] = 'k'
+        session.secure()
+        cookie = self.store(request, response, session)
+        (request, response, session) = self.connect(cookie)
+        self.assertEqual(session._secure, False)
+        self.assertEqual(session['_formkey[f]'], 'k')
+        self.assertEqual(session._secure, True)
+        (request, response, session) = self.connect(cookie)
+        session['_formkey[g]'] = 'j'
+        self.assertEqual(session['_formkey[f]'], 'k')
+        self.store(request, response, session)
+        (request, response, session) = self.connect(cookie)
+        self.assertEqual(session.get('_formkey[g]'), 'j')
+
+    def testShardedSession(self):
+        fileutils.shard_levels = 2
+        try:
+            (request, response, session) = self.connect()
+            session.a = 1
+            cookie = self.store(request, response, session)
+            self.assertEqual(len(self.files()), 1)
+            self.assertTrue(os.path.exists(response.session_filename))
+            (request, response, session) = self.connect(cookie)
+            self.assertEqual(session.a, 1)
+        finally:
+            fileutils.shard_levels = 0
+
+    def testSweepSessions(self):
+        folder = os.path.join(self.path, 'app', 'sessions')
+        (request, response, session) = self.connect()
+        session.a = 1
+        cookie = self.store(request, response, session)
+        filename = response.session_filename
+        index = os.path.join(folder, '.expiry')
+        self.assertEqual(os.listdir(os.path.join(index,
+                         os.listdir(index)[0])), [response.session_id])
+        (request, response, session) = self.connect()
+        session.a = 2
+        self.store(request, response, session)
+        self.assertEqual(len(self.files()), 2)
+
+        # only sessions listed in an old enough bucket are deleted
+
+        self.assertEqual(sweep_sessions(folder, 3600), 0)
+        old = time.time() - 7200
+        bucket = os.listdir(index)[0]
+        os.rename(os.path.join(index, bucket), os.path.join(index,
+                  str(int(old // globals.SESSION_EXPIRY_BUCKET))))
+        os.utime(filename, (old, old))
+        self.assertEqual(sweep_sessions(folder, 3600), 1)
+        self.assertEqual(os.listdir(index), [])
+        self.assertFalse(os.path.exists(filename))
+        self.assertEqual(len(self.files()), 1)
+
+        # a full sweep also finds the sessions that are not listed
+
+        os.utime(response.session_filename, (old, old))
+        self.assertEqual(sweep_sessions(folder, 3600), 0)
+        self.assertEqual(sweep_sessions(folder, 3600, full=True), 1)
+        self.assertEqual(self.files(), [])
+
+    def testCookieSession(self):
+        key = 'secret'
+        (request, response, session) = self.connect(cookie_key=key)
+        self.store(request, response, session)
+        self.assertFalse('session_id_app' in response.cookies)
+
+        session.a = 1
+        session.flash = 'hello'
+        self.store(request, response, session)
+        cookie = 'session_id_app=%s' % response.cookies['session_id_app'
+                ].value
+        self.assertEqual(self.files(), [])
+        (request, response, session) = self.connect(cookie,
+                cookie_key=key)
+        self.assertEqual(response.flash, 'hello')
+        self.assertEqual(session.a, 1)
+        self.store(request, response, session)
+        cookie = 'session_id_app=%s' % response.cookies['session_id_app'
+                ].value
+
+        # unchanged sessions are not sent again
+
+        (request, response, session) = self.connect(cookie,
+                cookie_key=key)
+        self.assertEqual(session.a, 1)
+        self.store(request, response, session)
+        self.assertFalse('session_id_app' in response.cookies)
+
+        # the signature is checked
+
+        (request, response, session) = self.connect(cookie,
+                cookie_key='other')
+        self.assertEqual(session.a, None)
+        (request, response, session) = self.connect(cookie.replace('.',
+                'x.'), cookie_key=key)
+        self.assertEqual(session.a, None)
+
+        # and so are the time of signing and the classes in the session
+
+        def sign(data, t):
+            signed = '%i.%s' % (t, base64.urlsafe_b64encode('p' + data))
+            return 'session_id_app=%s.%s' % (signed,
+                    hmac_hash('session_id_app' + signed, key))
+
+        data = cPickle.dumps({'a': 1})
+        (request, response, session) = self.connect(sign(data,
+                time.time() - 7200), cookie_key=key)
+        self.assertEqual(session.a, None)
+        (request, response, session) = self.connect(sign(data,
+                time.time() - 7200), cookie_key=key,
+                cookie_expiration=None)
+        self.assertEqual(session.a, 1)
+        (request, response, session) = self.connect(sign(cPickle.dumps({'a'
+                : Storage(b=datetime.date(2000, 1, 1))}), time.time()),
+                cookie_key=key)
+        self.assertEqual(session.a.b, datetime.date(2000, 1, 1))
+        (request, response, session) = self.connect(sign(cPickle.dumps({'a'
+                : os.path.join}), time.time()), cookie_key=key)
+        self.assertEqual(session.a, None)
+
+        # unchanged sessions are signed again from time to time
+
+        (request, response, session) = self.connect(sign(data,
+                time.time() - 1000), cookie_key=key)
+        self.assertEqual(session.a, 1)
+        self.store(request, response, session)
+        self.assertEqual(response.cookies['session_id_app'].value[:10],
+                         str(int(time.time()))[:10])
+
+    def testCookieSessionSize(self):
+        key = 'secret'
+        (request, response, session) = self.connect(cookie_key=key,
+                compression_level=9)
+        session.a = 'x' * 10000
+        self.store(request, response, session)
+        self.assertEqual(self.files(), [])
+        cookie = 'session_id_app=%s' % response.cookies['session_id_app'
+                ].value
+
+        # sessions too large for a cookie are stored on the server
+
+        (request, response, session) = self.connect(cookie,
+                cookie_key=key)
+        self.assertEqual(session.a, 'x' * 10000)
+        session.a = os.urandom(10000)
+        self.store(request, response, session)
+        self.assertEqual(len(self.files()), 1)
+        cookie = 'session_id_app=%s' % response.cookies['session_id_app'
+                ].value
+        (request, response, session) = self.connect(cookie,
+                cookie_key=key)
+        self.assertEqual(len(session.a), 10000)
+        session.a = 1
+        self.store(request, response, session)
+        self.assertTrue(response.session_in_cookie)
+        self.assertTrue('.' in response.cookies['session_id_app'].value)
+
+    def testMemcacheStore(self):
+        client = FakeMemcache()
+        store = lambda : MemcacheSessionStore(client, expiration=60)
+        (request, response, session) = self.connect(store=store())
+        self.store(request, response, session)
+        self.assertEqual(client.sets, 0)
+        self.assertFalse('session_id_app' in response.cookies)
+
+        session.a = 1
+        cookie = self.store(request, response, session)
+        self.assertEqual(client.sets, 1)
+        self.assertEqual(self.files(), [])
+        (request, response, session) = self.connect(cookie,
+                store=store())
+        self.assertEqual(session.a, 1)
+        self.store(request, response, session)
+        self.assertEqual(client.sets, 1)
+
+        # unchanged sessions are stored again before they expire
+
+        key = client.data.keys()[0]
+        client.data[key][0] = (time.time() - 31, client.data[key][0][1])
+        (request, response, session) = self.connect(cookie,
+                store=store())
+        self.assertEqual(session.a, 1)
+        self.store(request, response, session)
+        self.assertEqual(client.sets, 2)
+
+        client.data.clear()
+        (request, response, session) = self.connect(cookie,
+                store=store())
+        self.assertEqual(session.a, None)
+        self.assertEqual(response.session_id, None)
+
+    def testDBStore(self):
+        db = SQLDB('sqlite:memory:')
+        (request, response, session) = self.connect(db=db)
+        table = db.web2py_session_app
+        self.store(request, response, session)
+        self.assertEqual(db(table.id > 0).count(), 0)
+
+        session.a = 1
+        cookie = self.store(request, response, session)
+        self.assertEqual(db(table.id > 0).count(), 1)
+        (request, response, session) = self.connect(cookie, db=db)
+        self.assertEqual(session.a, 1)
+        session.a = 2
+        self.store(request, response, session)
+        self.assertEqual(db(table.id > 0).count(), 1)
+
+        # unchanged sessions are not written back until they get old
+
+        modified = datetime.datetime(2000, 1, 1)
+        db(table.id > 0).update(modified_datetime=modified)
+        (request, response, session) = self.connect(cookie, db=db)
+        self.assertEqual(session.a, 2)
+        response._session_store.modified = request.now
+        self.store(request, response, session)
+        self.assertEqual(db(table.id > 0).select()[0].modified_datetime,
+                         modified)
+        (request, response, session) = self.connect(cookie, db=db)
+        self.assertEqual(session.a, 2)
+        self.store(request, response, session)
+        self.assertNotEqual(db(table.id > 0).select()[0].modified_datetime,
+                            modified)
+
+        # expired sessions and wrong keys are ignored, and swept
+
+        db(table.id > 0).update(modified_datetime=modified)
+        store = DBSessionStore(db, expiration=3600)
+        (request, response, session) = self.connect(cookie, store=store)
+        self.assertEqual(session.a, None)
+        (request, response, session) = self.connect(cookie + 'x', db=db)
+        self.assertEqual(session.a, None)
+        self.assertEqual(response.session_id, None)
+        store.sweep(3600)
+        store.sweep(3600)
+        self.assertEqual(db(table.id > 0).count(), 0)
+
+        # the index used by sweep is created with the table
+
+        self.assertEqual(db.executesql("SELECT name FROM sqlite_master WHERE type='index' AND tbl_name='web2py_session_app';"
+                         ), [('web2py_session_app_modified_datetime', )])
+
+
+class FakeMemcache(object):
+
+    """
+    in-process stand-in for memcache.Client
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.sets = 0
+
+    def get(self, key):
+        if not key in self.data:
+            return None
+        (value, expires) = self.data[key]
+        if expires and expires < time.time():
+            del self.data[key]
+            return None
+        return value
+
+    def set(self, key, value, time_expire=0):
+        self.sets += 1
+        self.data[key] = [value, time_expire and time.time()
+                          + time_expire]
+        return True
+
+    def delete(self, key):
+        if key in self.data:
+            del self.data[key]
+        return 1
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,7 +9,7 @@ import unittest
 
 sys.path.append(os.path.realpath('../..'))
 
-from gluon.utils import md5_hash
+from gluon.utils import md5_hash, hmac_hash, compare
 
 class TestUtils(unittest.TestCase):
     """ Tests the utils.py module """
@@ -20,5 +20,14 @@ class TestUtils(unittest.TestCase):
         data = md5_hash("web2py rocks")
         self.assertEqual(data, '79509f3246a2824dee64635303e99204')
 
+    def test_hmac_hash(self):
+        """ Tests the hmac_hash and compare functions """
+
+        data = hmac_hash("web2py rocks", "key")
+        self.assertEqual(len(data), 64)
+        self.assertTrue(compare(data, hmac_hash("web2py rocks", "key")))
+        self.assertFalse(compare(data, hmac_hash("web2py rocks", "other")))
+        self.assertFalse(compare(data, data[:-1]))
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,9 +1,27 @@
 #!/usr/bin/python
 # coding: utf-8
 
-from hashlib import md5
+import hmac
+from hashlib import md5, sha256
 
 def md5_hash(text):
     """ Generate a md5 hash with the given text """
 
     return md5(text).hexdigest()
+
+
+def hmac_hash(text, key):
+    """ Generate a hmac-sha256 signature of the given text with key """
+
+    return hmac.new(key, text, sha256).hexdigest()
+
+
+def compare(a, b):
+    """ Compare two strings in a time that does not depend on their content """
+
+    if len(a) != len(b):
+        return False
+    result = 0
+    for (x, y) in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
@@ -24,6 +24,9 @@ from optparse import *
 from textwrap import dedent
 
 import gluon.contrib.cron
+import gluon.compileapp
+import gluon.fileutils
+import gluon.globals
 
 from gluon.main import HttpServer, save_password
 from gluon.fileutils import tar, untar
@@ -658,6 +661,33 @@ def console():
                       default=False,
                       help='Use web2py gui and run in taskbar (system tray)')
 
+    msg = 'freeze all applications: scan them once and skip the per'
+    msg += ' request filesystem checks (send SIGHUP to rescan)'
+    parser.add_option('-Z',
+                      '--frozen',
+                      action='store_true',
+                      dest='frozen',
+                      default=False,
+                      help=msg)
+
+    msg = 'store sessions and uploads in this many levels of hashed'
+    msg += ' subfolders (move existing files with scripts/reshard.py)'
+    parser.add_option('-G',
+                      '--shard_levels',
+                      default=0,
+                      type='int',
+                      dest='shard_levels',
+                      help=msg)
+
+    msg = 'delete file sessions not used for this many seconds'
+    msg += ' in a background thread (0 to disable)'
+    parser.add_option('-E',
+                      '--session_expiration',
+                      default=0,
+                      type='int',
+                      dest='session_expiration',
+                      help=msg)
+
     (options, args) = parser.parse_args()
 
     if options.quiet:
@@ -768,6 +798,22 @@ def start():
     except:
         options.taskbar = False
 
+    # ## if -Z run all applications frozen
+
+    try:
+        gluon.compileapp.frozen = options.frozen
+    except AttributeError:
+        pass
+    try:
+        gluon.fileutils.shard_levels = options.shard_levels
+    except AttributeError:
+        pass
+
+    # ## if -E sweep expired sessions in the background
+
+    if getattr(options, 'session_expiration', 0):
+        gluon.globals.SessionSweeper(options.session_expiration).start()
+
     if options.taskbar and os.name != 'nt':
         print 'Error: taskbar not supported on this platform'
         sys.exit(1)
@@ -18,3 +18,6 @@ request_queue_size = 5
 timeout = 10
 shutdown_timeout = 5
 folder = os.getcwd()
+frozen = False  # ## True skips per request filesystem checks
+shard_levels = 0  # ## levels of hashed subfolders for sessions and uploads
+session_expiration = 0  # ## seconds, sweep expired sessions when > 0
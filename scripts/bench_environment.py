@@ -0,0 +1,24 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# measures the per-request cost of building the controller environment
+# usage: python scripts/bench_environment.py [application]
+import sys
+import os
+import timeit
+sys.path.insert(0, '')
+from gluon.globals import Request, Response, Session
+from gluon.compileapp import build_environment
+NUMBER = 20000
+request = Request()
+request.application = (sys.argv[1:] or ['welcome'])[0]
+request.folder = os.path.join('applications', request.application) + '/'
+
+
+def serve():
+    response = Response()
+    environment = build_environment(request, response, Session())
+    response._view_environment = environment.copy()
+
+
+t = min(timeit.repeat(serve, number=NUMBER, repeat=5))
+print '%.1f us per request' % (t * 1e6 / NUMBER)
@@ -0,0 +1,30 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import os
+import sys
+
+
+def main():
+    """
+    moves the files in sessions/ and uploads/ to the layout with the given
+    number of levels of hashed subfolders (0 for the flat layout).
+    run it from the web2py folder while web2py is stopped and then start
+    web2py with the same --shard_levels:
+
+        python scripts/reshard.py 2 [app1 app2 ...]
+    """
+
+    sys.path.append(os.getcwd())
+    from gluon.fileutils import reshard
+    levels = int(sys.argv[1])
+    apps = sys.argv[2:] or os.listdir('applications')
+    for app in apps:
+        for folder in ['sessions', 'uploads']:
+            path = os.path.join('applications', app, folder)
+            if os.path.isdir(path):
+                print '%s: %s files moved' % (path, reshard(path,
+                        levels))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,22 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
+
+# ## python web2py.py -S app -M -R scripts/sessions2trash.py
+# ## deletes the expired sessions of app, from the database as well if
+# ## the models connect the session to one (see also web2py.py -E)
+
 SLEEP_MINUTES = 5
 EXPIRATION_MINUTES = 60
 import os
 import time
-import stat
+from gluon.globals import sweep_sessions
 path = os.path.join(request.folder, 'sessions')
+full = True
 while 1:
-    now = time.time()
-    for file in os.listdir(path):
-        filename = os.path.join(path, file)
-        t = os.stat(filename)[stat.ST_MTIME]
-        if now - t > EXPIRATION_MINUTES * 60:
-            unlink(filename)
+    sweep_sessions(path, EXPIRATION_MINUTES * 60, full)
+    full = False
+    store = response._session_store
+    if hasattr(store, 'sweep'):
+        store.sweep(EXPIRATION_MINUTES * 60)
+        store.db.commit()
     time.sleep(SLEEP_MINUTES * 60)